@@ -9,11 +9,24 @@ Uso:
 Endpoints:
     GET  /health   - Estado del agent
     GET  /ports    - Lista de puertos seriales
+    GET  /ports/changes       - Long-poll: espera a que se conecte/desconecte una placa
     POST /compile  - Compilar código (sin subir)
+    POST /compile/jobs        - Encolar compilación (devuelve job_id)
+    GET  /compile/jobs/<id>   - Estado/progreso de una compilación encolada
+    DELETE /compile/jobs/<id> - Cancelar compilación encolada
+    POST /compile/stream      - Compilar con log en vivo (Server-Sent Events)
     POST /upload   - Compilar y subir código al Arduino
+    POST /upload/stream       - Subir con log en vivo (Server-Sent Events)
+    POST /upload/batch        - Subir el mismo firmware a varias placas en paralelo
+    GET  /artifacts/<job>/<name> - Descargar un artefacto compilado (binario, Range/ETag)
+    GET  /metrics             - Métricas en formato Prometheus
+    GET  /diagnostics/compile - Tiempos por fase de compilación (resumen por FQBN)
+    POST /cores/install       - Instalar un core en segundo plano (devuelve job_id)
+    GET  /cores/install/<id>  - Estado de una instalación de core
 """
 
 import os
+import re
 import sys
 import json
 import time
@@ -21,47 +34,26 @@ import shutil
 import tempfile
 import platform
 import argparse
+import atexit
+import queue
+import signal
 import subprocess
 import hashlib
 import base64
 import uuid
+import heapq
+import functools
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
-# Job store para upload por job_id (compile -> upload sin reenviar artifacts)
-_upload_job_store = {}
-JOB_TTL_SEC = 600  # 10 min
-
-
-def _store_upload_job(build_dir, family, fqbn):
-    """Guarda un job de compilación. Retorna job_id."""
-    job_id = str(uuid.uuid4())[:12]
-    _upload_job_store[job_id] = {
-        'build_dir': build_dir,
-        'family': family,
-        'fqbn': fqbn,
-        'created_at': time.time(),
-    }
-    return job_id
-
-
-def _get_upload_job(job_id):
-    """Obtiene un job. Retorna dict o None si no existe/expirado."""
-    job = _upload_job_store.get(job_id)
-    if not job:
-        return None
-    if time.time() - job['created_at'] > JOB_TTL_SEC:
-        del _upload_job_store[job_id]
-        return None
-    if not os.path.isdir(job['build_dir']):
-        del _upload_job_store[job_id]
-        return None
-    return job
-
-
 try:
-    from flask import Flask, request, jsonify, make_response
+    from flask import Flask, Response, request, jsonify, make_response, send_file
     from flask_cors import CORS
+    from werkzeug.utils import secure_filename
 except ImportError:
     print("ERROR: Faltan dependencias. Instala con:")
     print("  pip install flask flask-cors requests")
@@ -88,95 +80,357 @@ except ImportError:
 VERSION = "1.2.0"
 DEFAULT_PORT = 8765
 
+
+def _get_home_tmp():
+    """
+    Directorio de trabajo del Agent (temporales, jobs, caché).
+    Con arduino-cli instalado vía snap debe estar dentro de ~/snap/arduino-cli/common
+    para que el proceso confinado pueda leer/escribir.
+    """
+    if ARDUINO_CLI and 'snap' in ARDUINO_CLI:
+        return os.path.join(os.path.expanduser('~'), 'snap', 'arduino-cli', 'common', 'maxide-tmp')
+    return os.path.join(os.path.expanduser('~'), '.maxide-agent', 'tmp')
+
+
+# ============================================
+# JOB STORE (compile → upload por job_id)
+# ============================================
+# Cada job apunta a un directorio con los artefactos (normalmente <home_tmp>/jobs/<id>).
+# Acotado en cantidad y bytes; un hilo barre los expirados cada JOB_SWEEP_INTERVAL_SEC
+# y borra sus directorios. jobs/index.json permite recuperar los jobs tras reiniciar.
+
+_upload_job_store = OrderedDict()  # job_id -> job (más antiguo primero)
+_upload_jobs_lock = threading.RLock()
+JOB_TTL_SEC = 600  # 10 min
+UPLOAD_JOBS_MAX = 100
+UPLOAD_JOBS_MAX_BYTES = 512 * 1024 * 1024
+JOB_SWEEP_INTERVAL_SEC = 60
+UPLOAD_JOBS_PERSIST = True  # --no-persist-jobs
+
+_job_sweeper_thread = None
+
+
+def _get_upload_jobs_dir():
+    return os.path.join(_get_home_tmp(), 'jobs')
+
+
+def _upload_job_owned(build_dir):
+    """True si el directorio vive bajo jobs/ (lo creó el Agent y puede borrarlo)."""
+    jobs_dir = os.path.abspath(_get_upload_jobs_dir())
+    return os.path.dirname(os.path.abspath(build_dir)) == jobs_dir
+
+
+def _save_upload_job_index():
+    """Escribe jobs/index.json (atómico). Llamar con el lock tomado."""
+    if not UPLOAD_JOBS_PERSIST:
+        return
+    jobs_dir = _get_upload_jobs_dir()
+    try:
+        os.makedirs(jobs_dir, exist_ok=True)
+        tmp_path = os.path.join(jobs_dir, 'index.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({jid: job for jid, job in _upload_job_store.items() if _upload_job_owned(job['build_dir'])}, f)
+        os.replace(tmp_path, os.path.join(jobs_dir, 'index.json'))
+    except OSError as e:
+        print(f"[JOBS] No se pudo guardar jobs/index.json: {e}")
+
+
+def _load_upload_job_index():
+    """Recupera jobs vigentes de jobs/index.json (al arrancar). Retorna cuántos se cargaron."""
+    if not UPLOAD_JOBS_PERSIST:
+        return 0
+    try:
+        with open(os.path.join(_get_upload_jobs_dir(), 'index.json'), 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    now = time.time()
+    loaded = 0
+    with _upload_jobs_lock:
+        for jid, job in sorted(saved.items(), key=lambda kv: kv[1].get('created_at', 0)):
+            if not isinstance(job, dict) or not os.path.isdir(job.get('build_dir') or ''):
+                continue
+            if now - job.get('created_at', 0) > JOB_TTL_SEC or jid in _upload_job_store:
+                continue
+            _upload_job_store[jid] = job
+            loaded += 1
+    return loaded
+
+
+def _drop_upload_job(job_id):
+    """Quita un job y borra su directorio si es propio. Llamar con el lock tomado."""
+    job = _upload_job_store.pop(job_id, None)
+    if job and _upload_job_owned(job['build_dir']):
+        shutil.rmtree(job['build_dir'], ignore_errors=True)
+
+
+def _enforce_upload_job_limits():
+    """Descarta los jobs más antiguos mientras se excedan los límites (conserva el último)."""
+    total = sum(j.get('bytes', 0) for j in _upload_job_store.values())
+    while len(_upload_job_store) > 1 and (len(_upload_job_store) > UPLOAD_JOBS_MAX or total > UPLOAD_JOBS_MAX_BYTES):
+        oldest_id = next(iter(_upload_job_store))
+        total -= _upload_job_store[oldest_id].get('bytes', 0)
+        print(f"[JOBS] Descartando job {oldest_id} (límite de jobs/bytes)")
+        _drop_upload_job(oldest_id)
+
+
+def _store_upload_job(build_dir, family, fqbn, job_id=None):
+    """Guarda un job de compilación. Retorna job_id (generado si no se indica)."""
+    job_id = job_id or str(uuid.uuid4())[:12]
+    size = _dir_size(build_dir) if os.path.isdir(build_dir) else 0
+    with _upload_jobs_lock:
+        _upload_job_store.pop(job_id, None)
+        _upload_job_store[job_id] = {
+            'build_dir': build_dir,
+            'family': family,
+            'fqbn': fqbn,
+            'created_at': time.time(),
+            'bytes': size,
+        }
+        _enforce_upload_job_limits()
+        _save_upload_job_index()
+    _start_job_sweeper()
+    return job_id
+
+
+def _get_upload_job(job_id):
+    """Obtiene un job. Retorna dict o None si no existe/expirado."""
+    with _upload_jobs_lock:
+        job = _upload_job_store.get(job_id)
+        if not job:
+            return None
+        if time.time() - job['created_at'] > JOB_TTL_SEC or not os.path.isdir(job['build_dir']):
+            _drop_upload_job(job_id)
+            _save_upload_job_index()
+            return None
+        return job
+
+
+def _sweep_upload_jobs():
+    """
+    Elimina jobs expirados (y sus directorios) y directorios huérfanos en jobs/
+    más viejos que el TTL (p.ej. de un Agent anterior sin índice). Retorna jobs eliminados.
+    """
+    now = time.time()
+    with _upload_jobs_lock:
+        expired = [jid for jid, j in _upload_job_store.items() if now - j['created_at'] > JOB_TTL_SEC]
+        for jid in expired:
+            _drop_upload_job(jid)
+        known = {os.path.abspath(j['build_dir']) for j in _upload_job_store.values()}
+        if expired:
+            _save_upload_job_index()
+    jobs_dir = _get_upload_jobs_dir()
+    try:
+        entries = list(os.scandir(jobs_dir))
+    except OSError:
+        entries = []
+    for entry in entries:
+        try:
+            if entry.is_dir() and os.path.abspath(entry.path) not in known \
+                    and now - entry.stat().st_mtime > JOB_TTL_SEC:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+    return len(expired)
+
+
+def _job_sweeper_loop():
+    while True:
+        time.sleep(JOB_SWEEP_INTERVAL_SEC)
+        try:
+            removed = _sweep_upload_jobs()
+            if removed:
+                print(f"[JOBS] {removed} job(s) expirado(s) eliminados")
+        except Exception as e:
+            print(f"[JOBS] Error barriendo jobs: {e}")
+
+
+def _start_job_sweeper():
+    """Arranca el hilo que barre jobs expirados (idempotente)."""
+    global _job_sweeper_thread
+    with _upload_jobs_lock:
+        if _job_sweeper_thread is None or not _job_sweeper_thread.is_alive():
+            _job_sweeper_thread = threading.Thread(target=_job_sweeper_loop, daemon=True, name='job-sweeper')
+            _job_sweeper_thread.start()
+
+
+def get_upload_jobs_status():
+    """Resumen para /health."""
+    with _upload_jobs_lock:
+        return {
+            'count': len(_upload_job_store),
+            'bytes': sum(j.get('bytes', 0) for j in _upload_job_store.values()),
+            'max_jobs': UPLOAD_JOBS_MAX,
+            'max_bytes': UPLOAD_JOBS_MAX_BYTES,
+            'ttl_sec': JOB_TTL_SEC,
+        }
+
+JOB_MANIFEST_NAME = 'manifest.json'
+
+
+def _handoff_job_artifacts(artifacts, job_dir, move):
+    """
+    Pone los artefactos flasheables en job_dir sin copiar: move=True renombra (build
+    temporal que se va a borrar); move=False crea hardlinks (entrada de caché que debe
+    quedar intacta). Copia solo si el sistema de archivos no lo permite.
+    Escribe manifest.json con tamaño y sha256 de cada archivo.
+    Returns: artefactos con 'path' apuntando a job_dir.
+    """
+    os.makedirs(job_dir, exist_ok=True)
+    handed = []
+    for art in artifacts:
+        dst = os.path.join(job_dir, art['name'])
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            if move:
+                os.replace(art['path'], dst)
+            else:
+                os.link(art['path'], dst)
+        except OSError:
+            shutil.copy2(art['path'], dst)
+        handed.append(dict(art, path=dst))
+    manifest = {
+        'files': {a['name']: {'size': a['size'], 'sha256': a['sha256'], 'type': a['type']} for a in handed},
+        'created_at': time.time(),
+    }
+    with open(os.path.join(job_dir, JOB_MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    return handed
+
+
+def _load_job_manifest(job_dir):
+    """manifest.json de un job (None si no tiene, p.ej. build_dir externo)."""
+    try:
+        with open(os.path.join(job_dir, JOB_MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _verify_job_manifest(job_dir):
+    """
+    Comprueba que los archivos del manifest existan con el tamaño registrado (sin rehashear).
+    Returns: (manifest|None, error_msg|None)
+    """
+    manifest = _load_job_manifest(job_dir)
+    if manifest is None:
+        return None, None
+    for name, info in (manifest.get('files') or {}).items():
+        path = os.path.join(job_dir, name)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return manifest, f'Falta {name} en el job'
+        if size != info.get('size'):
+            return manifest, f'{name} cambió de tamaño ({size} != {info.get("size")} bytes)'
+    return manifest, None
+
+
 # ============================================
 # FUNCIONES DE UTILIDAD - PUERTO SERIAL
 # ============================================
 
-def reset_serial_port(port, log_func=None):
+PORT_READY_TIMEOUT_SEC = 5.0   # espera máxima a que un puerto ocupado/reenumerándose se libere
+PORT_READY_POLL_SEC = 0.05
+
+
+def _probe_port(port):
+    """
+    Intenta abrir y cerrar el puerto pidiendo DTR/RTS bajos. En Linux/macOS el propio
+    open() activa DTR (HUPCL) antes de que pyserial los baje, así que una placa con
+    auto-reset (Uno, Nano) puede reiniciarse igualmente; en Windows no se tocan.
+    'busy' en POSIX solo detecta el flock de ser.exclusive: un monitor serie o WebSerial
+    que abren el puerto sin bloquearlo no se ven y el sondeo da 'free'.
+    Returns: ('free'|'busy'|'missing'|'denied'|'error', mensaje de error|None).
+    'error' es un fallo no reconocido: no tiene sentido reintentar.
+    """
+    ser = serial.Serial()
+    ser.port = port
+    ser.baudrate = 9600
+    ser.timeout = 0
+    ser.dtr = False
+    ser.rts = False
+    if os.name == 'posix':
+        ser.exclusive = True  # falla si otro proceso lo tiene abierto (flock)
+    try:
+        ser.open()
+        try:
+            ser.reset_input_buffer()
+        finally:
+            ser.close()
+        return 'free', None
+    except Exception as e:
+        msg = str(e)
+        low = msg.lower()
+        if 'busy' in low or 'exclusively lock' in low or 'in use' in low:
+            return 'busy', msg
+        if 'access is denied' in low or 'acceso denegado' in low:
+            # Windows: otro proceso tiene el puerto abierto
+            return 'busy', msg
+        if 'permission denied' in low:
+            return 'denied', msg
+        if 'no such file' in low or 'filenotfound' in low or 'cannot find' in low or 'no se puede encontrar' in low:
+            return 'missing', msg
+        if 'input/output error' in low or 'not functioning' in low:
+            # Dispositivo desapareciendo/reenumerándose tras un reset
+            return 'missing', msg
+        return 'error', msg
+
+
+def reset_serial_port(port, log_func=None, timeout=None):
     """
-    Intenta limpiar/resetear un puerto serial antes de usarlo.
-    Esto puede ayudar si el puerto quedó "bloqueado" por una conexión anterior.
+    Deja el puerto listo para usarlo.
+    Si se puede abrir a la primera no hace nada más (sin esperas). Si está ocupado
+    (conexión anterior cerrándose) o reenumerándose tras un reset, reintenta abrirlo
+    cada PORT_READY_POLL_SEC hasta que responda o venza el timeout.
     
     Args:
         port: Nombre del puerto (ej: "COM3", "/dev/ttyUSB0")
         log_func: Función opcional para logging
+        timeout: segundos máximos de espera (default PORT_READY_TIMEOUT_SEC)
     
     Returns:
-        bool: True si se pudo limpiar, False si hubo error
+        bool: True si el puerto quedó libre, False si sigue ocupado, sin permisos
+        o con un error no reconocido
     """
-    import serial
-    
     def log(msg):
         if log_func:
             log_func(msg)
         else:
             print(f"[RESET_PORT] {msg}")
-    
-    log(f"Intentando limpiar puerto {port}...")
-    
-    try:
-        # Paso 1: Intentar cerrar cualquier conexión existente
-        # abriendo y cerrando el puerto
-        try:
-            ser = serial.Serial()
-            ser.port = port
-            ser.baudrate = 9600
-            ser.timeout = 0.5
-            ser.dtr = False
-            ser.rts = False
-            
-            # Abrir el puerto
-            ser.open()
-            log(f"Puerto {port} abierto para limpieza")
-            
-            # Limpiar buffers
-            if ser.is_open:
-                ser.reset_input_buffer()
-                ser.reset_output_buffer()
-                log("Buffers limpiados")
-            
-            # Pequeña pausa
-            time.sleep(0.2)
-            
-            # Cerrar
-            ser.close()
-            log(f"Puerto {port} cerrado correctamente")
-            
-        except serial.SerialException as e:
-            # Si no se puede abrir, puede que ya esté cerrado o bloqueado
-            log(f"No se pudo abrir para limpiar: {e}")
-            # Continuar de todos modos
-        
-        # Paso 2: En Windows, intentar reset adicional
-        if platform.system() == 'Windows':
-            log("Aplicando reset adicional para Windows...")
-            try:
-                # Intentar con DTR toggle (reset del Arduino)
-                ser = serial.Serial()
-                ser.port = port
-                ser.baudrate = 1200  # Baudrate especial para forzar reset en algunos Arduinos
-                ser.timeout = 0.1
-                ser.open()
-                ser.dtr = True
-                time.sleep(0.1)
-                ser.dtr = False
-                time.sleep(0.1)
-                ser.close()
-                log("Reset DTR aplicado")
-            except Exception as e:
-                log(f"Reset DTR falló (normal si el puerto ya está limpio): {e}")
-        
-        # Paso 3: Esperar un momento para que el puerto se estabilice
-        log("Esperando estabilización del puerto...")
-        time.sleep(0.5)
-        
-        log(f"✓ Puerto {port} listo")
+
+    timeout = PORT_READY_TIMEOUT_SEC if timeout is None else timeout
+    t0 = time.time()
+    state, err = _probe_port(port)
+    if state == 'free':
+        log(f"Puerto {port} libre ({(time.time() - t0) * 1000:.0f} ms), sin reset")
         return True
-        
-    except Exception as e:
-        log(f"Error durante limpieza de puerto: {e}")
+    if state == 'denied':
+        log(f"Sin permisos sobre {port}: {err}")
+        return False
+    if state == 'error':
+        log(f"No se pudo abrir {port}: {err}")
         return False
 
+    log(f"Puerto {port} {'ocupado' if state == 'busy' else 'no disponible'} ({err}); esperando a que responda...")
+    polls = 0
+    while time.time() - t0 < timeout:
+        time.sleep(PORT_READY_POLL_SEC)
+        polls += 1
+        state, err = _probe_port(port)
+        if state == 'free':
+            log(f"✓ Puerto {port} listo tras {(time.time() - t0) * 1000:.0f} ms ({polls} sondeos)")
+            return True
+        if state == 'denied':
+            log(f"Sin permisos sobre {port}: {err}")
+            return False
+        if state == 'error':
+            log(f"No se pudo abrir {port}: {err}")
+            return False
+    log(f"Puerto {port} sigue {'ocupado' if state == 'busy' else 'no disponible'} tras {timeout:.1f}s: {err}")
+    return False
+
 
 def force_close_port_windows(port):
     """
@@ -249,14 +503,17 @@ REQUIRED_CORES = ['arduino:avr', 'esp32:esp32']
 
 def ensure_cores_installed():
     """
-    Verifica arduino-cli, versión y cores instalados (arduino:avr, esp32:esp32).
-    Si falta alguno, intenta instalarlo. Idempotente.
+    Verifica arduino-cli, versión, cores instalados (arduino:avr, esp32:esp32) y esptool.
+    Si falta algún core, lanza su instalación como job en segundo plano (no espera). Idempotente.
     
     Returns:
         dict: {
             'arduino_cli_ok': bool,
             'arduino_cli_version': str|None,
             'cores': {'avr_ok': bool, 'esp32_ok': bool},
+            'core_versions': {core_id: versión},
+            'esptool': {'ok': bool, 'path': str|None},
+            'installing': [core_id, ...],
             'errors': [str, ...]
         }
     """
@@ -264,114 +521,250 @@ def ensure_cores_installed():
         'arduino_cli_ok': False,
         'arduino_cli_version': None,
         'cores': {'avr_ok': False, 'esp32_ok': False},
+        'core_versions': {},
+        'esptool': {'ok': False, 'path': None},
+        'installing': [],
         'errors': []
     }
     
     def log(msg):
         print(f"[CORES] {msg}")
+
+    # esptool (fallback de upload ESP32)
+    try:
+        esptool_path = _find_esptool()
+    except Exception:
+        esptool_path = None
+    result['esptool'] = {'ok': bool(esptool_path), 'path': esptool_path}
     
     # 1) Verificar arduino-cli existe
     if not ARDUINO_CLI:
         result['errors'].append('arduino-cli no encontrado')
-        log("✗ arduino-cli no encontrado")
         return result
     
     result['arduino_cli_ok'] = True
-    log(f"arduino-cli: {ARDUINO_CLI}")
-    
-    # 2) Obtener versión
-    try:
-        r = subprocess.run(
-            [ARDUINO_CLI, 'version'],
-            capture_output=True, text=True, timeout=10
-        )
-        if r.returncode == 0:
-            out = r.stdout.strip()
-            if 'Version:' in out:
-                result['arduino_cli_version'] = out.split('Version:')[1].split()[0].strip()
-            elif out:
-                result['arduino_cli_version'] = out.split()[0] if out else None
-            log(f"Versión: {result['arduino_cli_version'] or '?'}")
-        else:
-            result['errors'].append('arduino-cli version falló')
-            log("✗ No se pudo obtener versión de arduino-cli")
-    except Exception as e:
-        result['errors'].append(f'arduino-cli version: {e}')
-        log(f"✗ Error ejecutando arduino-cli: {e}")
-        return result
     
-    # 3) Listar cores instalados
-    installed_cores = []
-    try:
-        r = subprocess.run(
-            [ARDUINO_CLI, 'core', 'list'],
-            capture_output=True, text=True, timeout=30
-        )
-        if r.returncode == 0:
-            for line in r.stdout.strip().split('\n')[1:]:  # Skip header
-                parts = line.split()
-                if len(parts) >= 1:
-                    # Columna 0 = ID (ej: arduino:avr, esp32:esp32)
-                    installed_cores.append(parts[0])
-        else:
-            result['errors'].append('arduino-cli core list falló')
-            log("✗ No se pudo listar cores")
-    except Exception as e:
-        result['errors'].append(f'core list: {e}')
-        log(f"✗ Error listando cores: {e}")
+    # 2) Obtener versión (cacheada por ruta del ejecutable)
+    result['arduino_cli_version'] = _get_arduino_cli_version()
+    if not result['arduino_cli_version']:
+        result['errors'].append('arduino-cli version falló')
+        log("✗ No se pudo obtener versión de arduino-cli")
+
+    # 3) Cores instalados (índice en memoria; solo llama a `core list` si cambió el data dir)
+    if _get_installed_cores() is None:
+        result['errors'].append('arduino-cli core list falló')
+        log("✗ No se pudo listar cores")
         return result
-    
-    # 4) Verificar e instalar cada core (idempotente)
+
+    # 4) Verificar cada core; los que falten se instalan como job (idempotente)
     core_map = {'arduino:avr': 'avr_ok', 'esp32:esp32': 'esp32_ok'}
     for core in REQUIRED_CORES:
-        is_installed = any(c == core or c.startswith(core + ':') for c in installed_cores)
-        
-        if is_installed:
+        if _is_core_installed(core):
             result['cores'][core_map[core]] = True
-            log(f"✓ {core} ya instalado")
-        else:
-            log(f"Instalando {core}...")
-            try:
-                subprocess.run(
-                    [ARDUINO_CLI, 'core', 'update-index'],
-                    capture_output=True, text=True, timeout=120
-                )
-                r = subprocess.run(
-                    [ARDUINO_CLI, 'core', 'install', core],
-                    capture_output=True, text=True, timeout=180
-                )
-                if r.returncode == 0:
-                    result['cores'][core_map[core]] = True
-                    log(f"✓ {core} instalado correctamente")
-                else:
-                    err = (r.stderr or r.stdout or '').strip()[:200]
-                    result['errors'].append(f'Instalación {core} falló: {err}')
-                    log(f"✗ Error instalando {core}: {err}")
-            except subprocess.TimeoutExpired:
-                result['errors'].append(f'Timeout instalando {core}')
-                log(f"✗ Timeout instalando {core}")
-            except Exception as e:
-                result['errors'].append(f'{core}: {e}')
-                log(f"✗ Error instalando {core}: {e}")
+            result['core_versions'][core] = _get_core_version(core)
+            continue
+        job = _start_core_install(core, auto=True)
+        if job is None:
+            continue
+        if job['state'] in ('queued', 'running'):
+            result['installing'].append(core)
+        elif job['state'] == 'failed':
+            result['errors'].append(f"Instalación {core} falló: {job['error']}")
     
     return result
 
 
-# Cache del último resultado de ensure_cores (para no bloquear /health)
-_cached_cores_status = None
-_cached_cores_ts = 0
-CORES_CACHE_TTL = 60  # segundos
+def _parse_cli_version(output):
+    """Extrae la versión de la salida de `arduino-cli version`."""
+    output = (output or '').strip()
+    if 'Version:' in output:
+        return output.split('Version:')[1].split()[0].strip()
+    if output:
+        return output.split()[0]
+    return None
+
 
+# Versión de arduino-cli por ruta (no cambia mientras el Agent corre)
+_cli_version_cache = {}
 
-def get_cores_status():
-    """Obtiene estado de cores (con cache corto para no bloquear /health)."""
-    global _cached_cores_status, _cached_cores_ts
+
+def _get_arduino_cli_version():
+    """Versión de arduino-cli (cacheada por ruta del ejecutable). None si no se pudo obtener."""
+    if not ARDUINO_CLI:
+        return None
+    if ARDUINO_CLI in _cli_version_cache:
+        return _cli_version_cache[ARDUINO_CLI]
+    try:
+        r = _cli_query([ARDUINO_CLI, 'version'], 10)
+        if r.returncode != 0:
+            return None
+        version = _parse_cli_version(r.stdout)
+    except Exception:
+        return None
+    _cli_version_cache[ARDUINO_CLI] = version
+    return version
+
+
+# ============================================
+# ÍNDICE DE CORES INSTALADOS
+# ============================================
+# `core list` tarda 1-3 s; lo ejecutamos al arrancar, tras instalar un core o cuando
+# cambia el data dir de arduino-cli (mtime de packages/<vendor>/hardware/<arch>).
+# Consultar si un core está instalado es un lookup en memoria.
+
+# Versión instalada de cada core (core_id -> versión). None = índice sin cargar.
+_installed_core_versions = None
+_cores_index_lock = threading.Lock()
+_cores_index_state = {'cli': None, 'data_dir': None, 'signature': None, 'checked_at': 0.0}
+# Cada cuánto revisar el mtime del data dir (segundos)
+CORES_INDEX_CHECK_SEC = 2.0
+
+# Data dir por ruta de arduino-cli
+_arduino_data_dir_cache = {}
+
+
+def _default_arduino_data_dir():
+    """Data dir por defecto de arduino-cli según el SO."""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~\\AppData\\Local')
+        return os.path.join(base, 'Arduino15')
+    if sys.platform == 'darwin':
+        return os.path.expanduser('~/Library/Arduino15')
+    return os.path.expanduser('~/.arduino15')
+
+
+def _arduino_cli_config_dir(key):
+    """
+    Directorio configurado en arduino-cli (p.ej. directories.data): `config get` (CLI >= 0.35)
+    o `config dump --format json`. None si ninguno responde.
+    """
+    try:
+        r = subprocess.run([ARDUINO_CLI, 'config', 'get', key],
+                           capture_output=True, text=True, timeout=10)
+        out = (r.stdout or '').strip()
+        if r.returncode == 0 and out and os.path.isabs(out.splitlines()[0].strip()):
+            return out.splitlines()[0].strip()
+        r = subprocess.run([ARDUINO_CLI, 'config', 'dump', '--format', 'json'],
+                           capture_output=True, text=True, timeout=10)
+        if r.returncode == 0 and r.stdout.strip():
+            value = json.loads(r.stdout)
+            value = value.get('config', value) if isinstance(value, dict) else {}
+            for part in key.split('.'):
+                value = value.get(part) if isinstance(value, dict) else None
+            if isinstance(value, str) and value:
+                return value
+    except Exception:
+        pass
+    return None
+
+
+def _get_arduino_data_dir():
+    """
+    directories.data de arduino-cli. Se consulta una vez por ejecutable; si falla, ruta por defecto.
+    """
+    if not ARDUINO_CLI:
+        return None
+    if ARDUINO_CLI in _arduino_data_dir_cache:
+        return _arduino_data_dir_cache[ARDUINO_CLI]
+    data_dir = _arduino_cli_config_dir('directories.data') or _default_arduino_data_dir()
+    _arduino_data_dir_cache[ARDUINO_CLI] = data_dir
+    return data_dir
+
+
+def _cores_dir_signature(data_dir):
+    """
+    Firma barata del estado de cores instalados: mtimes de packages/, packages/*/hardware
+    y packages/*/hardware/*. Instalar/actualizar/quitar un core cambia alguno de ellos.
+    """
+    if not data_dir:
+        return None
+    packages = os.path.join(data_dir, 'packages')
+    try:
+        mtimes = [os.stat(packages).st_mtime_ns]
+        for vendor in os.scandir(packages):
+            hardware = os.path.join(vendor.path, 'hardware')
+            if not vendor.is_dir() or not os.path.isdir(hardware):
+                continue
+            mtimes.append(os.stat(hardware).st_mtime_ns)
+            for arch in os.scandir(hardware):
+                if arch.is_dir():
+                    mtimes.append(arch.stat().st_mtime_ns)
+    except OSError:
+        return None
+    return (len(mtimes), max(mtimes))
+
+
+def _refresh_cores_index():
+    """
+    Recarga el índice con `arduino-cli core list`.
+    Returns: dict core_id -> versión, o None si el CLI falló (el índice anterior se conserva).
+    """
+    global _installed_core_versions
+    if not ARDUINO_CLI:
+        return None
+    data_dir = _get_arduino_data_dir()
+    # Firma antes de listar: si algo cambia durante `core list`, la próxima consulta recarga
+    signature = _cores_dir_signature(data_dir)
+    _cli_daemon_invalidate()
+    try:
+        r = _cli_query([ARDUINO_CLI, 'core', 'list'], 30)
+    except Exception as e:
+        print(f"[CORES] Error listando cores: {e}")
+        return None
+    if r.returncode != 0:
+        return None
+    cores = {}
+    for line in (r.stdout or '').strip().split('\n')[1:]:  # Skip header
+        parts = line.split()
+        if parts:
+            # Columna 0 = ID (ej: arduino:avr), columna 1 = versión instalada
+            cores[parts[0]] = parts[1] if len(parts) >= 2 else None
+    with _cores_index_lock:
+        _installed_core_versions = cores
+        _cores_index_state.update({
+            'cli': ARDUINO_CLI, 'data_dir': data_dir,
+            'signature': signature, 'checked_at': time.time(),
+        })
+    return cores
+
+
+def _get_installed_cores():
+    """
+    Índice de cores instalados (core_id -> versión). Carga perezosa; se recarga solo si
+    cambió el ejecutable o la firma del data dir (revisada como mucho cada CORES_INDEX_CHECK_SEC).
+    Returns None si el índice no se pudo cargar.
+    """
+    cores = _installed_core_versions
+    state = _cores_index_state
+    if cores is None or state['cli'] != ARDUINO_CLI:
+        return _refresh_cores_index()
     now = time.time()
-    if _cached_cores_status is not None and (now - _cached_cores_ts) < CORES_CACHE_TTL:
-        return _cached_cores_status
-    _cached_cores_status = ensure_cores_installed()
-    _cached_cores_ts = now
-    return _cached_cores_status
+    with _cores_index_lock:
+        # Solo un hilo por intervalo revisa la firma
+        if now - state['checked_at'] < CORES_INDEX_CHECK_SEC:
+            return cores
+        state['checked_at'] = now
+        data_dir, signature = state['data_dir'], state['signature']
+    if _cores_dir_signature(data_dir) != signature:
+        print("[CORES] Cambios en el data dir de arduino-cli, recargando índice de cores")
+        return _refresh_cores_index() or cores
+    return cores
+
+
+def _is_core_installed(core_id):
+    """True si core_id (package:arch) figura en el índice de cores instalados."""
+    cores = _get_installed_cores()
+    if not cores or not core_id:
+        return False
+    if core_id in cores:
+        return True
+    return any(c.startswith(core_id + ':') for c in cores)
+
+
+def _get_core_version(core_id):
+    """Versión instalada de core_id según el índice (None si no está o no se conoce)."""
+    cores = _get_installed_cores()
+    return cores.get(core_id) if cores and core_id else None
 
 
 def _core_id_from_fqbn(fqbn):
@@ -405,94 +798,506 @@ def ensure_core_for_fqbn(fqbn, log_func=None):
     if not ARDUINO_CLI:
         return False, 'arduino-cli no encontrado'
 
-    # Listar cores instalados
-    try:
-        r = subprocess.run(
-            [ARDUINO_CLI, 'core', 'list'],
-            capture_output=True, text=True, timeout=30
-        )
-        if r.returncode != 0:
-            return False, 'No se pudo listar cores'
-        installed = []
-        for line in r.stdout.strip().split('\n')[1:]:
-            parts = line.split()
-            if parts:
-                installed.append(parts[0])
-    except Exception as e:
-        log(f"Error listando cores: {e}")
-        return False, str(e)
+    if _is_core_installed(core_id):
+        log(f"Core {core_id} ya instalado")
+        return True, None
 
-    is_installed = any(c == core_id or c.startswith(core_id + ':') for c in installed)
-    if is_installed:
+    # Fallo en el índice: confirmar con `core list` antes de instalar
+    if _refresh_cores_index() is None:
+        return False, 'No se pudo listar cores'
+    if _is_core_installed(core_id):
         log(f"Core {core_id} ya instalado")
         return True, None
 
     log(f"Instalando core {core_id} para {fqbn}...")
-    try:
-        subprocess.run(
-            [ARDUINO_CLI, 'config', 'set', 'network.connection_timeout', '600s'],
-            capture_output=True, text=True, timeout=10
-        )
-        subprocess.run(
-            [ARDUINO_CLI, 'core', 'update-index'],
-            capture_output=True, text=True, timeout=120
-        )
-        r = subprocess.run(
-            [ARDUINO_CLI, 'core', 'install', core_id],
-            capture_output=True, text=True, timeout=180
-        )
-        if r.returncode == 0:
-            log(f"✓ Core {core_id} instalado correctamente")
-            return True, None
-        err = (r.stderr or r.stdout or '').strip()[:300]
-        return False, f'Error instalando core {core_id}: {err}'
-    except subprocess.TimeoutExpired:
+    job = _start_core_install(core_id)
+    if not _wait_core_install(job, CORE_INSTALL_WAIT_SEC):
         return False, f'Timeout instalando core {core_id}'
-    except Exception as e:
-        return False, str(e)
+    if job['state'] == 'done':
+        log(f"✓ Core {core_id} instalado correctamente")
+        return True, None
+    return False, job['error'] or f'Error instalando core {core_id}'
+
 
 # ============================================
-# FLASK APP
+# ÍNDICE DE LIBRERÍAS (header -> directorio de librería)
 # ============================================
+# Antes se pasaba agent/libraries/Servo con --library a toda compilación ESP32. Ahora se
+# indexan los headers de las librerías incluidas con el Agent (bundled), las instaladas
+# (sketchbook), las de cada plataforma y las builtin; por sketch se leen los #include y
+# solo se pasa --library cuando hace falta fijar la elección:
+#   - el header lo provee una librería bundled compatible con la arquitectura (gana siempre);
+#   - o hay varias candidatas: se elige por bundled > plataforma de la placa > sketchbook > builtin.
+# Una única candidata se deja a la detección de arduino-cli. El índice se recarga si
+# cambia el mtime de alguna carpeta de librerías (revisado cada LIBRARY_INDEX_CHECK_SEC).
+
+BUNDLED_LIBRARIES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libraries')
+LIBRARY_INDEX_CHECK_SEC = 5.0
+LIBRARY_SOURCE_PRIORITY = {'bundled': 0, 'platform': 1, 'user': 2, 'builtin': 3}
+_LIBRARY_ARCH_DIRS = ('avr', 'megaavr', 'sam', 'samd', 'esp32', 'esp8266', 'nrf52', 'stm32f4',
+                      'mbed', 'renesas', 'rp2040')
+_INCLUDE_RE = re.compile(r'^[ \t]*#[ \t]*include[ \t]*[<"]([^>"]+)[>"]', re.MULTILINE)
+
+_library_index = {'signature': None, 'checked_at': 0.0, 'headers': {}, 'count': 0}
+_library_index_lock = threading.Lock()
+_arduino_user_dir_cache = {}
+
+
+def _get_arduino_user_dir():
+    """directories.user de arduino-cli (sketchbook; las librerías instaladas van en libraries/)."""
+    if not ARDUINO_CLI:
+        return None
+    if ARDUINO_CLI not in _arduino_user_dir_cache:
+        default = os.path.join(os.path.expanduser('~'), 'Documents' if sys.platform in ('win32', 'darwin') else '', 'Arduino')
+        _arduino_user_dir_cache[ARDUINO_CLI] = _arduino_cli_config_dir('directories.user') or os.path.normpath(default)
+    return _arduino_user_dir_cache[ARDUINO_CLI]
+
+
+def _library_roots():
+    """[(source, platform_id|None, carpeta que contiene librerías)] que existen."""
+    roots = [('bundled', None, BUNDLED_LIBRARIES_DIR)]
+    user_dir = _get_arduino_user_dir()
+    if user_dir:
+        roots.append(('user', None, os.path.join(user_dir, 'libraries')))
+    data_dir = _get_arduino_data_dir()
+    if data_dir:
+        roots.append(('builtin', None, os.path.join(data_dir, 'libraries')))
+        packages = os.path.join(data_dir, 'packages')
+        try:
+            for vendor in os.scandir(packages):
+                hardware = os.path.join(vendor.path, 'hardware')
+                if not os.path.isdir(hardware):
+                    continue
+                for arch in os.scandir(hardware):
+                    for version in (os.scandir(arch.path) if arch.is_dir() else []):
+                        libs = os.path.join(version.path, 'libraries')
+                        if os.path.isdir(libs):
+                            roots.append(('platform', f'{vendor.name}:{arch.name}', libs))
+        except OSError:
+            pass
+    return [r for r in roots if os.path.isdir(r[2])]
 
-app = Flask(__name__)
-
-# Configurar CORS - Permitir todos los orígenes ya que el Agent solo es accesible localmente
-# Esto es necesario porque el frontend puede venir de HTTPS (Render) o HTTP (local)
-CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=False)
 
-# ============================================
-# MIDDLEWARE - Headers de seguridad y CORS
-# ============================================
+def _library_dirs_signature(roots):
+    """Firma barata: mtime de cada carpeta raíz y de cada librería (instalar/quitar/actualizar la cambia)."""
+    mtimes = []
+    for _source, _platform, root in roots:
+        try:
+            mtimes.append(os.stat(root).st_mtime_ns)
+            mtimes.extend(e.stat().st_mtime_ns for e in os.scandir(root) if e.is_dir())
+        except OSError:
+            pass
+    return (len(roots), len(mtimes), max(mtimes) if mtimes else 0)
 
-@app.after_request
-def add_security_headers(response):
-    """Añade headers de seguridad y CORS a todas las respuestas."""
-    response.headers['X-MAX-IDE-Agent'] = '1'
-    response.headers['X-Agent-Version'] = VERSION
-    # CORS headers explícitos para máxima compatibilidad
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-MAX-IDE-Client, X-Requested-With, Accept, Origin'
-    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-    response.headers['Access-Control-Max-Age'] = '86400'  # Cache preflight por 24h
-    return response
 
-@app.before_request
-def handle_preflight():
-    """Maneja todas las peticiones OPTIONS (preflight) de forma centralizada."""
-    if request.method == 'OPTIONS':
-        response = make_response()
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-MAX-IDE-Client, X-Requested-With, Accept, Origin'
-        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-        response.headers['Access-Control-Max-Age'] = '86400'
-        return response, 200
+def _read_library_info(lib_dir, source, platform_id):
+    """Headers incluibles (src/ o raíz en formato antiguo) y arquitecturas de una librería."""
+    props = {}
+    try:
+        with open(os.path.join(lib_dir, 'library.properties'), 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if '=' in line and not line.lstrip().startswith('#'):
+                    k, v = line.split('=', 1)
+                    props[k.strip()] = v.strip()
+    except OSError:
+        pass
+    src = os.path.join(lib_dir, 'src')
+    header_dir = src if os.path.isdir(src) else lib_dir
+    try:
+        entries = list(os.scandir(header_dir))
+    except OSError:
+        return None
+    headers = [e.name for e in entries if e.is_file() and e.name.lower().endswith(('.h', '.hpp'))]
+    # Carpetas por arquitectura en src/ (p.ej. Servo bundled: solo src/esp32) mandan sobre library.properties
+    arch_dirs = [e.name for e in entries if e.is_dir() and e.name in _LIBRARY_ARCH_DIRS] if header_dir == src else []
+    archs = [a.strip() for a in props.get('architectures', '*').split(',') if a.strip()]
+    return {
+        'name': props.get('name') or os.path.basename(lib_dir),
+        'dir': lib_dir,
+        'source': source,
+        'platform': platform_id,
+        'archs': arch_dirs or archs or ['*'],
+        'headers': headers,
+    }
 
-# ============================================
-# ENDPOINT: GET /health
-# ============================================
 
-@app.route('/health', methods=['GET', 'OPTIONS'])
+def _build_library_index(roots):
+    headers = {}
+    count = 0
+    for source, platform_id, root in roots:
+        try:
+            lib_dirs = sorted(e.path for e in os.scandir(root) if e.is_dir() and not e.name.startswith('.'))
+        except OSError:
+            continue
+        for lib_dir in lib_dirs:
+            info = _read_library_info(lib_dir, source, platform_id)
+            if not info or not info['headers']:
+                continue
+            count += 1
+            for header in info['headers']:
+                headers.setdefault(header, []).append(info)
+    return headers, count
+
+
+def _get_library_index():
+    """Índice header -> [librerías]. Se reconstruye al cambiar las carpetas de librerías."""
+    with _library_index_lock:
+        now = time.time()
+        if _library_index['signature'] is not None and now - _library_index['checked_at'] < LIBRARY_INDEX_CHECK_SEC:
+            return _library_index['headers']
+        _library_index['checked_at'] = now
+        roots = _library_roots()
+        signature = (tuple(r[2] for r in roots), _library_dirs_signature(roots))
+        if signature != _library_index['signature']:
+            headers, count = _build_library_index(roots)
+            if _library_index['signature'] is not None:
+                print(f"[LIBS] Cambios en carpetas de librerías, índice recargado ({count} librerías)")
+            _library_index.update(signature=signature, headers=headers, count=count)
+        return _library_index['headers']
+
+
+def _sketch_includes(sketch_files):
+    """Headers incluidos por el sketch que no son archivos del propio sketch."""
+    own = {os.path.basename(name) for name in sketch_files}
+    found = []
+    for content in sketch_files.values():
+        for header in _INCLUDE_RE.findall(str(content)):
+            header = header.strip()
+            if header not in own and header not in found:
+                found.append(header)
+    return found
+
+
+def _library_supports(info, fqbn):
+    arch = (fqbn or '').split(':')[1] if fqbn and fqbn.count(':') >= 2 else None
+    if info['source'] == 'platform':
+        return info['platform'] == _core_id_from_fqbn(fqbn)
+    return '*' in info['archs'] or arch in info['archs']
+
+
+def _library_args_for_sketch(fqbn, sketch_files, log_func=None):
+    """
+    --library necesarios para el sketch según sus #include (ver ÍNDICE DE LIBRERÍAS).
+    Returns: lista de argumentos para arduino-cli compile.
+    """
+    index = _get_library_index()
+    args = []
+    chosen = []
+    for header in _sketch_includes(sketch_files):
+        candidates = [i for i in index.get(header, []) if _library_supports(i, fqbn)]
+        if not candidates:
+            continue
+        best = min(candidates, key=lambda i: (LIBRARY_SOURCE_PRIORITY[i['source']], i['name'].lower()))
+        if best['source'] != 'bundled' and len({c['dir'] for c in candidates}) == 1:
+            continue
+        if best['dir'] not in args:
+            args.extend(['--library', best['dir']])
+            chosen.append(f"{header} → {best['name']} ({best['source']})")
+    if chosen and log_func:
+        log_func(f"Librerías: {', '.join(chosen)}")
+    return args
+
+
+def _read_library_version(lib_dir):
+    """version de library.properties o, si no hay, el mtime de la carpeta (formato antiguo)."""
+    try:
+        with open(os.path.join(lib_dir, 'library.properties'), 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                k, sep, v = line.partition('=')
+                if sep and k.strip() == 'version':
+                    return v.strip()
+    except OSError:
+        pass
+    try:
+        return f'mtime:{os.stat(lib_dir).st_mtime_ns}'
+    except OSError:
+        return None
+
+
+def _sketch_library_versions(fqbn, sketch_files):
+    """
+    {header: ["dir@version", ...]} de las librerías que pueden resolver cada #include del
+    sketch. Forma parte de la clave de caché: actualizar una librería invalida los binarios
+    que la enlazaron. Se leen de disco en cada llamada porque actualizar en sitio no
+    siempre cambia el mtime de la carpeta que vigila el índice.
+    """
+    index = _get_library_index()
+    versions = {}
+    for header in _sketch_includes(sketch_files):
+        dirs = sorted({i['dir'] for i in index.get(header, []) if _library_supports(i, fqbn)})
+        if dirs:
+            versions[header] = [f"{d}@{_read_library_version(d)}" for d in dirs]
+    return versions
+
+
+def get_library_index_status():
+    """Resumen para /health."""
+    with _library_index_lock:
+        return {
+            'libraries': _library_index['count'],
+            'headers': len(_library_index['headers']),
+            'checked_at': _library_index['checked_at'] or None,
+        }
+
+
+# ============================================
+# INSTALACIÓN DE CORES (jobs en segundo plano)
+# ============================================
+# update-index + install pueden tardar minutos: corren en su propio hilo, de a uno
+# (arduino-cli no admite instalaciones simultáneas sobre el mismo data dir) y se
+# consultan con GET /cores/install/<id>. Quien necesita el core espera al job.
+
+CORE_INSTALL_TIMEOUT = 300      # segundos para `core install`
+CORE_INSTALL_WAIT_SEC = 450     # espera máxima de una compilación/subida por el core
+CORE_INSTALL_RETRY_SEC = 600    # el prober no reintenta una instalación fallida antes de esto
+CORE_INSTALL_JOBS_KEEP = 20
+_CORE_ID_RE = re.compile(r'^[A-Za-z0-9_.\-]+:[A-Za-z0-9_.\-]+$')
+
+_core_install_jobs = OrderedDict()
+_core_install_jobs_lock = threading.Lock()
+_core_install_run_lock = threading.Lock()
+
+
+def _core_install_view(job):
+    """Representación JSON de un job de instalación."""
+    now = time.time()
+    return {
+        'job_id': job['id'],
+        'core': job['core'],
+        'state': job['state'],
+        'step': job['step'],
+        'auto': job['auto'],
+        'created_at': job['created_at'],
+        'elapsed_sec': round((job['finished_at'] or now) - job['started_at'], 2) if job['started_at'] else 0.0,
+        'error': job['error'],
+        'logs': list(job['logs']),
+    }
+
+
+def _run_core_install(job):
+    """Hilo: config + update-index + install de un core."""
+    core_id = job['core']
+
+    def log(msg):
+        timestamp = datetime.now().strftime('%H:%M:%S')
+        job['logs'].append(f"[{timestamp}] {msg}")
+        print(f"[CORES] {msg}")
+
+    def log_output(r):
+        for line in ((r.stdout or '') + '\n' + (r.stderr or '')).split('\n'):
+            if line.strip():
+                job['logs'].append(line.strip())
+
+    with _core_install_run_lock:
+        job['state'] = 'running'
+        job['started_at'] = time.time()
+        try:
+            if _is_core_installed(core_id):
+                log(f"✓ {core_id} ya instalado")
+                job['state'] = 'done'
+                return
+            job['step'] = 'config'
+            _run_cli([ARDUINO_CLI, 'config', 'set', 'network.connection_timeout', '600s'], 10)
+            job['step'] = 'update-index'
+            log('Actualizando índice de paquetes...')
+            _run_cli([ARDUINO_CLI, 'core', 'update-index'], 120)
+            job['step'] = 'install'
+            log(f'Instalando {core_id}... (puede tardar 1-3 minutos)')
+            r = _run_cli([ARDUINO_CLI, 'core', 'install', core_id], CORE_INSTALL_TIMEOUT)
+            log_output(r)
+            if r.returncode == 0:
+                _refresh_cores_index()
+                log(f"✓ {core_id} instalado correctamente")
+                job['state'] = 'done'
+            else:
+                job['error'] = f"Error instalando core {core_id}: {(r.stderr or r.stdout or '').strip()[:300]}"
+                log(f"✗ {job['error']}")
+                job['state'] = 'failed'
+        except subprocess.TimeoutExpired:
+            job['error'] = f'Timeout instalando core {core_id}'
+            log(f"✗ {job['error']}")
+            job['state'] = 'failed'
+        except Exception as e:
+            job['error'] = str(e)
+            log(f"✗ Error instalando {core_id}: {e}")
+            job['state'] = 'failed'
+        finally:
+            job['step'] = None
+            job['finished_at'] = time.time()
+            job['finished'].set()
+            _env_probe_wakeup.set()
+
+
+def _start_core_install(core_id, auto=False):
+    """
+    Lanza (o reutiliza) el job de instalación de core_id.
+    auto=True (prober): no reintenta si falló hace menos de CORE_INSTALL_RETRY_SEC; devuelve
+    ese job fallido, o None si no hay arduino-cli.
+    """
+    if not ARDUINO_CLI:
+        return None
+    now = time.time()
+    with _core_install_jobs_lock:
+        for job in reversed(_core_install_jobs.values()):
+            if job['core'] != core_id:
+                continue
+            if job['state'] in ('queued', 'running'):
+                return job
+            if auto and job['state'] == 'failed' and now - job['finished_at'] < CORE_INSTALL_RETRY_SEC:
+                return job
+            break
+        job = {
+            'id': str(uuid.uuid4())[:12],
+            'core': core_id,
+            'state': 'queued',
+            'step': None,
+            'auto': auto,
+            'created_at': now,
+            'started_at': None,
+            'finished_at': None,
+            'error': None,
+            'logs': deque(maxlen=200),
+            'finished': threading.Event(),
+        }
+        _core_install_jobs[job['id']] = job
+        while len(_core_install_jobs) > CORE_INSTALL_JOBS_KEEP:
+            oldest = next(iter(_core_install_jobs.values()))
+            if oldest['state'] in ('queued', 'running'):
+                break
+            _core_install_jobs.popitem(last=False)
+    print(f"[CORES] Job {job['id']}: instalar {core_id}")
+    threading.Thread(target=_run_core_install, args=(job,), daemon=True, name=f'core-install-{core_id}').start()
+    return job
+
+
+def _wait_core_install(job, timeout):
+    """
+    Espera a que termine un job de instalación. Si el hilo actual corre un job de
+    compilación/subida cancelado, deja de esperar (la instalación sigue). False si vence el timeout.
+    """
+    deadline = time.time() + timeout
+    cli_job = getattr(_cli_context, 'job', None)
+    while not job['finished'].wait(1.0):
+        if cli_job is not None and cli_job['cancel_requested']:
+            raise CompileCancelled()
+        if time.time() > deadline:
+            return False
+    return True
+
+
+# ============================================
+# PROBER DEL ENTORNO (snapshot para /health)
+# ============================================
+# /health se consulta cada pocos segundos con timeout corto: nunca debe ejecutar
+# arduino-cli. Un hilo mantiene el snapshot (versión CLI, cores, esptool) y /health
+# lo devuelve tal cual, con stale_since si el prober se atrasó.
+
+ENV_PROBE_INTERVAL_SEC = 30
+
+_env_snapshot = None
+_env_prober_thread = None
+_env_prober_lock = threading.Lock()
+_env_probe_wakeup = threading.Event()
+_agent_started_at = time.time()
+
+
+def _env_prober_loop():
+    global _env_snapshot
+    while True:
+        _env_probe_wakeup.clear()
+        t0 = time.time()
+        try:
+            snapshot = ensure_cores_installed()
+        except Exception as e:
+            print(f"[CORES] Error en prober: {e}")
+        else:
+            snapshot['probed_at'] = time.time()
+            snapshot['probe_ms'] = int((snapshot['probed_at'] - t0) * 1000)
+            _env_snapshot = snapshot
+        _env_probe_wakeup.wait(ENV_PROBE_INTERVAL_SEC)
+
+
+def _start_env_prober():
+    """Arranca el hilo del prober (idempotente)."""
+    global _env_prober_thread
+    with _env_prober_lock:
+        if _env_prober_thread is None or not _env_prober_thread.is_alive():
+            _env_prober_thread = threading.Thread(target=_env_prober_loop, daemon=True, name='env-prober')
+            _env_prober_thread.start()
+
+
+def get_cores_status():
+    """
+    Snapshot del entorno (no bloquea). stale_since: desde cuándo el snapshot debió
+    refrescarse y no lo hizo (None si está al día); antes del primer sondeo, el arranque.
+    """
+    _start_env_prober()
+    snapshot = _env_snapshot
+    now = time.time()
+    if snapshot is None:
+        return {
+            'arduino_cli_ok': bool(ARDUINO_CLI),
+            'arduino_cli_version': _cli_version_cache.get(ARDUINO_CLI),
+            'cores': {'avr_ok': False, 'esp32_ok': False},
+            'errors': [],
+            'probing': True,
+            'probed_at': None,
+            'stale_since': _agent_started_at,
+        }
+    status = dict(snapshot)
+    # Un sondeo puede tardar (core list); margen de un intervalo extra
+    due = snapshot['probed_at'] + ENV_PROBE_INTERVAL_SEC
+    status['stale_since'] = due if now > due + ENV_PROBE_INTERVAL_SEC else None
+    with _core_install_jobs_lock:
+        status['install_jobs'] = [
+            {'job_id': j['id'], 'core': j['core'], 'state': j['state'], 'step': j['step']}
+            for j in _core_install_jobs.values() if j['state'] in ('queued', 'running')
+        ]
+    return status
+
+
+# ============================================
+# FLASK APP
+# ============================================
+
+app = Flask(__name__)
+
+# Configurar CORS - Permitir todos los orígenes ya que el Agent solo es accesible localmente
+# Esto es necesario porque el frontend puede venir de HTTPS (Render) o HTTP (local)
+CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=False)
+
+# ============================================
+# MIDDLEWARE - Headers de seguridad y CORS
+# ============================================
+
+@app.after_request
+def add_security_headers(response):
+    """Añade headers de seguridad y CORS a todas las respuestas."""
+    response.headers['X-MAX-IDE-Agent'] = '1'
+    response.headers['X-Agent-Version'] = VERSION
+    # CORS headers explícitos para máxima compatibilidad
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-MAX-IDE-Client, X-Requested-With, Accept, Origin'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
+    response.headers['Access-Control-Max-Age'] = '86400'  # Cache preflight por 24h
+    return response
+
+@app.before_request
+def handle_preflight():
+    """Maneja todas las peticiones OPTIONS (preflight) de forma centralizada."""
+    if request.method == 'OPTIONS':
+        response = make_response()
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-MAX-IDE-Client, X-Requested-With, Accept, Origin'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
+        response.headers['Access-Control-Max-Age'] = '86400'
+        return response, 200
+
+# ============================================
+# ENDPOINT: GET /health
+# ============================================
+
+@app.route('/health', methods=['GET', 'OPTIONS'])
 def health():
     """
     Verifica el estado del Agent.
@@ -504,32 +1309,19 @@ def health():
             "ts": 1234567890,
             "platform": "Linux-6.x-x86_64",
             "arduino_cli": "/usr/bin/arduino-cli",
-            "arduino_cli_version": "0.35.0"
+            "arduino_cli_version": "0.35.0",
+            "cores": {"avr_ok": true, "esp32_ok": false},
+            "installing": [{"job_id", "core", "state", "step"}],
+            "probed_at": 1234567880.5,
+            "stale_since": null,
+            "compile_cache": {"entries", "bytes", "hits", "misses", "hit_rate", ...},
+            "upload_jobs": {"count", "bytes", "max_jobs", "max_bytes", "ttl_sec"},
+            "scheduler": {"capacity", "running", "waiting", "waiting_upload"}
         }
     """
     # OPTIONS se maneja en before_request
     
-    # Obtener versión de arduino-cli
-    cli_version = None
-    if ARDUINO_CLI:
-        try:
-            result = subprocess.run(
-                [ARDUINO_CLI, 'version'],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            if result.returncode == 0:
-                # Extraer versión del output
-                output = result.stdout.strip()
-                if 'Version:' in output:
-                    cli_version = output.split('Version:')[1].split()[0].strip()
-                elif output:
-                    cli_version = output.split()[0] if output else None
-        except Exception:
-            pass
-    
-    # Estado de cores (arduino:avr, esp32:esp32)
+    # Snapshot del prober (no ejecuta arduino-cli)
     cores_status = get_cores_status()
     return jsonify({
         'ok': True,
@@ -537,11 +1329,23 @@ def health():
         'ts': int(time.time()),
         'platform': platform.platform(),
         'arduino_cli': ARDUINO_CLI,
-        'arduino_cli_version': cli_version or cores_status.get('arduino_cli_version'),
+        'arduino_cli_version': cores_status.get('arduino_cli_version'),
         'python_version': platform.python_version(),
         'arduino_cli_ok': cores_status.get('arduino_cli_ok', False),
         'cores': cores_status.get('cores', {'avr_ok': False, 'esp32_ok': False}),
-        'errors': cores_status.get('errors', [])
+        'core_versions': cores_status.get('core_versions', {}),
+        'esptool': cores_status.get('esptool'),
+        'installing': cores_status.get('install_jobs', []),
+        'errors': cores_status.get('errors', []),
+        'probed_at': cores_status.get('probed_at'),
+        'stale_since': cores_status.get('stale_since'),
+        'compile_cache': get_compile_cache_status(),
+        'upload_jobs': get_upload_jobs_status(),
+        'scheduler': get_cli_scheduler_status(),
+        'libraries': get_library_index_status(),
+        'prewarm': get_prewarm_status(),
+        'cli_backend': get_cli_backend_status(),
+        'downloads': get_download_cache_status(),
     })
 
 # ============================================
@@ -638,108 +1442,396 @@ def _build_port_info(port, log_func):
     # suggested_family heurística
     sf = _get_suggested_family(vid, pid, manufacturer)
     port_info['suggested_family'] = sf
+    # Placas del registry que declaran este VID/PID
+    port_info['suggested_boards'] = [b['fqbn'] for b in _get_boards_by_usb(vid, pid)]
 
     return port_info
 
 
 # ============================================
-# ENDPOINT: GET /ports
+# WATCHER DE PUERTOS SERIALES
 # ============================================
+# Un hilo enumera los puertos cada PORTS_SCAN_INTERVAL_SEC y mantiene la tabla en memoria.
+# /ports la sirve con ETag (304 si no cambió) y /ports/changes hace long-poll hasta
+# que se conecta o desconecta una placa. _build_port_info solo corre para puertos nuevos.
+
+PORTS_SCAN_INTERVAL_SEC = 1.0
+PORTS_LONGPOLL_MAX_SEC = 60
+PORTS_CHANGES_KEEP = 100
+
+_ports_cond = threading.Condition()
+_ports_state = {
+    'ports': [],
+    'total_scanned': 0,
+    'all_devices': [],  # todos los dispositivos (incluye no USB), para _port_exists
+    'version': 0,
+    'etag': None,
+    'scanned_at': None,
+    'error': None,
+}
+_ports_changes = deque(maxlen=PORTS_CHANGES_KEEP)  # {'version', 'ts', 'added', 'removed'}
+_ports_info_cache = {}  # clave cruda del puerto -> port_info
+_ports_info_registry = None  # índice de placas con el que se construyó la caché
+_ports_scan_lock = threading.Lock()  # caché/registry: los reemplazan el watcher y _get_ports_snapshot
+_ports_watcher_thread = None
+_ports_watcher_lock = threading.Lock()
+
+
+def _is_usb_port(port, log):
+    """Filtra puertos USB reales (excluye ttyS* virtuales); en Windows todos cuentan."""
+    if platform.system() == 'Windows':
+        return True
+    try:
+        return (
+            getattr(port, 'vid', None) is not None or
+            'USB' in (getattr(port, 'hwid', None) or '') or
+            'usb' in (getattr(port, 'device', '') or '').lower() or
+            'ACM' in (getattr(port, 'device', '') or '')
+        )
+    except Exception as e:
+        log(f"No se pudo evaluar si es USB para {getattr(port, 'device', '?')}: {e}")
+        return True
 
-@app.route('/ports', methods=['GET', 'OPTIONS'])
-def list_ports():
-    """
-    Lista los puertos seriales disponibles.
-    Filtra solo puertos USB reales (excluir ttyS* virtuales).
 
-    Campos por puerto (cuando se puedan leer):
-    - path, label, vid, pid, manufacturer, serialNumber
-    - suggested_family: { avr_candidate, esp32_candidate } o null
-    - Contrato IDE: device, name, description, type, friendly_name, etc.
+def _scan_ports():
     """
+    Enumera los puertos. Returns (ports USB, todos los devices). Lanza si comports() falla.
+    Reutiliza el port_info de puertos ya vistos (misma clave device/vid/pid/serie/hwid).
+    """
+    global _ports_info_cache, _ports_info_registry
+
     def log(msg):
         print(f"[PORTS] {msg}")
 
-    ports = []
-    all_ports = []
-
-    try:
-        for port in serial.tools.list_ports.comports():
-            try:
-                is_usb_port = (
-                    getattr(port, 'vid', None) is not None or
-                    'USB' in (getattr(port, 'hwid', None) or '') or
-                    'usb' in (getattr(port, 'device', '') or '').lower() or
-                    'ACM' in (getattr(port, 'device', '') or '')
-                )
-            except Exception as e:
-                log(f"No se pudo evaluar si es USB para {getattr(port, 'device', '?')}: {e}")
-                is_usb_port = True
-
-            if platform.system() == 'Windows':
-                is_usb_port = True
+    # Sin el lock durante comports(): si se cuelga, /ports puede escanear desde otro hilo.
+    # Los dicts publicados no se modifican, solo se reemplazan (bajo el lock).
+    registry = _get_boards_index()
+    with _ports_scan_lock:
+        if registry is not _ports_info_registry:
+            _ports_info_cache = {}
+            _ports_info_registry = registry
+        previous = _ports_info_cache
 
+    ports = []
+    devices = []
+    cache = {}
+    for port in serial.tools.list_ports.comports():
+        devices.append(getattr(port, 'device', None) or '')
+        if not _is_usb_port(port, log):
+            continue
+        try:
+            key = tuple(getattr(port, a, None) for a in
+                        ('device', 'vid', 'pid', 'serial_number', 'description', 'hwid'))
+        except Exception:
+            key = None
+        info = previous.get(key) if key is not None else None
+        if info is None:
             try:
-                all_ports.append({
-                    'device': getattr(port, 'device', None),
-                    'vid': getattr(port, 'vid', None),
-                    'is_usb': is_usb_port
-                })
+                info = _build_port_info(port, log)
             except Exception as e:
-                log(f"No se pudieron leer metadatos básicos: {e}")
-
-            if not is_usb_port:
+                log(f"No se pudo construir info para puerto {getattr(port, 'device', '?')}: {e}")
                 continue
+        if key is not None:
+            cache[key] = info
+        ports.append(info)
+    with _ports_scan_lock:
+        if _ports_info_registry is registry:  # si cambió el registry, la caché nueva no sirve
+            _ports_info_cache = cache
+    return ports, devices
 
-            try:
-                port_info = _build_port_info(port, log)
-                ports.append(port_info)
-            except Exception as e:
-                log(f"No se pudo construir info para puerto {getattr(port, 'device', '?')}: {e}")
 
+def _refresh_ports():
+    """Escanea y, si la tabla cambió, incrementa la versión y despierta a los long-polls."""
+    try:
+        ports, devices = _scan_ports()
+        error = None
     except Exception as e:
-        log(f"Error listando puertos: {e}")
+        ports, devices, error = None, [], str(e)
+
+    with _ports_cond:
+        _ports_state['scanned_at'] = time.time()
+        if error is not None:
+            if _ports_state['error'] != error:
+                print(f"[PORTS] Error listando puertos: {error}")
+            _ports_state['error'] = error
+            return
+        _ports_state['error'] = None
+        _ports_state['total_scanned'] = len(devices)
+        _ports_state['all_devices'] = devices
+        old = {p['device']: p for p in _ports_state['ports']}
+        new = {p['device']: p for p in ports}
+        if _ports_state['etag'] is not None and old == new:
+            return
+        added = [d for d in new if d not in old]
+        removed = [d for d in old if d not in new]
+        _ports_state['ports'] = ports
+        _ports_state['version'] += 1
+        digest = hashlib.sha1(json.dumps(ports, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        _ports_state['etag'] = f'ports-{digest[:16]}'
+        if added or removed or _ports_state['version'] > 1:
+            _ports_changes.append({
+                'version': _ports_state['version'], 'ts': _ports_state['scanned_at'],
+                'added': added, 'removed': removed,
+            })
+            if added or removed:
+                print(f"[PORTS] Conectados: {added or '-'} | Desconectados: {removed or '-'}")
+        _ports_cond.notify_all()
+    if removed:
+        _flash_ledger_forget_ports(removed)
+
+
+def _ports_watcher_loop():
+    while True:
+        _refresh_ports()
+        time.sleep(PORTS_SCAN_INTERVAL_SEC)
+
+
+def _start_ports_watcher():
+    """Arranca el hilo del watcher (idempotente)."""
+    global _ports_watcher_thread
+    with _ports_watcher_lock:
+        if _ports_watcher_thread is None or not _ports_watcher_thread.is_alive():
+            _ports_watcher_thread = threading.Thread(target=_ports_watcher_loop, daemon=True, name='ports-watcher')
+            _ports_watcher_thread.start()
+
+
+def _get_ports_snapshot():
+    """
+    Tabla actual de puertos (copia de _ports_state). Escanea en el hilo actual si aún no
+    hay escaneo o si el watcher se atrasó (p.ej. comports() colgado en otro hilo).
+    """
+    _start_ports_watcher()
+    scanned_at = _ports_state['scanned_at']
+    if scanned_at is None or time.time() - scanned_at > 5 * PORTS_SCAN_INTERVAL_SEC:
+        _refresh_ports()
+    with _ports_cond:
+        return dict(_ports_state)
+
+
+def _ports_response(snapshot):
+    if snapshot['error'] is not None and snapshot['etag'] is None:
         return jsonify({
             'ok': False,
-            'error': f'Error listando puertos: {str(e)}',
+            'error': f"Error listando puertos: {snapshot['error']}",
             'ports': [],
             'os_name': platform.system(),
             'os_version': platform.release()
         }), 500
-
-    return jsonify({
+    resp = jsonify({
         'ok': True,
-        'ports': ports,
-        'count': len(ports),
-        'total_scanned': len(all_ports),
+        'ports': snapshot['ports'],
+        'count': len(snapshot['ports']),
+        'total_scanned': snapshot['total_scanned'],
+        'version': snapshot['version'],
         'os_name': platform.system(),
         'os_version': platform.release()
     })
+    resp.set_etag(snapshot['etag'])
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+# ============================================
+# ENDPOINT: GET /ports
+# ============================================
+
+@app.route('/ports', methods=['GET', 'OPTIONS'])
+def list_ports():
+    """
+    Lista los puertos seriales disponibles (tabla en memoria del watcher).
+    Filtra solo puertos USB reales (excluir ttyS* virtuales).
+    Devuelve ETag; con If-None-Match igual responde 304 sin cuerpo.
+
+    Campos por puerto (cuando se puedan leer):
+    - path, label, vid, pid, manufacturer, serialNumber
+    - suggested_family: { avr_candidate, esp32_candidate } o null
+    - Contrato IDE: device, name, description, type, friendly_name, etc.
+    """
+    snapshot = _get_ports_snapshot()
+    if snapshot['etag'] and request.if_none_match.contains(snapshot['etag']):
+        resp = make_response('', 304)
+        resp.set_etag(snapshot['etag'])
+        return resp
+    return _ports_response(snapshot)
+
+
+@app.route('/ports/changes', methods=['GET', 'OPTIONS'])
+def ports_changes():
+    """
+    Long-poll: responde cuando la versión de la tabla de puertos difiere de `since`
+    o al vencer `timeout` (segundos, máx. PORTS_LONGPOLL_MAX_SEC).
+
+    Query: ?since=<version>&timeout=30
+    Response: { ok, changed, version, ports, count, added, removed }
+    """
+    since = request.args.get('since', type=int)
+    timeout = min(max(request.args.get('timeout', default=30, type=float), 0), PORTS_LONGPOLL_MAX_SEC)
+    snapshot = _get_ports_snapshot()
+    if since is not None and since == snapshot['version']:
+        with _ports_cond:
+            _ports_cond.wait_for(lambda: _ports_state['version'] != since, timeout=timeout)
+            snapshot = dict(_ports_state)
+    changed = since is None or snapshot['version'] != since
+    added, removed = [], []
+    if since is not None and changed:
+        with _ports_cond:
+            events = [c for c in _ports_changes if c['version'] > since]
+        for c in events:
+            added += [d for d in c['added'] if d not in added]
+            removed += [d for d in c['removed'] if d not in removed]
+        current = {p['device'] for p in snapshot['ports']}
+        added = [d for d in added if d in current]
+        removed = [d for d in removed if d not in current]
+    return jsonify({
+        'ok': True,
+        'changed': changed,
+        'version': snapshot['version'],
+        'ports': snapshot['ports'],
+        'count': len(snapshot['ports']),
+        'added': added,
+        'removed': removed,
+    })
 
 # ============================================
 # ENDPOINT: GET /boards
 # ============================================
 
+# Registry base + archivos extra (--boards-registry / MAXIDE_BOARDS_REGISTRY, separados por os.pathsep).
+# Las entradas de archivos extra reemplazan a las del base con el mismo FQBN.
+BOARDS_REGISTRY_PATH = str(Path(__file__).resolve().parent / 'boards_registry.json')
+BOARDS_REGISTRY_EXTRA = [p for p in os.environ.get('MAXIDE_BOARDS_REGISTRY', '').split(os.pathsep) if p]
+# Cada cuánto revisar el mtime de los archivos del registry (segundos)
+BOARDS_REGISTRY_CHECK_SEC = 1.0
+
+# Índice inmutable; una recarga construye uno nuevo y reemplaza la referencia
+_boards_index = None
+_boards_index_lock = threading.Lock()
+_boards_index_checked_at = 0.0
+
+
+def _boards_registry_paths():
+    return [BOARDS_REGISTRY_PATH] + list(BOARDS_REGISTRY_EXTRA)
+
+
+def _boards_registry_signature(paths):
+    """(ruta, mtime, tamaño) de cada archivo del registry; None en mtime si no existe."""
+    sig = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            sig.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append((path, None, None))
+    return tuple(sig)
+
+
+def _parse_usb_id(value):
+    """VID/PID desde int, '0x2341' o '2341' (hex). None si no es válido."""
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip():
+        try:
+            return int(value.strip(), 16)
+        except ValueError:
+            return None
+    return None
+
+
+def _build_boards_index(paths, signature):
+    """Parsea los archivos del registry y arma las tablas por FQBN, familia y VID/PID."""
+    boards = []
+    by_fqbn = {}
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            if path != BOARDS_REGISTRY_PATH:
+                print(f"[BOARDS] Registry extra no encontrado: {path}")
+            continue
+        except Exception as e:
+            print(f"[BOARDS] Error cargando registry {path}: {e}")
+            continue
+        if not isinstance(entries, list):
+            print(f"[BOARDS] {path}: se esperaba una lista de placas")
+            continue
+        for b in entries:
+            if not isinstance(b, dict) or not isinstance(b.get('fqbn'), str) or not isinstance(b.get('family'), str):
+                print(f"[BOARDS] {path}: entrada ignorada (falta fqbn/family): {b!r}")
+                continue
+            if b['fqbn'] in by_fqbn:
+                boards[boards.index(by_fqbn[b['fqbn']])] = b
+            else:
+                boards.append(b)
+            by_fqbn[b['fqbn']] = b
+
+    by_family = {}
+    by_usb = {}
+    for b in boards:
+        by_family.setdefault(b['family'], []).append(b)
+        for usb in b.get('usb') or []:
+            if not isinstance(usb, dict):
+                continue
+            vid, pid = _parse_usb_id(usb.get('vid')), _parse_usb_id(usb.get('pid'))
+            if vid is not None:
+                by_usb.setdefault((vid, pid), []).append(b)
+    return {
+        'paths': list(paths),
+        'signature': signature,
+        'boards': boards,
+        'by_fqbn': by_fqbn,
+        'by_family': by_family,
+        'by_usb': by_usb,
+    }
+
+
+def _get_boards_index():
+    """
+    Índice del registry. Se parsea una vez; se recarga cuando cambia el mtime de algún archivo
+    (revisado como mucho cada BOARDS_REGISTRY_CHECK_SEC).
+    """
+    global _boards_index, _boards_index_checked_at
+    index = _boards_index
+    now = time.time()
+    paths = _boards_registry_paths()
+    if index is not None and index['paths'] == paths \
+            and now - _boards_index_checked_at < BOARDS_REGISTRY_CHECK_SEC:
+        return index
+    signature = _boards_registry_signature(paths)
+    _boards_index_checked_at = now
+    if index is not None and index['signature'] == signature:
+        return index
+    with _boards_index_lock:
+        if _boards_index is None or _boards_index['signature'] != signature:
+            if _boards_index is not None:
+                print("[BOARDS] Registry modificado, recargando")
+            _boards_index = _build_boards_index(paths, signature)
+        return _boards_index
+
+
 def _load_boards_registry():
-    """Carga el registry de placas desde JSON. Fuente única: agent/boards_registry.json"""
-    registry_path = Path(__file__).resolve().parent / 'boards_registry.json'
-    try:
-        with open(registry_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"[BOARDS] Error cargando registry: {e}")
-        return []
+    """Lista de placas del registry (agent/boards_registry.json + registries extra)."""
+    return _get_boards_index()['boards']
 
 
 def _get_board_by_fqbn(fqbn):
     """Busca un board en el registry por FQBN. Retorna dict con family, label o None si no existe."""
     if not fqbn or not isinstance(fqbn, str):
         return None
-    boards = _load_boards_registry()
-    for b in boards:
-        if b.get('fqbn') == fqbn:
-            return b
-    return None
+    return _get_boards_index()['by_fqbn'].get(fqbn)
+
+
+def _get_boards_by_family(family):
+    """Placas del registry de una familia ('avr', 'esp32', ...)."""
+    return list(_get_boards_index()['by_family'].get(family, []))
+
+
+def _get_boards_by_usb(vid, pid):
+    """Placas cuyo VID/PID declarado en el registry coincide (las entradas sin pid valen para todo el VID)."""
+    if vid is None:
+        return []
+    by_usb = _get_boards_index()['by_usb']
+    return by_usb.get((vid, pid), []) + by_usb.get((vid, None), [])
 
 
 def _compute_sha256(filepath):
@@ -815,189 +1907,1500 @@ def _collect_artifacts(build_dir, family, include_base64=False, max_base64_bytes
     return artifacts
 
 
-def _port_exists(port):
-    """Verifica si el puerto existe en la lista de puertos disponibles."""
-    if not port:
-        return False
+# ============================================
+# EJECUCIÓN DE arduino-cli (procesos cancelables)
+# ============================================
+
+class CompileCancelled(Exception):
+    """La compilación fue cancelada (DELETE /compile/jobs/<id>)."""
+
+
+# Contexto por hilo: job asíncrono en curso (None en peticiones síncronas) y, tras
+# _cli_slot, el instante en que el scheduler dio turno (slot_acquired_at)
+_cli_context = threading.local()
+
+
+def _kill_process_tree(proc):
+    """Termina un proceso y todos sus hijos (gcc, ld, ...)."""
+    if proc.poll() is not None:
+        return
+    if proc.pid is None:  # en proceso: llamada al daemon (_DaemonCall) o esptool (_EsptoolSession)
+        proc.kill()
+        return
     try:
-        port_str = str(port)
-        for p in serial.tools.list_ports.comports():
-            dev = getattr(p, 'device', None) or ''
-            if dev == port_str:
-                return True
-            if platform.system() == 'Windows' and dev.lower() == port_str.lower():
-                return True
-        return False
+        if platform.system() == 'Windows':
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(proc.pid)], capture_output=True, timeout=10)
+        else:
+            # start_new_session=True → el grupo de procesos tiene id == pid
+            os.killpg(proc.pid, signal.SIGKILL)
     except Exception:
-        return False
+        try:
+            proc.kill()
+        except Exception:
+            pass
 
 
-def _resolve_hex_for_upload(data, temp_dir, log_func):
+def _stream_emit(event, data):
+    """Publica un evento en el stream SSE del hilo actual (no-op si no hay stream)."""
+    job = getattr(_cli_context, 'job', None)
+    if job is not None and job.get('sink'):
+        job['sink'](event, data)
+
+
+def _set_phase(phase):
     """
-    Resuelve el archivo HEX para upload desde: artifact(s), hex_url, o code.
-    Returns: (hex_file_path, error_msg) - error_msg es None si ok.
+    Marca la fase actual (preparing, compiling, uploading, ...) del job o stream
+    del hilo. Es también el punto donde se detecta una cancelación pendiente.
     """
-    def log(msg):
-        log_func(msg)
+    job = getattr(_cli_context, 'job', None)
+    if job is None:
+        return
+    if job['cancel_requested']:
+        raise CompileCancelled()
+    job['phase'] = phase
+    _stream_emit('phase', {'phase': phase, 'ts': time.time()})
+
+
+def _new_cli_job(sink=None):
+    """Estado mínimo de ejecución (proceso actual, cancelación, progreso) para _cli_context.job."""
+    return {
+        'proc': None,
+        'cancel_requested': False,
+        'phase': None,
+        'output_lines': 0,
+        'last_line': None,
+        'sink': sink,
+        'low_priority': False,
+    }
 
-    # 1) artifact(s) - preferencia
-    artifacts = data.get('artifact') or data.get('artifacts')
-    if artifacts is not None:
-        if not isinstance(artifacts, list):
-            artifacts = [artifacts]
-        for art in artifacts:
-            if not isinstance(art, dict):
-                continue
-            # content_base64
-            if art.get('content_base64'):
-                try:
-                    raw = base64.b64decode(art['content_base64'])
-                    hex_path = os.path.join(temp_dir, art.get('name', 'firmware.hex'))
-                    with open(hex_path, 'wb') as f:
-                        f.write(raw)
-                    if len(raw) > 0:
-                        log(f"HEX desde artifact (base64): {len(raw)} bytes")
-                        return (hex_path, None)
-                except Exception as e:
-                    log(f"Error decodificando artifact base64: {e}")
-                    continue
-            # path (local)
-            if art.get('path') and os.path.isfile(art['path']):
-                p = art['path']
-                if p.lower().endswith('.hex'):
-                    log(f"HEX desde artifact path: {p}")
-                    return (p, None)
-            # url
-            if art.get('url'):
-                try:
-                    r = requests.get(art['url'], timeout=30, stream=True)
-                    r.raise_for_status()
-                    hex_path = os.path.join(temp_dir, art.get('name', 'firmware.hex'))
-                    with open(hex_path, 'wb') as f:
-                        for chunk in r.iter_content(8192):
-                            if chunk:
-                                f.write(chunk)
-                    if os.path.getsize(hex_path) > 0:
-                        log(f"HEX descargado desde artifact URL: {os.path.getsize(hex_path)} bytes")
-                        return (hex_path, None)
-                except Exception as e:
-                    log(f"Error descargando artifact URL: {e}")
-                    continue
 
-    # 2) hex_url (retrocompat)
-    hex_url = data.get('hex_url')
-    if hex_url:
+CLI_OUTPUT_MAX_LINES = 2000  # líneas retenidas por stream (stdout/stderr); el resto solo se emite
+
+
+# ============================================
+# MÉTRICAS (GET /metrics, formato texto de Prometheus)
+# ============================================
+# Contadores e histogramas en memoria: en el camino caliente solo se toma un lock y se
+# suma a un dict. Lo costoso (tamaño de tmp, caché, scheduler) se calcula al scrapear.
+
+METRICS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+METRICS_TMP_CHECK_SEC = 60  # cada cuánto se recalcula el tamaño de los directorios temporales
+
+_metrics_lock = threading.Lock()
+_metrics_counters = {}    # (name, labels) -> valor
+_metrics_histograms = {}  # (name, labels) -> [cuenta por bucket..., +Inf, suma]
+_metrics_tmp_bytes = {'checked_at': 0.0, 'dirs': {}}
+
+_METRICS_HELP = {
+    'maxide_compile_duration_seconds': 'Duración de /compile por familia, fqbn y resultado',
+    'maxide_compile_total': 'Compilaciones atendidas',
+    'maxide_upload_duration_seconds': 'Duración del upload por familia, estrategia y resultado',
+    'maxide_upload_retries_total': 'Reintentos de upload AVR (puerto ocupado/timeout)',
+    'maxide_upload_skipped_total': 'Uploads omitidos porque la placa ya tenía el firmware',
+    'maxide_compile_deduplicated_total': 'Compilaciones idénticas concurrentes servidas por otra en curso',
+    'maxide_esptool_attempt_seconds': 'Intentos de esptool write-flash por modo de reset',
+    'maxide_artifact_downloads_total': 'Artefactos por URL servidos desde la caché o descargados',
+    'maxide_errors_total': 'Errores por operación y error_code',
+    'maxide_cli_queue_wait_seconds': 'Espera de compilaciones en el scheduler por prioridad',
+}
+
+
+def _metric_labels(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _metric_inc(name, labels=None, value=1):
+    key = (name, _metric_labels(labels))
+    with _metrics_lock:
+        _metrics_counters[key] = _metrics_counters.get(key, 0) + value
+
+
+def _metric_observe(name, value, labels=None):
+    key = (name, _metric_labels(labels))
+    with _metrics_lock:
+        hist = _metrics_histograms.get(key)
+        if hist is None:
+            hist = _metrics_histograms[key] = [0] * (len(METRICS_BUCKETS) + 2)
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                hist[i] += 1
+                break
+        else:
+            hist[len(METRICS_BUCKETS)] += 1
+        hist[-1] += value
+
+
+def _metric_fqbn_label(fqbn):
+    """fqbn como etiqueta solo si está en el registry (acota la cardinalidad)."""
+    return fqbn if fqbn and _get_board_by_fqbn(fqbn) else 'other'
+
+
+def _with_request_metrics(op):
+    """
+    Decorador para _compile_request/_upload_request: registra duración (compile) y
+    error_code de la respuesta. Los tiempos de upload se miden en _do_upload_*.
+    """
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(data, logs, *args, **kwargs):
+            t0 = time.time()
+            payload, status = fn(data, logs, *args, **kwargs)
+            if not isinstance(payload, dict):
+                return payload, status
+            result = 'ok' if payload.get('ok') else 'error'
+            if op == 'compile':
+                labels = {'family': payload.get('family') or 'unknown',
+                          'fqbn': _metric_fqbn_label(payload.get('fqbn') or (data or {}).get('fqbn')),
+                          'cached': 'true' if payload.get('cached') else 'false', 'result': result}
+                _metric_observe('maxide_compile_duration_seconds', time.time() - t0, labels)
+                _metric_inc('maxide_compile_total', labels)
+            elif payload.get('skipped'):
+                _metric_inc('maxide_upload_skipped_total', {'family': payload.get('family') or 'unknown'})
+            if not payload.get('ok'):
+                _metric_inc('maxide_errors_total', {'op': op, 'code': payload.get('error_code') or 'UNKNOWN'})
+            return payload, status
+        return inner
+    return wrap
+
+
+def _with_upload_metrics(family):
+    """Decorador para _do_upload_avr/_do_upload_esp32: duración por estrategia y error_code."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            t0 = time.time()
+            result = fn(*args, **kwargs)
+            if family == 'esp32':
+                ok, strategy, err_code = result[0], result[1] or 'none', result[2]
+            else:
+                ok, strategy, err_code = result[0], 'arduino-cli', result[1]
+            _metric_observe('maxide_upload_duration_seconds', time.time() - t0,
+                            {'family': family, 'strategy': strategy, 'result': 'ok' if ok else 'error'})
+            if not ok:
+                _metric_inc('maxide_errors_total', {'op': f'upload_{family}', 'code': err_code or 'UPLOAD_FAIL'})
+            return result
+        return inner
+    return wrap
+
+
+# ============================================
+# SCHEDULER DE arduino-cli (compilaciones acotadas, upload primero)
+# ============================================
+# Flask corre con threaded=True: sin límite, una ráfaga de "Verificar" lanza N gcc en
+# paralelo en un PC de 4 núcleos y todo se arrastra, incluido el upload que espera el
+# estudiante. Cada _run_cli pasa por aquí: las compilaciones ocupan un slot (cupo según
+# núcleos y RAM libre) y esperan en una cola con prioridad; el resto de comandos
+# (upload, esptool, core list, ...) son livianos y entran sin esperar.
+# Prioridad: 'upload' (compilar para subir: /upload, return_job_id, for_upload) antes
+# que 'verify'. Las respuestas incluyen queue: {priority, wait_sec, queue_depth}.
+
+CLI_SLOTS = 0                    # 0 = automático (--cli-slots)
+CLI_RAM_PER_COMPILE_MB = 400     # RAM libre que se reserva por compilación
+CLI_CAPACITY_CHECK_SEC = 2.0
+CLI_PRIORITIES = {'upload': 0, 'verify': 1, 'prewarm': 2}
+CLI_LOW_PRIORITY_NICE = 10       # nice de los procesos de jobs en segundo plano (pre-calentamiento)
+
+_cli_sched_cond = threading.Condition()
+_cli_sched = {'running': 0, 'waiting': [], 'seq': 0, 'capacity': None, 'checked_at': 0.0}
+
+
+def _available_ram_mb():
+    """RAM disponible en MB (Linux/Windows). None si no se puede saber."""
+    try:
+        if platform.system() == 'Windows':
+            import ctypes
+
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                            ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                            ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                            ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                            ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+            stat = MEMORYSTATUSEX()
+            stat.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(stat)):
+                return stat.ullAvailPhys // (1024 * 1024)
+            return None
+        with open('/proc/meminfo', 'r', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except Exception:
+        pass
+    return None
+
+
+def _cli_capacity():
+    """
+    Compilaciones simultáneas permitidas. Llamar con _cli_sched_cond tomado.
+    Automático: la mitad de los núcleos (gcc ya paraleliza cada compilación), limitado
+    por la RAM libre (las compilaciones en curso ya consumen la suya).
+    """
+    if CLI_SLOTS > 0:
+        return CLI_SLOTS
+    now = time.time()
+    if _cli_sched['capacity'] is None or now - _cli_sched['checked_at'] > CLI_CAPACITY_CHECK_SEC:
+        capacity = max(1, (os.cpu_count() or 2) // 2)
+        ram = _available_ram_mb()
+        if ram is not None:
+            capacity = min(capacity, _cli_sched['running'] + ram // CLI_RAM_PER_COMPILE_MB)
+        _cli_sched['capacity'] = max(1, capacity)
+        _cli_sched['checked_at'] = now
+    return _cli_sched['capacity']
+
+
+def _cli_is_heavy(cmd):
+    return len(cmd) > 1 and cmd[1] == 'compile'
+
+
+@contextmanager
+def _cli_priority(priority):
+    """Fija la prioridad de los arduino-cli de este hilo y acumula su espera en cola."""
+    prev = (getattr(_cli_context, 'priority', None), getattr(_cli_context, 'queue_stats', None))
+    stats = {'priority': priority, 'wait_sec': 0.0, 'queue_depth': 0}
+    _cli_context.priority, _cli_context.queue_stats = priority, stats
+    try:
+        yield stats
+    finally:
+        _cli_context.priority, _cli_context.queue_stats = prev
+
+
+def _with_cli_priority(priority_of):
+    """
+    Decorador para *_request(data, logs, ...) -> (payload, status): fija la prioridad
+    (priority_of(data)) y añade 'queue' a la respuesta.
+    """
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(data, logs, *args, **kwargs):
+            with _cli_priority(priority_of(data or {})) as stats:
+                payload, status = fn(data, logs, *args, **kwargs)
+            if isinstance(payload, dict):
+                payload['queue'] = dict(stats, wait_sec=round(stats['wait_sec'], 2))
+            return payload, status
+        return inner
+    return wrap
+
+
+@contextmanager
+def _cli_slot(cmd):
+    """Espera turno para un comando pesado (compile) según prioridad y orden de llegada."""
+    if not _cli_is_heavy(cmd):
+        yield
+        return
+    job = getattr(_cli_context, 'job', None)
+    stats = getattr(_cli_context, 'queue_stats', None)
+    priority = CLI_PRIORITIES.get(getattr(_cli_context, 'priority', None), CLI_PRIORITIES['verify'])
+    if priority < CLI_PRIORITIES['prewarm']:
+        _prewarm_yield()
+    t0 = time.time()
+    with _cli_sched_cond:
+        _cli_sched['seq'] += 1
+        ticket = (priority, _cli_sched['seq'])
+        heapq.heappush(_cli_sched['waiting'], ticket)
+        ahead = sum(1 for t in _cli_sched['waiting'] if t < ticket)
         try:
-            r = requests.get(hex_url, timeout=30, stream=True)
-            r.raise_for_status()
-            hex_path = os.path.join(temp_dir, 'firmware.hex')
-            total = 0
-            with open(hex_path, 'wb') as f:
-                for chunk in r.iter_content(8192):
-                    if chunk:
-                        f.write(chunk)
-                        total += len(chunk)
-            if total == 0:
-                return (None, 'Archivo HEX vacío')
-            log(f"HEX descargado desde hex_url: {total} bytes")
-            return (hex_path, None)
-        except requests.RequestException as e:
-            return (None, f'Error descargando HEX: {str(e)}')
-
-    # 3) code - compilar localmente (retrocompat)
-    code = data.get('code', '')
-    if code and code.strip():
-        fqbn = data.get('fqbn', 'arduino:avr:uno')
-        board = _get_board_by_fqbn(fqbn)
-        if not board:
-            return (None, f'FQBN "{fqbn}" no está en el registry')
-        sketch_dir = os.path.join(temp_dir, 'sketch_upload')
-        os.makedirs(sketch_dir)
-        with open(os.path.join(sketch_dir, 'sketch_upload.ino'), 'w', encoding='utf-8') as f:
-            f.write(code)
-        build_dir = os.path.join(temp_dir, 'build')
-        os.makedirs(build_dir)
+            while _cli_sched['waiting'][0] != ticket or _cli_sched['running'] >= _cli_capacity():
+                if job is not None and job['cancel_requested']:
+                    raise CompileCancelled()
+                _cli_sched_cond.wait(0.5)
+        except BaseException:
+            _cli_sched['waiting'].remove(ticket)
+            heapq.heapify(_cli_sched['waiting'])
+            _cli_sched_cond.notify_all()
+            raise
+        heapq.heappop(_cli_sched['waiting'])
+        _cli_sched['running'] += 1
+    _cli_context.slot_acquired_at = time.time()
+    waited = _cli_context.slot_acquired_at - t0
+    _metric_observe('maxide_cli_queue_wait_seconds', waited, {'priority': getattr(_cli_context, 'priority', None) or 'verify'})
+    if stats is not None:
+        stats['wait_sec'] += waited
+        stats['queue_depth'] = max(stats['queue_depth'], ahead)
+    if waited >= 1.0:
+        print(f"[SCHED] compile esperó {waited:.1f}s en cola ({ahead} adelante)")
+    try:
+        yield
+    finally:
+        with _cli_sched_cond:
+            _cli_sched['running'] -= 1
+            _cli_sched_cond.notify_all()
+
+
+def get_cli_scheduler_status():
+    """Resumen para /health."""
+    with _cli_sched_cond:
+        return {
+            'capacity': _cli_capacity(),
+            'running': _cli_sched['running'],
+            'waiting': len(_cli_sched['waiting']),
+            'waiting_upload': sum(1 for p, _seq in _cli_sched['waiting'] if p == CLI_PRIORITIES['upload']),
+        }
+
+
+def _run_cli(cmd, timeout):
+    """
+    Ejecuta arduino-cli (o esptool) y devuelve un CompletedProcess (stdout/stderr como texto).
+    Las compilaciones esperan antes su turno en el scheduler (la espera no cuenta en timeout).
+    """
+    with _cli_slot(cmd):
+        return _exec_cli(cmd, timeout)
+
+
+def _exec_cli(cmd, timeout):
+    """
+    Fuera de un job/stream equivale a subprocess.run(capture_output=True). Dentro de uno
+    lanza el proceso en su propio grupo, lo registra para poder cancelarlo, publica cada
+    línea en el stream y retiene como máximo CLI_OUTPUT_MAX_LINES por salida.
+    """
+    if CLI_BACKEND == 'daemon':
+        r = _cli_daemon_exec(cmd, timeout)
+        if r is not None:
+            return r
+    job = getattr(_cli_context, 'job', None)
+    if job is None:
+        return subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+
+    popen_kwargs = {}
+    if platform.system() == 'Windows':
+        popen_kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        if job.get('low_priority'):
+            popen_kwargs['creationflags'] |= subprocess.BELOW_NORMAL_PRIORITY_CLASS
+    else:
+        popen_kwargs['start_new_session'] = True
+        if job.get('low_priority'):
+            popen_kwargs['preexec_fn'] = functools.partial(os.nice, CLI_LOW_PRIORITY_NICE)
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        text=True, encoding='utf-8', errors='replace', bufsize=1, **popen_kwargs
+    )
+    job['proc'] = proc
+    if job['cancel_requested']:
+        _kill_process_tree(proc)
+
+    captured = {'stdout': deque(maxlen=CLI_OUTPUT_MAX_LINES), 'stderr': deque(maxlen=CLI_OUTPUT_MAX_LINES)}
+    totals = {'stdout': 0, 'stderr': 0}
+
+    def _reader(stream, name):
+        for line in stream:
+            captured[name].append(line)
+            totals[name] += 1
+            text = line.rstrip()
+            if text:
+                job['output_lines'] += 1
+                job['last_line'] = text[:300]
+                if job.get('sink'):  # hilo lector: sin _cli_context propio
+                    job['sink']('log', {'line': text, 'stream': name})
+        stream.close()
+
+    readers = [
+        threading.Thread(target=_reader, args=(proc.stdout, 'stdout'), daemon=True),
+        threading.Thread(target=_reader, args=(proc.stderr, 'stderr'), daemon=True),
+    ]
+    for t in readers:
+        t.start()
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_process_tree(proc)
+        proc.wait()
+        raise
+    finally:
+        for t in readers:
+            t.join(timeout=5)
+        job['proc'] = None
+    if job['cancel_requested']:
+        raise CompileCancelled()
+
+    def _text(name):
+        omitted = totals[name] - len(captured[name])
+        prefix = f'[... {omitted} líneas omitidas ...]\n' if omitted > 0 else ''
+        return prefix + ''.join(captured[name])
+
+    return subprocess.CompletedProcess(cmd, proc.returncode, _text('stdout'), _text('stderr'))
+
+
+# ============================================
+# BACKEND DAEMON DE arduino-cli (gRPC, opcional: --cli-backend daemon)
+# ============================================
+# Cada `arduino-cli` lanzado vuelve a leer configuración, índices y plataformas. Con
+# --cli-backend daemon se arranca una vez `arduino-cli daemon`, se inicializa una
+# instancia y version, core list, compile y upload van por su interfaz gRPC local.
+# Requiere grpcio y los stubs generados de arduino-cli (paquete cc.arduino.cli.commands.v1,
+# ver requirements.txt). Cualquier comando no cubierto, o un daemon caído, sigue por
+# subprocess como siempre. --benchmark-backends N compara latencias de ambos caminos.
+
+CLI_BACKEND = 'subprocess'       # 'subprocess' | 'daemon'
+CLI_DAEMON_START_TIMEOUT_SEC = 20
+CLI_DAEMON_RETRY_SEC = 60        # tras un fallo, cuánto esperar antes de reintentar arrancarlo
+
+# Flags con valor de compile/upload que el daemon entiende (flag -> campo del request)
+_CLI_DAEMON_FLAGS = {
+    '--fqbn': 'fqbn', '-b': 'fqbn',
+    '--build-path': 'build_path',
+    '--build-cache-path': 'build_cache_path',
+    '--output-dir': 'export_dir',
+    '--library': 'library',
+    '--warnings': 'warnings',
+    '-p': 'port', '--port': 'port',
+    '--input-file': 'import_file',
+    '--input-dir': 'import_dir',
+}
+
+_cli_daemon_lock = threading.Lock()
+_cli_daemon = {
+    'api': None, 'proc': None, 'address': None, 'stub': None, 'instance': None,
+    'needs_init': True, 'error': None, 'failed_at': 0.0, 'started_at': None, 'starting': False,
+    'calls': 0, 'fallbacks': 0,
+}
+
+
+class _DaemonCall:
+    """Llamada gRPC en curso registrada en job['proc'] (cancelable como un proceso)."""
+
+    pid = None
+
+    def __init__(self, call):
+        self.call = call
+
+    def poll(self):
+        return None if self.call.is_active() else 0
+
+    def kill(self):
+        self.call.cancel()
+
+
+def _cli_daemon_import():
+    """grpc + stubs de arduino-cli. Lanza ImportError si no están instalados."""
+    import grpc
+    from cc.arduino.cli.commands.v1 import (commands_pb2, commands_pb2_grpc, common_pb2, compile_pb2,
+                                            core_pb2, port_pb2, upload_pb2)
+    return {'grpc': grpc, 'commands': commands_pb2, 'service': commands_pb2_grpc, 'common': common_pb2,
+            'compile': compile_pb2, 'core': core_pb2, 'port': port_pb2, 'upload': upload_pb2}
+
+
+def _cli_daemon_spawn(api):
+    """
+    Lanza `arduino-cli daemon` en un puerto libre y crea una instancia.
+    Returns: (proc, 'host:port', stub, instance). Si algo falla, mata el proceso y relanza.
+    """
+    proc = subprocess.Popen(
+        [ARDUINO_CLI, 'daemon', '--port', '0', '--format', 'json'],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8', errors='replace'
+    )
+    found = queue.Queue()
+
+    def _reader():
+        for line in proc.stdout:
+            m = re.search(r'"Port"\s*:\s*"?(\d+)', line) or re.search(r'listening on [\w.]+:(\d+)', line, re.I)
+            if m:
+                found.put(m.group(1))
+                break
+        for _line in proc.stdout:  # vaciar la salida para que el daemon no se bloquee
+            pass
+
+    threading.Thread(target=_reader, daemon=True, name='cli-daemon-out').start()
+    channel = None
+    try:
         try:
-            r = subprocess.run(
-                [ARDUINO_CLI, 'compile', '--fqbn', fqbn, '--output-dir', build_dir, sketch_dir],
-                capture_output=True, text=True, timeout=120
-            )
-            if r.returncode != 0:
-                return (None, f'Error de compilación: {(r.stderr or r.stdout or "")[:500]}')
-            for fname in os.listdir(build_dir):
-                if fname.endswith('.hex'):
-                    hex_path = os.path.join(build_dir, fname)
-                    log(f"HEX compilado localmente: {hex_path}")
-                    return (hex_path, None)
-            return (None, 'No se generó archivo HEX')
-        except subprocess.TimeoutExpired:
-            return (None, 'Timeout de compilación')
+            port = found.get(timeout=CLI_DAEMON_START_TIMEOUT_SEC)
+        except queue.Empty:
+            raise RuntimeError('arduino-cli daemon no informó su puerto')
+        address = f'127.0.0.1:{port}'
+        channel = api['grpc'].insecure_channel(address)
+        api['grpc'].channel_ready_future(channel).result(timeout=CLI_DAEMON_START_TIMEOUT_SEC)
+        stub = api['service'].ArduinoCoreServiceStub(channel)
+        instance = stub.Create(api['commands'].CreateRequest()).instance
+    except BaseException:
+        # Sin esto cada reintento (CLI_DAEMON_RETRY_SEC) dejaría otro daemon huérfano
+        if channel is not None:
+            channel.close()
+        _kill_process_tree(proc)
+        raise
+    return proc, address, stub, instance
+
+
+def _cli_daemon_init(api, stub, instance):
+    """(Re)carga índices y plataformas en la instancia (tras instalar un core, p.ej.)."""
+    for resp in stub.Init(api['commands'].InitRequest(instance=instance)):
+        error = getattr(resp, 'error', None)
+        if error is not None and getattr(error, 'message', ''):
+            print(f"[DAEMON] Init: {error.message}")
+
+
+def _cli_daemon_ensure():
+    """Stub listo para usar (arranca/inicializa el daemon si hace falta) o None → usar subprocess."""
+    d = _cli_daemon
+    spawn = False
+    with _cli_daemon_lock:
+        if d['proc'] is not None and d['proc'].poll() is not None:
+            print("[DAEMON] arduino-cli daemon terminó; se usará subprocess hasta reiniciarlo")
+            d.update(proc=None, stub=None, instance=None, error='daemon terminado', failed_at=time.time())
+        if d['stub'] is None:
+            if not ARDUINO_CLI or d['starting'] or time.time() - d['failed_at'] < CLI_DAEMON_RETRY_SEC:
+                return None  # mientras arranca, las llamadas siguen por subprocess
+            d['starting'] = spawn = True
+    if spawn:
+        # Arranque fuera del lock: puede tardar hasta 2×CLI_DAEMON_START_TIMEOUT_SEC
+        try:
+            api = d['api'] or _cli_daemon_import()
+            proc, address, stub, instance = _cli_daemon_spawn(api)
         except Exception as e:
-            return (None, str(e))
+            with _cli_daemon_lock:
+                d.update(starting=False, error=str(e)[:300], failed_at=time.time())
+            print(f"[DAEMON] No disponible, se usa subprocess: {e}")
+            return None
+        atexit.register(proc.terminate)
+        with _cli_daemon_lock:
+            d.update(api=api, proc=proc, address=address, stub=stub, instance=instance,
+                     needs_init=True, error=None, started_at=time.time(), starting=False)
+        print(f"[DAEMON] arduino-cli daemon en {address} (pid {proc.pid})")
+    with _cli_daemon_lock:
+        if d['stub'] is None:
+            return None
+        if d['needs_init']:
+            try:
+                _cli_daemon_init(d['api'], d['stub'], d['instance'])
+                d['needs_init'] = False
+            except Exception as e:
+                print(f"[DAEMON] Error inicializando instancia: {e}")
+                return None
+        return d['api'], d['stub'], d['instance']
 
-    return (None, 'Se requiere artifact(s), hex_url o code')
 
+def _cli_daemon_invalidate():
+    """Los cores instalados cambiaron: la instancia se reinicializa en la próxima llamada."""
+    _cli_daemon['needs_init'] = True
 
-def _do_upload_avr(port, fqbn, hex_file, log_func):
+
+def _cli_daemon_parse(cmd):
+    """argv de arduino-cli -> (rpc, opciones) o None si el daemon no lo cubre."""
+    if not cmd or cmd[0] != ARDUINO_CLI:
+        return None
+    args = list(cmd[1:])
+    if args == ['version']:
+        return 'version', {}
+    if args == ['core', 'list']:
+        return 'core_list', {}
+    if not args or args[0] not in ('compile', 'upload'):
+        return None
+    opts = {'library': [], 'verbose': False, 'sketch_path': None}
+    i = 1
+    while i < len(args):
+        arg = args[i]
+        if arg in ('-v', '--verbose'):
+            opts['verbose'] = True
+        elif arg in _CLI_DAEMON_FLAGS and i + 1 < len(args):
+            field = _CLI_DAEMON_FLAGS[arg]
+            i += 1
+            if field == 'library':
+                opts['library'].append(args[i])
+            else:
+                opts[field] = args[i]
+        elif arg.startswith('-') or opts['sketch_path'] is not None:
+            return None
+        else:
+            opts['sketch_path'] = arg
+        i += 1
+    return args[0], opts
+
+
+def _cli_daemon_collect(cmd, responses, job):
+    """Junta out_stream/err_stream de una llamada en streaming (publicando líneas si hay job)."""
+    out, err = [], []
+    for resp in responses:
+        for chunk, sink, name in ((resp.out_stream, out, 'stdout'), (resp.err_stream, err, 'stderr')):
+            if not chunk:
+                continue
+            text = chunk.decode('utf-8', errors='replace')
+            sink.append(text)
+            if job is not None:
+                for line in text.splitlines():
+                    if line.strip():
+                        job['output_lines'] += 1
+                        job['last_line'] = line.strip()[:300]
+                        if job.get('sink'):
+                            job['sink']('log', {'line': line.rstrip(), 'stream': name})
+    return ''.join(out), ''.join(err)
+
+
+def _cli_daemon_call(api, stub, instance, rpc, opts, timeout):
+    """Ejecuta la RPC. Returns: (returncode, stdout, stderr, llamada en streaming o None)."""
+    commands = api['commands']
+    if rpc == 'version':
+        return 0, f"arduino-cli  Version: {stub.Version(commands.VersionRequest(), timeout=timeout).version}\n", '', None
+    if rpc == 'core_list':
+        core = api['core']
+        lines = ['ID Installed Latest Name']
+        if hasattr(core, 'PlatformListRequest'):  # arduino-cli < 1.0
+            resp = stub.PlatformList(core.PlatformListRequest(instance=instance), timeout=timeout)
+            for p in resp.installed_platforms:
+                lines.append(f'{p.id} {p.installed} {p.latest} {p.name}')
+        else:
+            resp = stub.PlatformSearch(core.PlatformSearchRequest(instance=instance), timeout=timeout)
+            for p in resp.search_output:
+                if p.installed_version:
+                    lines.append(f'{p.metadata.id} {p.installed_version} {p.latest_version} {p.metadata.id}')
+        return 0, '\n'.join(lines) + '\n', '', None
+    if rpc == 'compile':
+        req = api['compile'].CompileRequest(
+            instance=instance, fqbn=opts.get('fqbn', ''), sketch_path=opts['sketch_path'] or '',
+            build_path=opts.get('build_path', ''), build_cache_path=opts.get('build_cache_path', ''),
+            export_dir=opts.get('export_dir', ''), library=opts['library'],
+            warnings=opts.get('warnings', ''), verbose=opts['verbose'])
+        return None, None, None, stub.Compile(req, timeout=timeout)
+    req = api['upload'].UploadRequest(
+        instance=instance, fqbn=opts.get('fqbn', ''), sketch_path=opts['sketch_path'] or '',
+        port=api['port'].Port(address=opts.get('port', ''), protocol='serial'),
+        import_file=opts.get('import_file', ''), import_dir=opts.get('import_dir', ''), verbose=opts['verbose'])
+    return None, None, None, stub.Upload(req, timeout=timeout)
+
+
+def _cli_daemon_exec(cmd, timeout):
     """
-    Ejecuta upload AVR con arduino-cli.
-    Returns: (ok: bool, error_code: str|None, hint: str|None)
-    No deja el puerto abierto (arduino-cli cierra al terminar).
+    Ejecuta cmd por el daemon. Returns: CompletedProcess, o None si hay que usar subprocess
+    (comando no cubierto o daemon no disponible). Lanza TimeoutExpired/CompileCancelled como _exec_cli.
     """
-    def log(msg):
-        log_func(msg)
+    parsed = _cli_daemon_parse(cmd)
+    if parsed is None:
+        return None
+    ready = _cli_daemon_ensure()
+    if ready is None:
+        _cli_daemon['fallbacks'] += 1
+        return None
+    api, stub, instance = ready
+    grpc = api['grpc']
+    job = getattr(_cli_context, 'job', None)
+    if job is not None and job['cancel_requested']:
+        raise CompileCancelled()
+    _cli_daemon['calls'] += 1
+    try:
+        code, stdout, stderr, call = _cli_daemon_call(api, stub, instance, parsed[0], parsed[1], timeout)
+        if call is None:
+            return subprocess.CompletedProcess(cmd, code, stdout, stderr)
+        if job is not None:
+            job['proc'] = _DaemonCall(call)
+        try:
+            stdout, stderr = _cli_daemon_collect(cmd, call, job)
+        finally:
+            if job is not None:
+                job['proc'] = None
+        return subprocess.CompletedProcess(cmd, 0, stdout, stderr)
+    except grpc.RpcError as e:
+        status = e.code() if hasattr(e, 'code') else None
+        if status == grpc.StatusCode.DEADLINE_EXCEEDED:
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        if status == grpc.StatusCode.CANCELLED and job is not None and job['cancel_requested']:
+            raise CompileCancelled()
+        if status == grpc.StatusCode.UNAVAILABLE:
+            # Daemon caído: reintentar por subprocess y rearrancarlo más adelante
+            with _cli_daemon_lock:
+                _cli_daemon.update(stub=None, error='UNAVAILABLE', failed_at=time.time())
+            _cli_daemon['fallbacks'] += 1
+            return None
+        details = e.details() if hasattr(e, 'details') else str(e)
+        return subprocess.CompletedProcess(cmd, 1, '', f'Error: {details}\n')
+
+
+def _cli_query(cmd, timeout):
+    """Consulta corta (version, core list): por el daemon si está activo; si no, subprocess."""
+    if CLI_BACKEND == 'daemon':
+        r = _cli_daemon_exec(cmd, timeout)
+        if r is not None:
+            return r
+    return subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+
+
+def get_cli_backend_status():
+    """Resumen para /health."""
+    d = _cli_daemon
+    status = {'backend': CLI_BACKEND}
+    if CLI_BACKEND == 'daemon':
+        status.update(daemon_ready=d['stub'] is not None, address=d['address'], error=d['error'],
+                      started_at=d['started_at'], calls=d['calls'], fallbacks=d['fallbacks'])
+    return status
+
+
+def _benchmark_cli_backends(iterations):
+    """
+    Latencia de version, core list y compile (sketch mínimo, build dir persistente) por
+    subprocess y por daemon. Returns: {op: {backend: {median_ms, min_ms, max_ms} | None}}.
+    """
+    global CLI_BACKEND
+    fqbn = next((b['fqbn'] for b in _load_boards_registry()
+                 if _is_core_installed(_core_id_from_fqbn(b.get('fqbn')))), None)
+    out_dir = tempfile.mkdtemp(prefix='bench_', dir=_get_home_tmp())
+    ops = {
+        'version': lambda: _cli_query([ARDUINO_CLI, 'version'], 30),
+        'core list': lambda: _cli_query([ARDUINO_CLI, 'core', 'list'], 60),
+    }
+    if fqbn:
+        ops[f'compile {fqbn}'] = lambda: _compile_sketch(fqbn, {'sketch_verify.ino': PREWARM_SKETCH}, out_dir, [],
+                                                         lambda msg: None, timeout=PREWARM_TIMEOUT_SEC)
+    previous = CLI_BACKEND
+    results = {op: {} for op in ops}
+    try:
+        for backend in ('subprocess', 'daemon'):
+            CLI_BACKEND = backend
+            if backend == 'daemon' and _cli_daemon_ensure() is None:
+                for op in ops:
+                    results[op][backend] = None
+                continue
+            for op, fn in ops.items():
+                fn()  # calentamiento (build dir, caches del SO)
+                samples = []
+                for _ in range(iterations):
+                    t0 = time.time()
+                    r = fn()
+                    samples.append((time.time() - t0) * 1000)
+                    if r.returncode != 0:
+                        print(f"[BENCH] {op} ({backend}) falló: {(r.stderr or r.stdout or '').strip()[:200]}")
+                samples.sort()
+                results[op][backend] = {'median_ms': round(samples[len(samples) // 2], 1),
+                                        'min_ms': round(samples[0], 1), 'max_ms': round(samples[-1], 1)}
+    finally:
+        CLI_BACKEND = previous
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return results
 
-    log("Limpiando puerto antes de upload...")
-    reset_serial_port(port, log)
-    time.sleep(0.3)
 
-    upload_cmd = [
-        ARDUINO_CLI, 'upload',
-        '-p', port,
-        '--fqbn', fqbn,
-        '--input-file', hex_file,
-        '-v'
-    ]
-    MAX_RETRIES = 2
-    for attempt in range(MAX_RETRIES + 1):
-        if attempt > 0:
-            log(f"Reintento {attempt}/{MAX_RETRIES}...")
-            time.sleep(1.5)
-            reset_serial_port(port, log)
-            time.sleep(0.5)
-        log(f"Ejecutando: {' '.join(upload_cmd)}")
+# ============================================
+# CACHE DE COMPILACIÓN (content-addressed)
+# ============================================
+# En un aula 30 estudiantes compilan casi el mismo sketch para la misma placa.
+# Cada entrada guarda los artefactos (.hex/.bin), sus sha256 y el log original,
+# indexada por hash(sketch normalizado, fqbn, opciones, versión CLI, versión core).
+
+COMPILE_CACHE_DIR = None  # None → <home_tmp>/compile_cache
+COMPILE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+_compile_cache_lock = threading.Lock()
+_compile_cache_index = None  # OrderedDict key -> bytes (LRU: más antiguo primero)
+_compile_cache_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'deduplicated': 0}
+
+
+def _get_compile_cache_dir():
+    return COMPILE_CACHE_DIR or os.path.join(_get_home_tmp(), 'compile_cache')
+
+
+def _normalize_sketch_source(content):
+    """Normaliza saltos de línea y espacios finales (no cambian el binario generado)."""
+    text = str(content).replace('\r\n', '\n').replace('\r', '\n')
+    return '\n'.join(line.rstrip() for line in text.split('\n')).rstrip('\n')
+
+
+def _compile_cache_key(sketch_files, fqbn, extra_args):
+    """
+    Calcula la clave de caché.
+    sketch_files: {nombre: contenido}; extra_args: argumentos adicionales de compile
+    (--warnings, --library <path>, ...). Incluye la versión de las librerías que el
+    sketch puede enlazar (ver _sketch_library_versions).
+    """
+    files = {
+        name.replace('\\', '/'): hashlib.sha256(_normalize_sketch_source(content).encode('utf-8')).hexdigest()
+        for name, content in sketch_files.items()
+    }
+    payload = {
+        'files': files,
+        'fqbn': fqbn,
+        'args': list(extra_args),
+        'arduino_cli_version': _get_arduino_cli_version(),
+        'core_version': _get_core_version(_core_id_from_fqbn(fqbn)),
+        'libraries': _sketch_library_versions(fqbn, sketch_files),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _dir_size(path):
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _compile_cache_load_index():
+    """Carga (una vez) el índice LRU desde disco. Llamar con _compile_cache_lock tomado."""
+    global _compile_cache_index
+    if _compile_cache_index is not None:
+        return _compile_cache_index
+    entries = []
+    cache_dir = _get_compile_cache_dir()
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            meta_path = os.path.join(cache_dir, name, 'meta.json')
+            if not os.path.isfile(meta_path):
+                # Restos de escrituras interrumpidas
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+                continue
+            entries.append((os.path.getmtime(meta_path), name, _dir_size(os.path.join(cache_dir, name))))
+    entries.sort()
+    _compile_cache_index = OrderedDict((name, size) for _mtime, name, size in entries)
+    return _compile_cache_index
+
+
+def _compile_cache_drop(key):
+    """Elimina una entrada. Llamar con _compile_cache_lock tomado."""
+    _compile_cache_index.pop(key, None)
+    shutil.rmtree(os.path.join(_get_compile_cache_dir(), key), ignore_errors=True)
+
+
+def _compile_cache_evict():
+    """Expulsa entradas LRU hasta respetar COMPILE_CACHE_MAX_BYTES. Llamar con el lock tomado."""
+    while len(_compile_cache_index) > 1 and sum(_compile_cache_index.values()) > COMPILE_CACHE_MAX_BYTES:
+        oldest = next(iter(_compile_cache_index))
+        _compile_cache_drop(oldest)
+        _compile_cache_stats['evictions'] += 1
+
+
+def _compile_cache_get(key):
+    """
+    Busca una compilación previa.
+    Returns: dict {artifacts, compile_log, logs, fqbn, family, entry_dir} o None.
+    """
+    if COMPILE_CACHE_MAX_BYTES <= 0:
+        return None
+    entry_dir = os.path.join(_get_compile_cache_dir(), key)
+    meta_path = os.path.join(entry_dir, 'meta.json')
+    with _compile_cache_lock:
+        index = _compile_cache_load_index()
+        if key not in index:
+            _compile_cache_stats['misses'] += 1
+            return None
         try:
-            r = subprocess.run(upload_cmd, capture_output=True, text=True, timeout=120)
-        except subprocess.TimeoutExpired:
-            return (False, 'TIMEOUT', 'Timeout durante el upload. Verifica la conexión.')
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            for art in meta['artifacts']:
+                art['path'] = os.path.join(entry_dir, art['name'])
+                if not os.path.isfile(art['path']):
+                    raise FileNotFoundError(art['path'])
+        except Exception as e:
+            print(f"[CACHE] Entrada {key[:12]} inválida, eliminando: {e}")
+            _compile_cache_drop(key)
+            _compile_cache_stats['misses'] += 1
+            return None
+        index.move_to_end(key)
+        _compile_cache_stats['hits'] += 1
+        try:
+            os.utime(meta_path)  # Orden LRU persistente entre reinicios
+        except OSError:
+            pass
+    meta['entry_dir'] = entry_dir
+    return meta
 
-        if r.returncode == 0:
-            log("✓ Upload exitoso")
-            return (True, None, None)
 
-        err = (r.stderr + r.stdout).lower()
-        if any(x in err for x in ['busy', 'in use', 'resource busy', 'com-state', "can't open device"]):
-            if attempt < MAX_RETRIES:
+def _compile_cache_put(key, artifacts, compile_log, logs, fqbn, family):
+    """Guarda los artefactos de una compilación exitosa. Errores de disco no son fatales."""
+    if COMPILE_CACHE_MAX_BYTES <= 0:
+        return
+    cache_dir = _get_compile_cache_dir()
+    entry_dir = os.path.join(cache_dir, key)
+    tmp_dir = f'{entry_dir}.tmp-{uuid.uuid4().hex[:8]}'
+    try:
+        os.makedirs(tmp_dir)
+        stored = []
+        for art in artifacts:
+            shutil.copy2(art['path'], os.path.join(tmp_dir, art['name']))
+            stored.append({k: v for k, v in art.items() if k not in ('path', 'content_base64')})
+        meta = {
+            'fqbn': fqbn,
+            'family': family,
+            'artifacts': stored,
+            'compile_log': compile_log,
+            'logs': logs,
+            'created_at': time.time(),
+        }
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        with _compile_cache_lock:
+            index = _compile_cache_load_index()
+            if key in index or os.path.isdir(entry_dir):
+                # Otra petición idéntica ya la guardó
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            os.replace(tmp_dir, entry_dir)
+            index[key] = _dir_size(entry_dir)
+            _compile_cache_stats['stores'] += 1
+            _compile_cache_evict()
+    except Exception as e:
+        print(f"[CACHE] No se pudo guardar en caché: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def get_compile_cache_status():
+    """Estado de la caché de compilación para /health."""
+    with _compile_cache_lock:
+        index = _compile_cache_load_index()
+        lookups = _compile_cache_stats['hits'] + _compile_cache_stats['misses']
+        return {
+            'entries': len(index),
+            'bytes': sum(index.values()),
+            'max_bytes': COMPILE_CACHE_MAX_BYTES,
+            'hits': _compile_cache_stats['hits'],
+            'misses': _compile_cache_stats['misses'],
+            'stores': _compile_cache_stats['stores'],
+            'evictions': _compile_cache_stats['evictions'],
+            'hit_rate': round(_compile_cache_stats['hits'] / lookups, 3) if lookups else None,
+            'inflight': len(_compile_flights),
+            'deduplicated': _compile_cache_stats['deduplicated'],
+        }
+
+
+# Single-flight: doble clic o reintento del IDE mandan el mismo /compile casi a la vez.
+# La primera petición con una clave de caché compila ("líder"); las idénticas que llegan
+# mientras tanto esperan, reciben en vivo las líneas de log del líder y después leen
+# sus artefactos de la caché o, si la caché está desactivada o ya expulsó la entrada,
+# directamente del build del líder (flight['result']), que se borra cuando lo suelta la
+# última petición. Un error de compilación se comparte tal cual; si el líder se cancela
+# o agota el tiempo, cada una compila por su cuenta.
+
+# cache_key -> {'done': Event, 'logs': lista del líder, 'error': payload|None,
+#               'result': {artifacts, compile_log, temp_dir}|None, 'followers': n, 'holders': n}
+_compile_flights = {}
+_compile_flights_lock = threading.Lock()
+
+
+def _compile_flight_join(key, logs):
+    """Returns: (flight, es_lider)."""
+    with _compile_flights_lock:
+        flight = _compile_flights.get(key)
+        if flight is not None:
+            flight['followers'] += 1
+            flight['holders'] += 1
+            return flight, False
+        flight = _compile_flights[key] = {'done': threading.Event(), 'logs': logs, 'error': None,
+                                          'result': None, 'followers': 0, 'holders': 1}
+        return flight, True
+
+
+def _compile_flight_finish(key, flight):
+    """El líder terminó (con o sin éxito): despierta a las peticiones en espera."""
+    with _compile_flights_lock:
+        if _compile_flights.get(key) is flight:
+            del _compile_flights[key]
+    flight['done'].set()
+
+
+def _compile_flight_release(flight):
+    """Suelta el flight (líder o espera); la última petición borra el build compartido."""
+    with _compile_flights_lock:
+        flight['holders'] -= 1
+        last = flight['holders'] <= 0
+    if last and flight['result'] is not None:
+        shutil.rmtree(flight['result']['temp_dir'], ignore_errors=True)
+
+
+def _compile_flight_result(flight):
+    """
+    Resultado exitoso del líder con la forma de una entrada de caché, o None.
+    Los artefactos siguen en el build del líder mientras esta petición no suelte el flight.
+    """
+    result = flight['result']
+    if result is None:
+        return None
+    return {
+        'artifacts': [dict(a) for a in result['artifacts']],
+        'compile_log': result['compile_log'],
+        'entry_dir': os.path.dirname(result['artifacts'][0]['path']) if result['artifacts'] else result['temp_dir'],
+    }
+
+
+def _compile_flight_wait(flight, logs):
+    """
+    Espera al líder reenviando sus líneas de log (incluido el stream SSE de esta petición).
+    Returns: payload de error del líder (copia) o None. Lanza CompileCancelled si se cancela esta petición.
+    """
+    job = getattr(_cli_context, 'job', None)
+    seen = 0
+    while True:
+        finished = flight['done'].wait(0.25)
+        lines = flight['logs'][seen:]
+        seen += len(lines)
+        for line in lines:
+            logs.append(line)
+            _stream_emit('log', {'line': line})
+        if finished:
+            break
+        if job is not None and job['cancel_requested']:
+            raise CompileCancelled()
+    if flight['error'] is None:
+        return None
+    return dict(flight['error'], logs=logs, compile_log='\n'.join(logs))
+
+
+# ============================================
+# BUILD DIRS PERSISTENTES (compilación incremental)
+# ============================================
+# Cada FQBN (y opcionalmente cada proyecto) tiene un "slot" con:
+#   <slot>/<sketch_name>/  sketch estable (solo se reescriben archivos que cambian)
+#   <slot>/build/          --build-path (objetos del core, librerías y sketch)
+# y todos comparten <warm>/core_cache (--build-cache-path, core.a precompilados).
+# Así arduino-cli solo recompila las unidades del sketch que cambiaron.
+
+WARM_BUILDS_ENABLED = True
+WARM_BUILD_DIR = None  # None → <home_tmp>/warm_builds
+WARM_BUILD_TTL_SEC = 7 * 24 * 3600  # slots sin uso se eliminan tras 7 días
+WARM_BUILD_MAX_SLOTS = 12
+
+_warm_slot_locks = {}
+_warm_slot_locks_guard = threading.Lock()
+
+
+def _get_warm_build_dir():
+    return WARM_BUILD_DIR or os.path.join(_get_home_tmp(), 'warm_builds')
+
+
+def _warm_slot_name(fqbn, project=None):
+    """Nombre de directorio seguro para el slot de un FQBN (+ proyecto)."""
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', fqbn)
+    if project:
+        name += '__' + re.sub(r'[^A-Za-z0-9._-]+', '_', str(project))[:40]
+    return name
+
+
+def _warm_slot_project(data):
+    """Proyecto del slot persistente de una request (/compile y /upload con code): options.project o project_id."""
+    options = data.get('options') if isinstance(data.get('options'), dict) else {}
+    return options.get('project') or data.get('project_id')
+
+
+def _get_warm_slot_lock(name):
+    with _warm_slot_locks_guard:
+        lock = _warm_slot_locks.get(name)
+        if lock is None:
+            lock = _warm_slot_locks[name] = threading.Lock()
+        return lock
+
+
+def _sync_warm_sketch(sketch_dir, sketch_files):
+    """
+    Sincroniza el sketch del slot con sketch_files sin tocar archivos idénticos
+    (conserva su mtime). Elimina archivos que ya no forman parte del sketch.
+    Returns: número de archivos escritos.
+    """
+    os.makedirs(sketch_dir, exist_ok=True)
+    wanted = {}
+    for fname, content in sketch_files.items():
+        rel = os.path.normpath(fname)
+        if rel.startswith('..') or os.path.isabs(rel):
+            continue
+        wanted[rel] = str(content).encode('utf-8')
+
+    written = 0
+    for rel, raw in wanted.items():
+        fpath = os.path.join(sketch_dir, rel)
+        try:
+            with open(fpath, 'rb') as f:
+                if f.read() == raw:
+                    continue
+        except OSError:
+            pass
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, 'wb') as f:
+            f.write(raw)
+        written += 1
+
+    for root, _dirs, fnames in os.walk(sketch_dir):
+        for fname in fnames:
+            rel = os.path.relpath(os.path.join(root, fname), sketch_dir)
+            if rel not in wanted:
+                os.remove(os.path.join(root, fname))
+    return written
+
+
+def _prune_stale_sketch_objects(build_path, sketch_files):
+    """
+    Política de limpieza: elimina de <build>/sketch los objetos (.o/.d/.cpp) cuyo
+    fuente ya no existe en el sketch. Core y librerías se conservan.
+    """
+    obj_dir = os.path.join(build_path, 'sketch')
+    if not os.path.isdir(obj_dir):
+        return 0
+    current = {os.path.normpath(name).replace('\\', '/') for name in sketch_files}
+    removed = 0
+    for root, _dirs, fnames in os.walk(obj_dir):
+        for fname in fnames:
+            fpath = os.path.join(root, fname)
+            src = os.path.relpath(fpath, obj_dir).replace('\\', '/')
+            for suffix in ('.o', '.d'):
+                if src.endswith(suffix):
+                    src = src[:-len(suffix)]
+                    break
+            if src.endswith('.ino.cpp'):
+                src = src[:-len('.cpp')]
+            if src not in current:
+                try:
+                    os.remove(fpath)
+                    removed += 1
+                except OSError:
+                    pass
+    return removed
+
+
+def _cleanup_warm_builds(keep=None):
+    """Elimina slots sin uso más de WARM_BUILD_TTL_SEC y los más antiguos si hay demasiados."""
+    base = _get_warm_build_dir()
+    if not os.path.isdir(base):
+        return
+    slots = []
+    for name in os.listdir(base):
+        path = os.path.join(base, name)
+        if name == 'core_cache' or name == keep or not os.path.isdir(path):
+            continue
+        slots.append((os.path.getmtime(path), name, path))
+    slots.sort()
+    now = time.time()
+    excess = len(slots) + (1 if keep else 0) - WARM_BUILD_MAX_SLOTS
+    for mtime, name, path in slots:
+        if now - mtime <= WARM_BUILD_TTL_SEC and excess <= 0:
+            continue
+        lock = _get_warm_slot_lock(name)
+        if not lock.acquire(blocking=False):
+            continue  # En uso
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+            excess -= 1
+            print(f"[WARM] Slot {name} eliminado")
+        finally:
+            lock.release()
+
+
+# ============================================
+# TIEMPOS POR FASE DE COMPILACIÓN
+# ============================================
+# arduino-cli no informa cuánto tarda cada etapa, y en /compile síncrono la salida no
+# llega en vivo. Pero en el build dir persistente cada fase escribe en un lugar fijo:
+#   preprocess  includes.cache, preproc/, sketch/*.cpp (detección de librerías, prototipos)
+#   sketch      sketch/**/*.o       libraries  libraries/**      core  core/**
+#   linking     *.elf, *.map        output     *.hex, *.eep, *.bin
+# El mtime del último archivo que escribió cada fase marca su fin. Una fase sin archivos
+# nuevos se reutilizó del build anterior (dura 0 y aparece en 'reused').
+
+COMPILE_PHASES = ('preprocess', 'sketch', 'libraries', 'core', 'linking', 'output')
+COMPILE_TIMINGS_WINDOW = 50  # compilaciones recientes por FQBN en /diagnostics/compile
+
+_compile_timings = {}  # fqbn -> deque de timings (solo compilaciones reales exitosas)
+_compile_timings_lock = threading.Lock()
+
+
+def _build_file_phase(rel_path):
+    parts = rel_path.replace('\\', '/').split('/')
+    top, name = parts[0], parts[-1].lower()
+    if top in ('sketch', 'libraries', 'core') and len(parts) > 1:
+        if top == 'sketch' and not name.endswith('.o'):
+            return 'preprocess'
+        return top
+    if name.endswith(('.elf', '.map')):
+        return 'linking'
+    if name.endswith(('.hex', '.eep', '.bin')):
+        return 'output'
+    return 'preprocess'
+
+
+def _compile_phase_timings(build_path, t_start, t_end):
+    """
+    Duración de cada fase a partir de los archivos escritos en build_path entre t_start y t_end.
+    Returns: {phases: {fase: seg}, reused: [...], compiled_files: {sketch, libraries, core}, other_sec}
+    """
+    ends = {}
+    fresh = {}
+    for root, _dirs, files in os.walk(build_path):
+        for fname in files:
+            path = os.path.join(root, fname)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
                 continue
-            if "can't open device" in err or 'not found' in err or 'no such file' in err:
-                return (False, 'PORT_NOT_FOUND', 'Puerto no encontrado. Verifica que el Arduino esté conectado.')
-            return (False, 'PORT_BUSY', 'El puerto está ocupado. Cierra Serial Monitor u otras apps.')
-        if 'permission denied' in err or 'access denied' in err:
-            if platform.system() == 'Linux':
-                hint = 'Permiso denegado. Ejecuta: sudo usermod -a -G dialout $USER\nY cierra sesión y vuelve a entrar.'
-                if ARDUINO_CLI and 'snap' in ARDUINO_CLI:
-                    hint = 'arduino-cli (snap) no puede acceder a puertos. Instala arduino-cli sin snap.'
-            else:
-                hint = 'Permiso denegado. Ejecuta el Agent como administrador.'
-            return (False, 'PERMISSION_DENIED', hint)
-        if 'sync' in err or 'not in sync' in err or 'programmer is not responding' in err:
-            hint = 'Error de sincronización con el bootloader. Si es Nano clon CH340, usa "Arduino Nano (Old Bootloader)".'
-            return (False, 'SYNC_FAIL', hint)
-        if 'timeout' in err or 'timed out' in err:
-            return (False, 'TIMEOUT', 'Timeout. Verifica la conexión y reinicia el Arduino.')
-        break
+            if mtime < t_start:
+                continue
+            phase = _build_file_phase(os.path.relpath(path, build_path))
+            ends[phase] = max(ends.get(phase, 0.0), min(mtime, t_end))
+            if fname.endswith('.o'):
+                fresh[phase] = fresh.get(phase, 0) + 1
+    phases = {}
+    reused = []
+    prev = t_start
+    for phase in COMPILE_PHASES:
+        if phase not in ends:
+            phases[phase] = 0.0
+            reused.append(phase)
+            continue
+        end = max(ends[phase], prev)
+        phases[phase] = round(end - prev, 3)
+        prev = end
+    return {
+        'phases': phases,
+        'reused': reused,
+        'compiled_files': {p: fresh.get(p, 0) for p in ('sketch', 'libraries', 'core')},
+        'other_sec': round(max(0.0, t_end - prev), 3),
+    }
+
+
+def _record_compile_timings(fqbn, timings):
+    with _compile_timings_lock:
+        _compile_timings.setdefault(fqbn, deque(maxlen=COMPILE_TIMINGS_WINDOW)).append(timings)
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def get_compile_timings_summary(fqbn=None):
+    """Resumen por FQBN de las últimas COMPILE_TIMINGS_WINDOW compilaciones reales."""
+    with _compile_timings_lock:
+        recent = {k: list(v) for k, v in _compile_timings.items() if fqbn is None or k == fqbn}
+    summary = {}
+    for key, items in recent.items():
+        totals = [t['total_sec'] for t in items]
+        with_phases = [t for t in items if t.get('phases')]
+        summary[key] = {
+            'count': len(items),
+            'total_sec': {
+                'avg': round(sum(totals) / len(totals), 3),
+                'p50': _percentile(totals, 0.5),
+                'p90': _percentile(totals, 0.9),
+                'max': max(totals),
+            },
+            'phases_avg_sec': {
+                p: round(sum(t['phases'][p] for t in with_phases) / len(with_phases), 3) for p in COMPILE_PHASES
+            } if with_phases else None,
+            'reused_ratio': {
+                p: round(sum(1 for t in with_phases if p in t['reused']) / len(with_phases), 2) for p in COMPILE_PHASES
+            } if with_phases else None,
+        }
+    return summary
+
+
+def _compile_sketch(fqbn, sketch_files, output_dir, extra_args, log_func, project=None,
+                    sketch_name='sketch_verify', timeout=120, timings=None):
+    """
+    Ejecuta `arduino-cli compile` y deja los artefactos en output_dir.
+    Con WARM_BUILDS_ENABLED usa el build dir persistente del FQBN (bloqueado
+    mientras dura la compilación); si no, un sketch temporal como antes.
+    timings: dict opcional donde se dejan los tiempos por fase y la espera en la cola del
+    scheduler (queue_wait_sec), solo con build dir persistente.
+    Returns: CompletedProcess. Lanza subprocess.TimeoutExpired.
+    """
+    if not WARM_BUILDS_ENABLED:
+        sketch_dir = os.path.join(output_dir + '_sketch', sketch_name)
+        _sync_warm_sketch(sketch_dir, sketch_files)
+        cmd = [ARDUINO_CLI, 'compile', '--fqbn', fqbn, '--output-dir', output_dir] + list(extra_args) + [sketch_dir]
+        return _run_cli(cmd, timeout)
+
+    base = _get_warm_build_dir()
+    name = _warm_slot_name(fqbn, project)
+    slot_dir = os.path.join(base, name)
+    sketch_dir = os.path.join(slot_dir, sketch_name)
+    build_path = os.path.join(slot_dir, 'build')
+    build_cache_path = os.path.join(base, 'core_cache')
+
+    lock = _get_warm_slot_lock(name)
+    if not lock.acquire(blocking=False):
+        log_func(f"Esperando build dir de {fqbn} (otra compilación en curso)...")
+        lock.acquire()
+    is_new = False
+    try:
+        is_new = not os.path.isdir(build_path)
+        os.makedirs(build_path, exist_ok=True)
+        os.makedirs(build_cache_path, exist_ok=True)
+        # Otros sketch_name en el mismo slot (p.ej. versiones previas) sobran
+        for entry in os.listdir(slot_dir):
+            if entry not in (sketch_name, 'build'):
+                shutil.rmtree(os.path.join(slot_dir, entry), ignore_errors=True)
+        changed = _sync_warm_sketch(sketch_dir, sketch_files)
+        pruned = _prune_stale_sketch_objects(build_path, sketch_files)
+        os.utime(slot_dir)
+        log_func(
+            f"Build dir {'nuevo' if is_new else 'reutilizado'} ({name}): "
+            f"{changed} archivo(s) del sketch modificados" + (f", {pruned} objeto(s) obsoletos eliminados" if pruned else '')
+        )
+        cmd = [
+            ARDUINO_CLI, 'compile',
+            '--fqbn', fqbn,
+            '--build-path', build_path,
+            '--build-cache-path', build_cache_path,
+            '--output-dir', output_dir,
+        ] + list(extra_args) + [sketch_dir]
+        try:
+            t_cli = time.time()
+            _cli_context.slot_acquired_at = None
+            result = _run_cli(cmd, timeout)
+            if timings is not None:
+                # Las fases cuentan desde que el scheduler dio turno, no desde la cola
+                t_run = getattr(_cli_context, 'slot_acquired_at', None) or t_cli
+                timings.update(_compile_phase_timings(build_path, t_run, time.time()))
+                timings['queue_wait_sec'] = round(t_run - t_cli, 3)
+            return result
+        except (subprocess.TimeoutExpired, CompileCancelled):
+            # Objetos a medio escribir podrían parecer actualizados: empezar de cero
+            shutil.rmtree(build_path, ignore_errors=True)
+            raise
+    finally:
+        lock.release()
+        if is_new:
+            _cleanup_warm_builds(keep=name)
+
+
+# ============================================
+# PRE-CALENTAMIENTO DE BUILD DIRS (opcional, --prewarm)
+# ============================================
+# La primera compilación tras encender el PC paga el core completo de la placa, y llega
+# justo cuando toda la clase pulsa "Verificar". Con --prewarm, tras el arranque se compila
+# un sketch mínimo por cada FQBN del registry (con su core instalado) en el slot
+# persistente, con prioridad baja de CPU y solo mientras el scheduler está ocioso. Una
+# compilación real cancela la del pre-calentamiento, que se reintenta más tarde.
+
+PREWARM_ENABLED = False
+PREWARM_START_DELAY_SEC = 15.0   # deja arrancar al Agent (puertos, sondeo de entorno)
+PREWARM_IDLE_SEC = 30.0          # silencio exigido tras la última compilación real
+PREWARM_TIMEOUT_SEC = 600        # un core ESP32 completo puede tardar varios minutos en un PC de aula
+PREWARM_MAX_YIELDS = 3           # veces que un FQBN cede ante compilaciones reales antes de rendirse
+PREWARM_SKETCH = 'void setup() {}\nvoid loop() {}\n'
+
+_prewarm_lock = threading.Lock()
+_prewarm_thread = None
+_prewarm_state = {
+    'state': 'disabled',  # disabled | waiting | running | done
+    'total': 0,
+    'current': None,
+    'job': None,
+    'results': {},  # fqbn -> {state: ok|error|skipped|deferred, sec, error}
+    'last_request_at': 0.0,
+    'started_at': None,
+    'finished_at': None,
+}
+
+
+def _prewarm_yield():
+    """Una compilación real llega: cancela la del pre-calentamiento (si hay) y reinicia la espera."""
+    with _prewarm_lock:
+        _prewarm_state['last_request_at'] = time.time()
+        job = _prewarm_state['job']
+        if job is not None and not job['cancel_requested']:
+            job['cancel_requested'] = True
+            if job['proc'] is not None:
+                _kill_process_tree(job['proc'])
+            print(f"[PREWARM] Cede {_prewarm_state['current']} a una compilación real")
+
+
+def _prewarm_wait_idle():
+    """Bloquea hasta que no haya compilaciones en curso ni en cola durante PREWARM_IDLE_SEC."""
+    while True:
+        with _cli_sched_cond:
+            busy = _cli_sched['running'] or _cli_sched['waiting']
+        with _prewarm_lock:
+            quiet_for = time.time() - _prewarm_state['last_request_at']
+        if not busy and quiet_for >= PREWARM_IDLE_SEC:
+            return
+        time.sleep(max(0.5, min(5.0, PREWARM_IDLE_SEC - quiet_for)))
+
+
+def _prewarm_fqbns():
+    """FQBNs del registry sin repetir, en orden de aparición."""
+    fqbns = []
+    for board in _load_boards_registry():
+        fqbn = board.get('fqbn')
+        if fqbn and fqbn not in fqbns:
+            fqbns.append(fqbn)
+    return fqbns
+
+
+def _prewarm_one(fqbn):
+    """Compila el sketch mínimo de fqbn en su slot. Lanza CompileCancelled si cede el turno."""
+    job = _new_cli_job()
+    job['low_priority'] = True
+    out_dir = tempfile.mkdtemp(prefix='prewarm_', dir=_get_home_tmp())
+    with _prewarm_lock:
+        _prewarm_state['current'], _prewarm_state['job'] = fqbn, job
+    _cli_context.job = job
+    t0 = time.time()
+    try:
+        with _cli_priority('prewarm'):
+            r = _compile_sketch(fqbn, {'sketch_verify.ino': PREWARM_SKETCH}, out_dir, [],
+                                lambda msg: print(f"[PREWARM] {msg}"), timeout=PREWARM_TIMEOUT_SEC)
+        sec = round(time.time() - t0, 1)
+        if r.returncode == 0:
+            return {'state': 'ok', 'sec': sec}
+        return {'state': 'error', 'sec': sec, 'error': (r.stderr or r.stdout or '').strip()[-300:]}
+    except subprocess.TimeoutExpired:
+        return {'state': 'error', 'sec': round(time.time() - t0, 1), 'error': 'Timeout'}
+    finally:
+        _cli_context.job = None
+        with _prewarm_lock:
+            _prewarm_state['current'], _prewarm_state['job'] = None, None
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def _prewarm_run(fqbns):
+    """Pre-calienta cada FQBN; los que ceden ante compilaciones reales vuelven al final de la cola."""
+    with _prewarm_lock:
+        _prewarm_state.update(state='running', total=len(fqbns), results={}, started_at=time.time(), finished_at=None)
+    pending = deque(fqbns)
+    yields = {}
+    while pending:
+        fqbn = pending.popleft()
+        if not _get_core_version(_core_id_from_fqbn(fqbn)):
+            result = {'state': 'skipped', 'error': 'Core no instalado'}
+        else:
+            _prewarm_wait_idle()
+            try:
+                result = _prewarm_one(fqbn)
+            except CompileCancelled:
+                yields[fqbn] = yields.get(fqbn, 0) + 1
+                if yields[fqbn] < PREWARM_MAX_YIELDS:
+                    pending.append(fqbn)
+                    result = {'state': 'deferred'}
+                else:
+                    result = {'state': 'skipped', 'error': f'Cedido {yields[fqbn]} veces a compilaciones reales'}
+            except Exception as e:
+                result = {'state': 'error', 'error': str(e)[:300]}
+        with _prewarm_lock:
+            _prewarm_state['results'][fqbn] = result
+        if result['state'] in ('ok', 'error'):
+            print(f"[PREWARM] {fqbn}: {result['state']}" + (f" ({result['sec']}s)" if 'sec' in result else ''))
+    with _prewarm_lock:
+        _prewarm_state.update(state='done', finished_at=time.time())
+
 
-    return (False, 'UPLOAD_FAIL', (r.stderr or r.stdout or 'Error desconocido')[:500])
+def _prewarm_loop():
+    time.sleep(PREWARM_START_DELAY_SEC)
+    try:
+        _prewarm_run(_prewarm_fqbns())
+    except Exception as e:
+        print(f"[PREWARM] Error: {e}")
+        with _prewarm_lock:
+            _prewarm_state.update(state='done', finished_at=time.time())
+
+
+def _start_prewarm():
+    """Arranca el pre-calentamiento en segundo plano (idempotente; solo con PREWARM_ENABLED)."""
+    global _prewarm_thread
+    if not PREWARM_ENABLED or not ARDUINO_CLI or not WARM_BUILDS_ENABLED:
+        return
+    with _prewarm_lock:
+        if _prewarm_thread is None:
+            _prewarm_state['state'] = 'waiting'
+            _prewarm_thread = threading.Thread(target=_prewarm_loop, daemon=True, name='prewarm')
+            _prewarm_thread.start()
+
+
+def get_prewarm_status():
+    """Progreso para /health."""
+    with _prewarm_lock:
+        results = dict(_prewarm_state['results'])
+        return {
+            'state': _prewarm_state['state'],
+            'total': _prewarm_state['total'],
+            'done': sum(1 for r in results.values() if r['state'] != 'deferred'),
+            'current': _prewarm_state['current'],
+            'results': results,
+            'started_at': _prewarm_state['started_at'],
+            'finished_at': _prewarm_state['finished_at'],
+        }
 
 
 # ============================================
@@ -1008,7 +3411,7 @@ def _do_upload_avr(port, fqbn, hex_file, log_func):
 def install_esp32_core():
     """
     Instala el core ESP32 automáticamente (arduino-cli core install esp32:esp32).
-    Un solo clic para estudiantes, sin abrir CMD.
+    Un solo clic para estudiantes, sin abrir CMD. Espera al mismo job que /cores/install.
     """
     logs = []
 
@@ -1018,42 +3421,59 @@ def install_esp32_core():
         logs.append(entry)
         print(f"[ESP32-INSTALL] {msg}")
 
-    try:
-        if not ARDUINO_CLI:
-            return jsonify({'ok': False, 'error': 'arduino-cli no encontrado', 'logs': logs}), 500
+    if not ARDUINO_CLI:
+        return jsonify({'ok': False, 'error': 'arduino-cli no encontrado', 'logs': logs}), 500
 
-        log('Instalando core esp32:esp32... (puede tardar 1-3 minutos)')
-        result = subprocess.run(
-            [ARDUINO_CLI, 'core', 'install', 'esp32:esp32'],
-            capture_output=True,
-            text=True,
-            timeout=300,
-            cwd=os.path.dirname(os.path.abspath(__file__))
-        )
+    log('Instalando core esp32:esp32... (puede tardar 1-3 minutos)')
+    job = _start_core_install('esp32:esp32')
+    finished = _wait_core_install(job, 300)
+    logs.extend(job['logs'])
+    if not finished:
+        log('Tiempo de espera agotado')
+        return jsonify({
+            'ok': False, 'error': 'La instalación tardó demasiado (timeout 5 min)', 'logs': logs,
+            'job_id': job['id'], 'status_url': f"/cores/install/{job['id']}"
+        }), 500
+    if job['state'] == 'done':
+        return jsonify({'ok': True, 'logs': logs, 'message': 'Core ESP32 instalado. Intenta verificar/subir de nuevo.'})
+    return jsonify({'ok': False, 'error': job['error'] or 'Error desconocido', 'logs': logs}), 500
+
+
+# ============================================
+# ENDPOINT: /cores/install (jobs de instalación)
+# ============================================
+
+@app.route('/cores/install', methods=['POST', 'OPTIONS'])
+def create_core_install():
+    """
+    Lanza la instalación de un core en segundo plano.
+    Body: { "core": "esp32:esp32" } o { "fqbn": "esp32:esp32:esp32" }
+    Response (202): { "ok": true, "job": {...}, "status_url": "/cores/install/<id>" }
+    """
+    data = request.get_json(silent=True) or {}
+    core_id = data.get('core') or _core_id_from_fqbn(data.get('fqbn'))
+    if not isinstance(core_id, str) or not _CORE_ID_RE.match(core_id):
+        return jsonify({'ok': False, 'error': 'core inválido (formato paquete:arquitectura)',
+                        'error_code': 'INVALID_CORE'}), 400
+    if not ARDUINO_CLI:
+        return jsonify({'ok': False, 'error': 'arduino-cli no encontrado'}), 500
+    job = _start_core_install(core_id)
+    return jsonify({
+        'ok': True, 'job': _core_install_view(job),
+        'status_url': f"/cores/install/{job['id']}"
+    }), 202
 
-        if result.stdout:
-            for line in result.stdout.strip().split('\n'):
-                if line.strip():
-                    log(line)
-        if result.stderr:
-            for line in result.stderr.strip().split('\n'):
-                if line.strip():
-                    log(line)
 
-        if result.returncode == 0:
-            log('✓ Core esp32:esp32 instalado correctamente')
-            return jsonify({'ok': True, 'logs': logs, 'message': 'Core ESP32 instalado. Intenta verificar/subir de nuevo.'})
+@app.route('/cores/install/<job_id>', methods=['GET', 'OPTIONS'])
+def core_install_status(job_id):
+    """Estado de un job de instalación: { state: queued|running|done|failed, step, logs, error }."""
+    job = _core_install_jobs.get(job_id)
+    if job is None:
         return jsonify({
-            'ok': False,
-            'error': result.stderr or result.stdout or 'Error desconocido',
-            'logs': logs
-        }), 500
-    except subprocess.TimeoutExpired:
-        log('Tiempo de espera agotado')
-        return jsonify({'ok': False, 'error': 'La instalación tardó demasiado (timeout 5 min)', 'logs': logs}), 500
-    except Exception as e:
-        log(f'Error: {e}')
-        return jsonify({'ok': False, 'error': str(e), 'logs': logs}), 500
+            'ok': False, 'error': f'job_id "{job_id}" no encontrado o expirado',
+            'error_code': 'JOB_NOT_FOUND'
+        }), 404
+    return jsonify({'ok': True, 'job': _core_install_view(job)})
 
 
 @app.route('/boards', methods=['GET', 'OPTIONS'])
@@ -1072,45 +3492,44 @@ def list_boards():
         }
     """
     boards = _load_boards_registry()
-    return jsonify({
-        'ok': True,
-        'boards': boards
-    })
-
-# ============================================
-# ENDPOINT: POST /compile
-# ============================================
-
-@app.route('/compile', methods=['POST', 'OPTIONS'])
-def compile_code():
-    """
-    Compila código Arduino sin subirlo.
-    
-    Request body:
-        { "fqbn", "sketch": { "code"? | "files"? }, "options"? }
-        Retrocompat: { "code", "fqbn" } → sketch.code
-    
-    Response:
-        {
-            "ok": true/false,
-            "fqbn": "...",
-            "family": "avr" | "esp32",
-            "artifacts": [{ "name", "type", "path", "sha256", "size" }],
-            "compile_log": "...",
-            "logs": [...], "size": N, "message": "..."  (retrocompat)
-        }
+    return jsonify({
+        'ok': True,
+        'boards': boards
+    })
+
+# ============================================
+# ENDPOINT: POST /compile
+# ============================================
+
+def _compile_priority(data):
+    """Una compilación que va a subirse (return_job_id / for_upload) pasa antes que un 'Verificar'."""
+    options = data.get('options') or {}
+    intent = data.get('return_job_id') or data.get('for_upload') or options.get('return_job_id')
+    return 'upload' if intent else 'verify'
+
+
+@_with_request_metrics('compile')
+@_with_cli_priority(_compile_priority)
+def _compile_request(data, logs, job_id=None):
+    """
+    Lógica de POST /compile, compartida por el endpoint síncrono y los jobs asíncronos.
+    logs: lista donde se van agregando las líneas (visible mientras compila).
+    job_id: si se indica, el resultado se registra para upload con ese mismo id.
+    Returns: (payload dict, status HTTP)
     """
-    logs = []
     temp_dir = None
+    flight = None
+    joined = None
     
     def log(msg):
         timestamp = datetime.now().strftime('%H:%M:%S')
         log_entry = f"[{timestamp}] {msg}"
         logs.append(log_entry)
+        _stream_emit('log', {'line': log_entry})
         print(f"[COMPILE] {msg}")
     
     def err_resp(msg, status=400):
-        return jsonify({'ok': False, 'error': msg, 'logs': logs}), status
+        return {'ok': False, 'error': msg, 'logs': logs}, status
     
     try:
         if not ARDUINO_CLI:
@@ -1119,7 +3538,6 @@ def compile_code():
                 500
             )
         
-        data = request.get_json()
         if not data:
             return err_resp('JSON body requerido')
         
@@ -1134,6 +3552,7 @@ def compile_code():
         family = board.get('family', 'avr')
 
         # Asegurar que el core necesario esté instalado (esp32:esp32 o arduino:avr)
+        _set_phase('preparing')
         core_ok, core_err = ensure_core_for_fqbn(fqbn, log)
         if not core_ok:
             hint_esp32 = ''
@@ -1152,104 +3571,140 @@ def compile_code():
         if not code and not files:
             return err_resp('No hay código para compilar (sketch.code o sketch.files requerido)')
         
-        # Directorio temporal aislado por request
-        if ARDUINO_CLI and 'snap' in ARDUINO_CLI:
-            home_tmp = os.path.join(os.path.expanduser('~'), 'snap', 'arduino-cli', 'common', 'maxide-tmp')
-        else:
-            home_tmp = os.path.join(os.path.expanduser('~'), '.maxide-agent', 'tmp')
-        os.makedirs(home_tmp, exist_ok=True)
-        temp_dir = tempfile.mkdtemp(prefix='compile_', dir=home_tmp)
-        
+        # sketch → {nombre: contenido}
         sketch_name = 'sketch_verify'
-        sketch_dir = os.path.join(temp_dir, sketch_name)
-        os.makedirs(sketch_dir)
-        
         if files and isinstance(files, dict):
-            for fname, content in files.items():
-                if not fname or content is None:
-                    continue
-                fpath = os.path.join(sketch_dir, fname)
-                os.makedirs(os.path.dirname(fpath) or '.', exist_ok=True)
-                with open(fpath, 'w', encoding='utf-8') as f:
-                    f.write(str(content))
-            log(f"Sketch creado desde {len(files)} archivo(s)")
+            sketch_files = {
+                fname: str(content) for fname, content in files.items()
+                if fname and content is not None
+            }
         else:
             main_ino = f'{sketch_name}.ino'
             if files and isinstance(files, list):
                 main_ino = next((f for f in files if f.endswith('.ino')), main_ino)
-            out_code = code if code else 'void setup() {} void loop() {}'
-            with open(os.path.join(sketch_dir, main_ino), 'w', encoding='utf-8') as f:
-                f.write(out_code)
-            log(f"Sketch creado: {len(code)} caracteres")
-        
-        build_dir = os.path.join(temp_dir, 'build')
-        os.makedirs(build_dir)
-        
-        compile_cmd = [
-            ARDUINO_CLI, 'compile',
-            '--fqbn', fqbn,
-            '--output-dir', build_dir,
-            sketch_dir
-        ]
-        if family == 'esp32':
-            lib_servo = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libraries', 'Servo')
-            if os.path.isdir(lib_servo):
-                compile_cmd.insert(-1, '--library')
-                compile_cmd.insert(-1, lib_servo)
-        
+            sketch_files = {main_ino: code if code else 'void setup() {} void loop() {}'}
+
+        # Argumentos adicionales (forman parte de la clave de caché)
+        extra_args = _library_args_for_sketch(fqbn, sketch_files, log)
         options = data.get('options') or {}
         if options.get('warnings') == 'all':
-            compile_cmd.append('--warnings')
-            compile_cmd.append('all')
-        
+            extra_args.extend(['--warnings', 'all'])
+
+        home_tmp = _get_home_tmp()
+        os.makedirs(home_tmp, exist_ok=True)
+
+        t_start = time.time()
+        cache_key = _compile_cache_key(sketch_files, fqbn, extra_args)
+        cached = _compile_cache_get(cache_key)
         tag = '[ESP32]' if family == 'esp32' else '[AVR]'
-        log(f"{tag} Compilando para {fqbn} (family={family})")
-        
-        compile_result = subprocess.run(
-            compile_cmd,
-            capture_output=True,
-            text=True,
-            timeout=120
-        )
-        
-        if compile_result.stdout:
-            for line in compile_result.stdout.strip().split('\n'):
-                if line.strip():
-                    logs.append(f"[stdout] {line}")
-        if compile_result.stderr:
-            for line in compile_result.stderr.strip().split('\n'):
-                if line.strip():
-                    logs.append(f"[stderr] {line}")
-        
-        if compile_result.returncode != 0:
-            error_msg = compile_result.stderr or compile_result.stdout or 'Error desconocido'
-            log(f"Error de compilación (exit code: {compile_result.returncode})")
-            # Mensajes específicos según familia
-            hint = None
-            if family == 'esp32':
-                hint = 'ESP32: Verifica que el core esté instalado (arduino-cli core install esp32:esp32)'
-                if 'platform' in error_msg.lower() or 'package' in error_msg.lower() or 'unknown' in error_msg.lower():
-                    hint = 'ESP32: Instala el core con: arduino-cli core install esp32:esp32'
-            elif family == 'avr':
-                hint = 'AVR: Verifica sintaxis y que el sketch tenga setup() y loop()'
-            return jsonify({
-                'ok': False,
-                'error': error_msg,
-                'logs': logs,
-                'exit_code': compile_result.returncode,
-                'fqbn': fqbn,
-                'family': family,
-                'compile_log': '\n'.join(logs),
-                'hint': hint
-            }), 400
-        
-        # Detectar artefactos (AVR: .hex, ESP32: .bin)
-        artifacts = _collect_artifacts(build_dir, family, include_base64=False)
+
+        deduplicated = shared = False
+        if not cached:
+            flight, leader = _compile_flight_join(cache_key, logs)
+            if not leader:
+                log(f"{tag} Compilación idéntica en curso (clave {cache_key[:12]}), esperando su resultado")
+                joined, flight = flight, None
+                shared_error = _compile_flight_wait(joined, logs)
+                with _compile_cache_lock:
+                    _compile_cache_stats['deduplicated'] += 1
+                _metric_inc('maxide_compile_deduplicated_total', {'family': family})
+                if shared_error is not None:
+                    return dict(shared_error, deduplicated=True,
+                                timings={'total_sec': round(time.time() - t_start, 3), 'deduplicated': True}), 400
+                cached = _compile_cache_get(cache_key)
+                if not cached:
+                    cached = _compile_flight_result(joined)
+                    shared = bool(cached)
+                deduplicated = bool(cached)
+                if not cached:
+                    log(f"{tag} Sin resultado compartido, compilando")
+
+        timings = {}
+        if cached:
+            build_dir = cached['entry_dir']
+            artifacts = cached['artifacts']
+            compile_log = cached.get('compile_log', '')
+            elapsed_ms = int((time.time() - t_start) * 1000)
+            origin = 'compartida' if shared else 'desde caché'
+            log(f"{tag} Compilación {origin} para {fqbn} ({elapsed_ms} ms, clave {cache_key[:12]})")
+        else:
+            # Directorio temporal aislado por request (solo para los artefactos)
+            temp_dir = tempfile.mkdtemp(prefix='compile_', dir=home_tmp)
+            build_dir = os.path.join(temp_dir, 'build')
+            os.makedirs(build_dir)
+
+            if files and isinstance(files, dict):
+                log(f"Sketch creado desde {len(files)} archivo(s)")
+            else:
+                log(f"Sketch creado: {len(code)} caracteres")
+
+            log(f"{tag} Compilando para {fqbn} (family={family})")
+            _set_phase('compiling')
+
+            compile_result = _compile_sketch(fqbn, sketch_files, build_dir, extra_args, log,
+                                             project=_warm_slot_project(data), sketch_name=sketch_name,
+                                             timings=timings)
+            timings['total_sec'] = round(time.time() - t_start, 3)
+            if timings.get('phases'):
+                queued = f"cola {timings['queue_wait_sec']:.2f}s | " if timings.get('queue_wait_sec') else ''
+                log("⏱ Fases: " + queued + ' | '.join(f"{p} {sec:.2f}s" for p, sec in timings['phases'].items()
+                                                      if p not in timings['reused']) + f" | total {timings['total_sec']:.2f}s")
+
+            if compile_result.stdout:
+                for line in compile_result.stdout.strip().split('\n'):
+                    if line.strip():
+                        logs.append(f"[stdout] {line}")
+            if compile_result.stderr:
+                for line in compile_result.stderr.strip().split('\n'):
+                    if line.strip():
+                        logs.append(f"[stderr] {line}")
+
+            if compile_result.returncode != 0:
+                error_msg = compile_result.stderr or compile_result.stdout or 'Error desconocido'
+                log(f"Error de compilación (exit code: {compile_result.returncode})")
+                # Mensajes específicos según familia
+                hint = None
+                if family == 'esp32':
+                    hint = 'ESP32: Verifica que el core esté instalado (arduino-cli core install esp32:esp32)'
+                    if 'platform' in error_msg.lower() or 'package' in error_msg.lower() or 'unknown' in error_msg.lower():
+                        hint = 'ESP32: Instala el core con: arduino-cli core install esp32:esp32'
+                elif family == 'avr':
+                    hint = 'AVR: Verifica sintaxis y que el sketch tenga setup() y loop()'
+                error_payload = {
+                    'ok': False,
+                    'error': error_msg,
+                    'logs': logs,
+                    'exit_code': compile_result.returncode,
+                    'fqbn': fqbn,
+                    'family': family,
+                    'compile_log': '\n'.join(logs),
+                    'hint': hint,
+                    'timings': timings
+                }
+                if flight is not None:
+                    flight['error'] = dict(error_payload)
+                return error_payload, 400
+
+            # Detectar artefactos (AVR: .hex, ESP32: .bin)
+            _set_phase('collecting')
+            artifacts = _collect_artifacts(build_dir, family, include_base64=False)
+            total_size = sum(a['size'] for a in artifacts)
+            log(f"✓ Compilación exitosa ({total_size} bytes, {len(artifacts)} artefacto(s))")
+            compile_log = '\n'.join(logs)
+            if artifacts:
+                _compile_cache_put(cache_key, artifacts, compile_log, list(logs), fqbn, family)
+                if flight is not None:
+                    # Las peticiones en espera leen del build aunque la caché no lo guarde;
+                    # el temp_dir pasa a ser del flight (lo borra el último en soltarlo)
+                    flight['result'] = {'artifacts': artifacts, 'compile_log': compile_log, 'temp_dir': temp_dir}
+                    temp_dir = None
+            _record_compile_timings(fqbn, timings)
+
+        if cached:
+            timings = {'total_sec': round(time.time() - t_start, 3), 'cached': not shared}
+            if deduplicated:
+                timings['deduplicated'] = True
         total_size = sum(a['size'] for a in artifacts)
-        
-        log(f"✓ Compilación exitosa ({total_size} bytes, {len(artifacts)} artefacto(s))")
-        
-        compile_log = '\n'.join(logs)
         resp_data = {
             'ok': True,
             'fqbn': fqbn,
@@ -1259,67 +3714,431 @@ def compile_code():
             'message': 'Compilación exitosa',
             'logs': logs,
             'size': total_size,
+            'cached': bool(cached) and not shared,
+            'cache_key': cache_key,
+            'deduplicated': deduplicated,
+            'timings': timings,
         }
         # return_job_id: guardar build_dir para upload posterior sin reenviar artifacts
-        if data.get('return_job_id') or (data.get('options') or {}).get('return_job_id'):
-            jobs_base = os.path.join(home_tmp, 'jobs')
+        if job_id or data.get('return_job_id') or (data.get('options') or {}).get('return_job_id'):
+            jobs_base = _get_upload_jobs_dir()
             os.makedirs(jobs_base, exist_ok=True)
-            job_id = _store_upload_job(build_dir, family, fqbn)
+            job_id = job_id or str(uuid.uuid4())[:12]
             job_dir = os.path.join(jobs_base, job_id)
-            os.makedirs(job_dir, exist_ok=True)
-            # Copiar todo el árbol de build (AVR: .hex; ESP32: .bin en posible subdir)
-            for item in os.listdir(build_dir):
-                src = os.path.join(build_dir, item)
-                dst = os.path.join(job_dir, item)
-                if os.path.isfile(src):
-                    shutil.copy2(src, dst)
-                elif os.path.isdir(src):
-                    shutil.copytree(src, dst)
-            _upload_job_store[job_id]['build_dir'] = job_dir
+            # Solo los artefactos flasheables: rename desde el build temporal,
+            # hardlink desde la caché (sin copiar megabytes de intermedios)
+            artifacts = _handoff_job_artifacts(artifacts, job_dir, move=not cached and flight is None)
+            resp_data['artifacts'] = [dict(a, url=_artifact_url(job_id, a['name'])) for a in artifacts]
+            _store_upload_job(job_dir, family, fqbn, job_id)
             resp_data['job_id'] = job_id
-        return jsonify(resp_data)
+        return resp_data, 200
         
+    except CompileCancelled:
+        log("Compilación cancelada")
+        return {
+            'ok': False,
+            'error': 'Compilación cancelada',
+            'error_code': 'CANCELLED',
+            'logs': logs
+        }, 409
+
     except subprocess.TimeoutExpired:
         log("Timeout de compilación (120s)")
-        return jsonify({
+        return {
             'ok': False,
             'error': 'Timeout de compilación',
             'logs': logs,
             'hint': 'La compilación tardó más de 2 minutos.'
-        }), 408
+        }, 408
         
     except Exception as e:
         log(f"Error inesperado: {str(e)}")
-        return jsonify({
+        return {
             'ok': False,
             'error': str(e),
             'logs': logs
-        }), 500
+        }, 500
         
     finally:
+        # Después de _compile_cache_put: las peticiones en espera ya encuentran los artefactos
+        if flight is not None:
+            _compile_flight_finish(cache_key, flight)
+            _compile_flight_release(flight)
+        if joined is not None:
+            _compile_flight_release(joined)
         if temp_dir and os.path.exists(temp_dir):
             try:
                 shutil.rmtree(temp_dir)
             except Exception as e:
                 print(f"[COMPILE] Error limpiando temp: {e}")
 
+
+@app.route('/compile', methods=['POST', 'OPTIONS'])
+def compile_code():
+    """
+    Compila código Arduino sin subirlo.
+    
+    Request body:
+        { "fqbn", "sketch": { "code"? | "files"? }, "options"? }
+        Retrocompat: { "code", "fqbn" } → sketch.code
+    
+    Response:
+        {
+            "ok": true/false,
+            "fqbn": "...",
+            "family": "avr" | "esp32",
+            "artifacts": [{ "name", "type", "path", "sha256", "size" }],
+            "compile_log": "...",
+            "cached": bool, "cache_key": "...",  (cached=true → artefactos y log desde caché)
+            "deduplicated": bool,  (true → resultado de una compilación idéntica que ya estaba en curso)
+            "logs": [...], "size": N, "message": "..."  (retrocompat)
+        }
+    """
+    payload, status = _compile_request(request.get_json(silent=True), [])
+    return jsonify(payload), status
+
+
+# ============================================
+# ENDPOINT: /compile/jobs (cola asíncrona)
+# ============================================
+# POST devuelve un job_id al instante; un pool acotado de workers compila;
+# GET consulta estado/progreso; DELETE mata el árbol de procesos de arduino-cli.
+# Un job terminado con éxito queda registrado para POST /upload {job_id}.
+
+COMPILE_WORKERS = 2        # compilaciones simultáneas (--compile-workers)
+COMPILE_QUEUE_MAX = 16     # jobs en espera antes de responder 503
+COMPILE_JOBS_KEEP = 50     # jobs terminados que se conservan para consulta
+_COMPILE_JOB_FINISHED = ('done', 'failed', 'cancelled')
+
+_compile_jobs = OrderedDict()
+_compile_jobs_lock = threading.Lock()
+_compile_executor = None
+_compile_durations = {}  # fqbn -> segundos de la última compilación real (estimación de progreso)
+
+
+def _get_compile_executor():
+    """Pool de workers (se crea con COMPILE_WORKERS la primera vez). Llamar con el lock tomado."""
+    global _compile_executor
+    if _compile_executor is None:
+        _compile_executor = ThreadPoolExecutor(max_workers=max(1, COMPILE_WORKERS), thread_name_prefix='compile')
+    return _compile_executor
+
+
+def _prune_compile_jobs():
+    """Olvida jobs terminados expirados o que exceden COMPILE_JOBS_KEEP. Llamar con el lock tomado."""
+    now = time.time()
+    finished = [jid for jid, j in _compile_jobs.items() if j['status'] in _COMPILE_JOB_FINISHED]
+    for jid in finished:
+        if now - _compile_jobs[jid]['finished_at'] > JOB_TTL_SEC:
+            del _compile_jobs[jid]
+    finished = [jid for jid in finished if jid in _compile_jobs]
+    for jid in finished[:max(0, len(finished) - COMPILE_JOBS_KEEP)]:
+        del _compile_jobs[jid]
+
+
+def _run_compile_job(job_id):
+    """Worker: ejecuta _compile_request para un job encolado."""
+    with _compile_jobs_lock:
+        job = _compile_jobs.get(job_id)
+        if job is None or job['status'] != 'queued':
+            return
+        job['status'] = 'running'
+        job['started_at'] = time.time()
+        job['phase'] = 'preparing'
+
+    _cli_context.job = job
+    try:
+        payload, http_status = _compile_request(job['request'], job['logs'], job_id=job_id)
+    except Exception as e:
+        payload, http_status = {'ok': False, 'error': str(e), 'logs': job['logs']}, 500
+    finally:
+        _cli_context.job = None
+
+    with _compile_jobs_lock:
+        job['finished_at'] = time.time()
+        job['result'] = payload
+        job['http_status'] = http_status
+        job['request'] = None  # liberar el código del sketch
+        if payload.get('ok'):
+            job['status'] = 'done'
+            if not payload.get('cached'):
+                _compile_durations[payload.get('fqbn')] = job['finished_at'] - job['started_at']
+        elif job['cancel_requested'] or payload.get('error_code') == 'CANCELLED':
+            job['status'] = 'cancelled'
+        else:
+            job['status'] = 'failed'
+        job['phase'] = job['status']
+    print(f"[JOBS] Job {job_id}: {job['status']}")
+
+
+def _compile_job_view(job):
+    """Representación JSON de un job. Llamar con el lock tomado."""
+    now = time.time()
+    view = {
+        'ok': True,
+        'job_id': job['id'],
+        'status': job['status'],
+        'phase': job['phase'],
+        'fqbn': job['fqbn'],
+        'created_at': job['created_at'],
+        'elapsed_sec': round((job['finished_at'] or now) - job['started_at'], 2) if job['started_at'] else 0.0,
+        'output_lines': job['output_lines'],
+        'last_line': job['last_line'],
+        'progress': None,
+        'logs': job['logs'][-50:],
+    }
+    if job['status'] == 'queued':
+        queued = [j for j in _compile_jobs.values() if j['status'] == 'queued']
+        view['queue_position'] = queued.index(job) + 1
+        view['progress'] = 0.0
+    elif job['status'] == 'running':
+        expected = _compile_durations.get(job['fqbn'])
+        if expected:
+            view['progress'] = round(min(0.95, (now - job['started_at']) / expected), 2)
+    else:
+        view['progress'] = 1.0
+        view['result'] = job['result']
+    return view
+
+
+@app.route('/compile/jobs', methods=['POST', 'OPTIONS'])
+def create_compile_job():
+    """
+    Encola una compilación. Mismo body que POST /compile.
+    
+    Response (202): { "ok": true, "job_id": "...", "status": "queued", "status_url": "/compile/jobs/<id>" }
+    503 QUEUE_FULL si hay demasiados jobs pendientes.
+    """
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'ok': False, 'error': 'JSON body requerido'}), 400
+
+    with _compile_jobs_lock:
+        _prune_compile_jobs()
+        pending = sum(1 for j in _compile_jobs.values() if j['status'] in ('queued', 'running'))
+        if pending >= max(1, COMPILE_WORKERS) + COMPILE_QUEUE_MAX:
+            return jsonify({
+                'ok': False, 'error': 'Demasiadas compilaciones en cola. Intenta de nuevo en unos segundos.',
+                'error_code': 'QUEUE_FULL'
+            }), 503
+        job_id = str(uuid.uuid4())[:12]
+        job = _new_cli_job()
+        job.update({
+            'id': job_id,
+            'status': 'queued',
+            'phase': 'queued',
+            'fqbn': data.get('fqbn') or data.get('board') or 'arduino:avr:uno',
+            'request': data,
+            'logs': [],
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'http_status': None,
+        })
+        _compile_jobs[job_id] = job
+        job['future'] = _get_compile_executor().submit(_run_compile_job, job_id)
+
+    return jsonify({
+        'ok': True, 'job_id': job_id, 'status': 'queued',
+        'status_url': f'/compile/jobs/{job_id}'
+    }), 202
+
+
+@app.route('/compile/jobs/<job_id>', methods=['GET', 'DELETE', 'OPTIONS'])
+def compile_job(job_id):
+    """
+    GET: estado y progreso { status: queued|running|done|failed|cancelled, phase, progress,
+         queue_position?, output_lines, last_line, logs, result? }
+    DELETE: cancela el job (si está compilando, mata arduino-cli y sus hijos).
+    """
+    with _compile_jobs_lock:
+        job = _compile_jobs.get(job_id)
+        if job is None:
+            return jsonify({
+                'ok': False, 'error': f'job_id "{job_id}" no encontrado o expirado',
+                'error_code': 'JOB_NOT_FOUND'
+            }), 404
+
+        if request.method == 'DELETE' and job['status'] not in _COMPILE_JOB_FINISHED:
+            job['cancel_requested'] = True
+            if job['status'] == 'queued' and job['future'].cancel():
+                job['status'] = job['phase'] = 'cancelled'
+                job['finished_at'] = time.time()
+                job['request'] = None
+                job['result'] = {'ok': False, 'error': 'Compilación cancelada', 'error_code': 'CANCELLED'}
+            elif job['proc'] is not None:
+                _kill_process_tree(job['proc'])
+            print(f"[JOBS] Cancelación solicitada para {job_id}")
+
+        return jsonify(_compile_job_view(job))
+
+
+# ============================================
+# DESCARGAS DE ARTEFACTOS (sesión HTTP compartida + caché por sha256)
+# ============================================
+# Los artefactos por URL (HEX/bin compilados en el servidor) se bajan con una sola
+# requests.Session: conexiones keep-alive reutilizadas y reintentos acotados ante fallos
+# de red o 5xx. Cada descarga queda en <home_tmp>/downloads con su sha256 como nombre.
+# Si el descriptor trae sha256 y ese contenido ya está en la caché, el upload no toca la
+# red (reintentos y re-uploads del mismo HEX). Sin sha256 se descarga siempre: la misma
+# URL puede servir otro binario.
+
+DOWNLOAD_TIMEOUT_SEC = 30
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+_http_session = None
+_http_session_lock = threading.Lock()
+_download_cache_lock = threading.Lock()
+_download_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+_SHA256_RE = re.compile(r'^[0-9a-fA-F]{64}$')
+
+
+def _get_http_session():
+    """requests.Session compartida (pool keep-alive + reintentos con backoff)."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=DOWNLOAD_RETRIES, backoff_factor=0.5,
+                          status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def _get_download_cache_dir():
+    return os.path.join(_get_home_tmp(), 'downloads')
+
+
+def _download_cache_store(src, digest):
+    """Copia src a la caché (atómico) y recorta por LRU (mtime) hasta DOWNLOAD_CACHE_MAX_BYTES."""
+    cache_dir = _get_download_cache_dir()
+    tmp = os.path.join(cache_dir, f'.{digest}.{uuid.uuid4().hex}.tmp')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, os.path.join(cache_dir, digest))
+    except OSError as e:
+        print(f"[DOWNLOAD] No se pudo guardar en caché: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return
+    with _download_cache_lock:
+        entries = []
+        for entry in os.scandir(cache_dir):
+            if entry.is_file() and _SHA256_RE.match(entry.name):
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.path, st.st_size))
+        entries.sort()
+        total = sum(size for _mtime, _path, size in entries)
+        for _mtime, path, size in entries:
+            if total <= DOWNLOAD_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                _download_cache_stats['evictions'] += 1
+            except OSError:
+                pass
+
+
+def _download_artifact(url, dest, expected_sha256=None):
+    """
+    Deja en dest el contenido de url. Con expected_sha256 se sirve de la caché si ya lo
+    tiene (sin red) y se rechaza una descarga cuyo hash no coincide.
+    Returns: (bytes, from_cache). Lanza requests.RequestException o ValueError (hash).
+    """
+    expected = str(expected_sha256).lower() if _SHA256_RE.match(str(expected_sha256 or '')) else None
+    if expected:
+        cached = os.path.join(_get_download_cache_dir(), expected)
+        with _download_cache_lock:
+            try:
+                os.utime(cached, None)  # LRU
+                shutil.copyfile(cached, dest)
+                hit = True
+            except OSError:
+                hit = False
+            _download_cache_stats['hits' if hit else 'misses'] += 1
+        if hit:
+            _metric_inc('maxide_artifact_downloads_total', {'source': 'cache'})
+            return os.path.getsize(dest), True
+    else:
+        with _download_cache_lock:
+            _download_cache_stats['misses'] += 1
+    _metric_inc('maxide_artifact_downloads_total', {'source': 'network'})
+    digest = hashlib.sha256()
+    total = 0
+    resp = _get_http_session().get(url, timeout=DOWNLOAD_TIMEOUT_SEC, stream=True)
+    try:
+        resp.raise_for_status()
+        with open(dest, 'wb') as f:
+            for chunk in resp.iter_content(8192):
+                if chunk:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    total += len(chunk)
+    finally:
+        resp.close()
+    digest = digest.hexdigest()
+    if expected and digest != expected:
+        os.remove(dest)
+        raise ValueError(f"sha256 no coincide (esperado {expected[:12]}, recibido {digest[:12]})")
+    if total:
+        _download_cache_store(dest, digest)
+    return total, False
+
+
+def get_download_cache_status():
+    """Estado de la caché de descargas para /health."""
+    with _download_cache_lock:
+        entries = 0
+        total = 0
+        try:
+            for entry in os.scandir(_get_download_cache_dir()):
+                if entry.is_file() and _SHA256_RE.match(entry.name):
+                    entries += 1
+                    total += entry.stat().st_size
+        except OSError:
+            pass
+        return dict(_download_cache_stats, entries=entries, bytes=total, max_bytes=DOWNLOAD_CACHE_MAX_BYTES)
+
+
 # ============================================
 # HELPERS - Upload
 # ============================================
 
 def _port_exists(port):
-    """Verifica si el puerto existe en la lista de puertos disponibles."""
+    """
+    Verifica si el puerto existe según la tabla del watcher. Si no aparece, reescanea
+    una vez (la placa pudo conectarse después del último escaneo).
+    """
     if not port:
         return False
     port_str = str(port).strip()
-    try:
-        for p in serial.tools.list_ports.comports():
-            dev = getattr(p, 'device', None) or ''
+
+    def _match(snapshot):
+        for dev in snapshot['all_devices']:
             if dev == port_str:
                 return True
             if platform.system() == 'Windows' and dev.lower() == port_str.lower():
                 return True
         return False
+
+    try:
+        if _match(_get_ports_snapshot()):
+            return True
+        _refresh_ports()
+        with _ports_cond:
+            return _match(_ports_state)
     except Exception:
         return False
 
@@ -1363,15 +4182,10 @@ def _resolve_hex_for_upload(data, temp_dir, log_func):
                     return None, f"Artifact base64 inválido: {e}"
             if art.get('url'):
                 try:
-                    resp = requests.get(art['url'], timeout=30, stream=True)
-                    resp.raise_for_status()
                     hex_path = os.path.join(temp_dir, 'firmware.hex')
-                    with open(hex_path, 'wb') as f:
-                        for chunk in resp.iter_content(8192):
-                            if chunk:
-                                f.write(chunk)
-                    if os.path.getsize(hex_path) > 0:
-                        log_func(f"Usando artifact desde URL ({os.path.getsize(hex_path)} bytes)")
+                    size, cached = _download_artifact(art['url'], hex_path, art.get('sha256'))
+                    if size > 0:
+                        log_func(f"Usando artifact desde {'caché (sin descargar)' if cached else 'URL'} ({size} bytes)")
                         return hex_path, None
                 except Exception as e:
                     log_func(f"Error descargando artifact URL: {e}")
@@ -1381,15 +4195,10 @@ def _resolve_hex_for_upload(data, temp_dir, log_func):
     hex_url = data.get('hex_url')
     if hex_url:
         try:
-            resp = requests.get(hex_url, timeout=30, stream=True)
-            resp.raise_for_status()
             hex_path = os.path.join(temp_dir, 'firmware.hex')
-            with open(hex_path, 'wb') as f:
-                for chunk in resp.iter_content(8192):
-                    if chunk:
-                        f.write(chunk)
-            if os.path.getsize(hex_path) > 0:
-                log_func(f"HEX descargado desde URL ({os.path.getsize(hex_path)} bytes)")
+            size, cached = _download_artifact(hex_url, hex_path, data.get('hex_sha256'))
+            if size > 0:
+                log_func(f"HEX {'desde caché (sin descargar)' if cached else 'descargado desde URL'} ({size} bytes)")
                 return hex_path, None
             return None, "Archivo HEX vacío"
         except Exception as e:
@@ -1398,17 +4207,13 @@ def _resolve_hex_for_upload(data, temp_dir, log_func):
     # 3) code (compilar localmente)
     code = data.get('code')
     if code and code.strip():
-        sketch_dir = os.path.join(temp_dir, 'sketch_upload')
-        os.makedirs(sketch_dir)
-        with open(os.path.join(sketch_dir, 'sketch_upload.ino'), 'w', encoding='utf-8') as f:
-            f.write(code)
         build_dir = os.path.join(temp_dir, 'build')
         os.makedirs(build_dir)
-        r = subprocess.run(
-            [ARDUINO_CLI, 'compile', '--fqbn', data.get('fqbn', 'arduino:avr:uno'),
-             '--output-dir', build_dir, sketch_dir],
-            capture_output=True, text=True, timeout=120
-        )
+        # Mismo slot persistente que /compile: tras "Verificar", "Subir" es incremental
+        fqbn = data.get('fqbn', 'arduino:avr:uno')
+        sketch_files = {'sketch_verify.ino': code}
+        r = _compile_sketch(fqbn, sketch_files, build_dir, _library_args_for_sketch(fqbn, sketch_files, log_func),
+                            log_func, project=_warm_slot_project(data))
         if r.returncode != 0:
             return None, (r.stderr or r.stdout or 'Error de compilación')[:500]
         for f in os.listdir(build_dir):
@@ -1419,35 +4224,54 @@ def _resolve_hex_for_upload(data, temp_dir, log_func):
     return None, "Se requiere artifact(s), hex_url o code"
 
 
+@_with_upload_metrics('avr')
 def _do_upload_avr(port, fqbn, hex_file, log_func):
     """
     Ejecuta upload AVR con arduino-cli upload -p <port> --fqbn <fqbn> --input-file <hex>.
+    Antes de cada intento espera a que el puerto se pueda abrir (sin sleeps fijos) y
+    registra en el log el tiempo de cada etapa.
     Returns: (ok: bool, error_code: str|None, hint: str|None)
     """
-    log_func("Limpiando puerto serial antes de upload...")
+    t_total = time.time()
+    timings = []
+
+    def stage_done(name, t_start):
+        timings.append(f"{name} {(time.time() - t_start) * 1000:.0f} ms")
+
+    def log_timings():
+        log_func(f"⏱ Etapas: {' | '.join(timings)} | total {(time.time() - t_total):.2f} s")
+
+    t = time.time()
     reset_serial_port(port, log_func)
-    time.sleep(0.3)
+    stage_done('preparar puerto', t)
 
     upload_cmd = [ARDUINO_CLI, 'upload', '-p', port, '--fqbn', fqbn, '--input-file', hex_file, '-v']
     MAX_RETRIES = 2
     for attempt in range(MAX_RETRIES + 1):
         if attempt > 0:
             log_func(f"Reintento {attempt}/{MAX_RETRIES}...")
-            time.sleep(1.5)
+            _metric_inc('maxide_upload_retries_total', {'family': 'avr'})
+            t = time.time()
             reset_serial_port(port, log_func)
-            time.sleep(0.5)
+            stage_done(f'esperar puerto #{attempt + 1}', t)
         log_func(f"Ejecutando: {' '.join(upload_cmd)}")
+        t = time.time()
         try:
-            r = subprocess.run(upload_cmd, capture_output=True, text=True, timeout=120)
+            r = _run_cli(upload_cmd, 120)
         except subprocess.TimeoutExpired:
+            stage_done(f'upload #{attempt + 1}', t)
+            log_timings()
             return False, 'TIMEOUT', 'Timeout durante el upload. Verifica la conexión y reinicia el Arduino.'
+        stage_done(f'upload #{attempt + 1}', t)
         if r.returncode == 0:
+            log_timings()
             return True, None, None
         err = (r.stderr + r.stdout).lower()
         if any(x in err for x in ['busy', 'in use', 'resource busy', 'com-state', 'timeout', "can't open device"]) and attempt < MAX_RETRIES:
             continue
         break
 
+    log_timings()
     out = r.stderr + r.stdout
     err_lower = out.lower()
     if "can't set com-state" in err_lower or 'com-state' in err_lower:
@@ -1539,84 +4363,442 @@ def _resolve_bin_for_upload_esp32(data, temp_dir, log_func):
     elif not isinstance(artifacts, list):
         artifacts = []
 
-    esp32_bin_dir = os.path.join(temp_dir, 'esp32_bin')
-    os.makedirs(esp32_bin_dir, exist_ok=True)
-    has_firmware = False
+    esp32_bin_dir = os.path.join(temp_dir, 'esp32_bin')
+    os.makedirs(esp32_bin_dir, exist_ok=True)
+    has_firmware = False
+
+    for art in artifacts:
+        if not isinstance(art, dict):
+            continue
+        name = art.get('name', '')
+        if not name.endswith('.bin'):
+            continue
+        out_path = os.path.join(esp32_bin_dir, name)
+        if art.get('path') and os.path.isfile(art['path']):
+            shutil.copy2(art['path'], out_path)
+            if 'firmware' in name.lower():
+                has_firmware = True
+            log_func(f"Artifact {name} desde path")
+        elif art.get('content_base64'):
+            try:
+                with open(out_path, 'wb') as f:
+                    f.write(base64.b64decode(art['content_base64']))
+                if 'firmware' in name.lower():
+                    has_firmware = True
+                log_func(f"Artifact {name} desde base64")
+            except Exception as e:
+                log_func(f"Error artifact {name}: {e}")
+        elif art.get('url'):
+            try:
+                size, cached = _download_artifact(art['url'], out_path, art.get('sha256'))
+                if size > 0 and 'firmware' in name.lower():
+                    has_firmware = True
+                log_func(f"Artifact {name} desde {'caché (sin descargar)' if cached else 'URL'}")
+            except Exception as e:
+                log_func(f"Error descargando {name}: {e}")
+
+    if has_firmware:
+        return esp32_bin_dir, None
+
+    # 3) code - compilar
+    code = data.get('code')
+    if code and code.strip():
+        fqbn = data.get('fqbn', 'esp32:esp32:esp32')
+        build_dir = os.path.join(temp_dir, 'build_esp32')
+        os.makedirs(build_dir)
+        sketch_files = {'sketch_verify.ino': code}
+        extra_args = _library_args_for_sketch(fqbn, sketch_files, log_func)
+        try:
+            r = _compile_sketch(fqbn, sketch_files, build_dir, extra_args, log_func,
+                                project=_warm_slot_project(data))
+            if r.returncode != 0:
+                return None, (r.stderr or r.stdout or 'Error de compilación')[:500]
+            if any(f.endswith('.bin') for f in os.listdir(build_dir)):
+                log_func("Compilación ESP32 exitosa")
+                return build_dir, None
+            return None, "No se generaron archivos .bin"
+        except subprocess.TimeoutExpired:
+            return None, "Timeout de compilación"
+        except Exception as e:
+            return None, str(e)
+
+    return None, "Se requiere build_dir, artifact(s) con firmware.bin, o code"
+
+
+def _esp32_flash_files(build_dir):
+    """
+    Clasifica los .bin de un build ESP32 por región. Acepta los nombres de arduino-cli
+    (sketch.ino.bin, sketch.ino.bootloader.bin, ...) y los cortos (firmware.bin, ...).
+    Returns: {'firmware': Path, 'bootloader'?: Path, 'partitions'?: Path}
+    """
+    files = {}
+    others = []
+    for fp in sorted(Path(build_dir).rglob('*.bin')):
+        name = fp.name.lower()
+        if not fp.is_file() or name.endswith('merged.bin') or name == 'boot_app0.bin':
+            continue
+        if name == 'bootloader.bin' or name.endswith('.bootloader.bin'):
+            files.setdefault('bootloader', fp)
+        elif name == 'partitions.bin' or name.endswith('.partitions.bin'):
+            files.setdefault('partitions', fp)
+        elif name == 'firmware.bin':
+            files['firmware'] = fp
+        else:
+            others.append(fp)
+    if 'firmware' not in files and others:
+        files['firmware'] = others[0]
+    return files
+
+
+# Perfil de flasheo por placa: campo "flash" de la entrada del registry (ver
+# BOARDS_REGISTRY.md). Se aplica a esptool: baudios, compresión, modo/frecuencia/tamaño
+# de flash y offset del bootloader (0x1000 en ESP32, 0x0 en S3/C3). Antes de escribir,
+# las regiones que el registro de firmware no garantiza se comparan por hash en la placa
+# (esptool verify-flash) y solo se escriben las que difieren.
+
+ESP32_FLASH_PROFILE_DEFAULT = {
+    'chip': 'esp32',
+    'baud': 460800,
+    'compress': True,
+    'flash_mode': 'keep',
+    'flash_freq': 'keep',
+    'flash_size': 'keep',
+    'bootloader_offset': '0x1000',
+    'diff_on_device': True,
+    'strategy': 'arduino-cli',  # 'esptool': ir directo a esptool (permite saltar regiones)
+}
+ESP32_REGION_OFFSETS = {'partitions': '0x8000', 'firmware': '0x10000'}
+
+_ESPTOOL_WROTE_RE = re.compile(
+    r'Wrote (\d+) bytes(?: \((\d+) compressed\))? at 0x([0-9a-fA-F]+) in ([\d.]+) seconds')
+# Formato de esptool >= 5: "Verifying 0x10 (16) bytes at 0x00001000 in flash against '...'..."
+# seguido de "Verification successful (digest matched)." o "Verification failed ...".
+_ESPTOOL_VERIFY_RE = re.compile(
+    r'bytes at 0x([0-9a-fA-F]+) in flash against [^\n]*\n\s*Verification (successful|failed)')
+
+
+def _esp32_flash_profile(fqbn):
+    """Perfil de flasheo de la placa (defaults + campo "flash" del registry)."""
+    profile = dict(ESP32_FLASH_PROFILE_DEFAULT)
+    custom = (_get_board_by_fqbn(fqbn) or {}).get('flash')
+    if isinstance(custom, dict):
+        profile.update({k: v for k, v in custom.items() if k in ESP32_FLASH_PROFILE_DEFAULT})
+    return profile
+
+
+def _esp32_flash_timeout(total_bytes, baud):
+    """Timeout de un intento de esptool según tamaño y baudios (en vez de un fijo de 90 s)."""
+    transfer = total_bytes * 10 / max(int(baud), 9600)
+    return int(min(120, 15 + 3 * transfer))
+
+
+def _esptool_base_cmd(esptool_path, port, profile):
+    if esptool_path.startswith(sys.executable) or ' -m ' in esptool_path:
+        base = esptool_path.split()
+    else:
+        base = [esptool_path]
+    return base + ['--chip', str(profile['chip']), '--port', port, '--baud', str(profile['baud'])]
+
+
+def _esptool_flash_params_args(profile):
+    """Modo/frecuencia/tamaño de flash: write-flash los graba en la cabecera del bootloader,
+    así que verify-flash debe recibir los mismos para comparar lo mismo."""
+    return ['--flash-mode', str(profile['flash_mode']), '--flash-freq', str(profile['flash_freq']),
+            '--flash-size', str(profile['flash_size'])]
+
+
+def _esptool_offset(value):
+    return int(str(value), 16) if isinstance(value, str) else int(value)
+
+
+def _esp32_regions_differing(esptool_path, port, profile, regions, log_func, report, session=None):
+    """
+    Compara regiones [(nombre, offset, path)] con la flash de la placa (verify-flash, un
+    solo intento; por la sesión en proceso si la hay). Returns: lista de las que difieren;
+    todas si no se pudo verificar.
+    """
+    t = time.time()
+    if session is not None:
+        results = session.verify('default_reset', regions)
+    else:
+        cmd = (_esptool_base_cmd(esptool_path, port, profile) + ['--before', 'default_reset', 'verify-flash']
+               + _esptool_flash_params_args(profile))
+        for _name, offset, path in regions:
+            cmd.extend([offset, str(path)])
+        total = sum(os.path.getsize(path) for _n, _o, path in regions)
+        try:
+            r = _run_cli(cmd, _esp32_flash_timeout(total, profile['baud']))
+            output = r.stdout + r.stderr
+        except subprocess.TimeoutExpired:
+            output = ''
+        results = {int(off, 16): 'OK' if status == 'successful' else 'FAILED'
+                   for off, status in _ESPTOOL_VERIFY_RE.findall(output)}
+    report['verify_sec'] = round(time.time() - t, 2)
+    if not results:
+        log_func("No se pudo comparar la flash de la placa; se escriben todas las regiones")
+        return regions
+    differing = []
+    for region in regions:
+        name, offset = region[0], region[1]
+        if results.get(_esptool_offset(offset)) == 'OK':
+            report['regions'][name] = {'offset': offset, 'skipped': 'device'}
+            log_func(f"{name} idéntico en la placa: no se reescribe")
+        else:
+            differing.append(region)
+    return differing
+
+
+def _esptool_region_timings(output, regions, report):
+    """Tiempos por región a partir de las líneas 'Wrote N bytes ... at 0x... in S seconds'."""
+    by_offset = {_esptool_offset(offset): (name, offset) for name, offset, _path in regions}
+    for written, compressed, offset, sec in _ESPTOOL_WROTE_RE.findall(output):
+        region = by_offset.get(int(offset, 16))
+        if region:
+            report['regions'][region[0]] = {
+                'offset': region[1], 'bytes': int(written),
+                'compressed': int(compressed) if compressed else None, 'sec': float(sec),
+            }
+
+
+# esptool dentro del proceso del agente cuando `import esptool` trae la API de Python
+# (v5: write_flash(esp, addr_data, ...)). Se abre una sola conexión serie por upload y se
+# reutiliza, con el chip ya detectado, para comparar regiones y para los dos modos de
+# reset; no se arranca un intérprete por intento. Su salida va al mismo log del upload.
+# Sin esa API (esptool 4.x, solo el ejecutable) o con --esptool-subprocess, se usa el
+# ejecutable como antes.
+
+ESPTOOL_INPROCESS = True  # --esptool-subprocess
+
+# esptool escribe en sys.stdout (global). Mientras haya sesiones activas se instala un
+# único stdout que reparte por hilo: cada upload recibe solo sus líneas y el resto de
+# hilos escribe en la consola como siempre. El lock solo cubre registrar/quitar un hilo,
+# nunca la operación serie, así que varios ESP32 (p. ej. /upload/batch) flashean a la vez.
+_esptool_stdout_lock = threading.Lock()
+_esptool_stdout = {'router': None, 'previous': None, 'sinks': {}}  # sinks: thread id -> _EsptoolOutput
+
+
+def _esptool_api():
+    """Módulo esptool si su API de Python es utilizable; None si no (se usa el ejecutable)."""
+    if not ESPTOOL_INPROCESS:
+        return None
+    try:
+        import inspect
+        import esptool
+        params = inspect.signature(esptool.write_flash).parameters
+        for name in ('detect_chip', 'run_stub', 'attach_flash', 'verify_flash', 'reset_chip'):
+            getattr(esptool, name)
+    except (ImportError, AttributeError, TypeError, ValueError):
+        return None
+    return esptool if 'addr_data' in params else None
+
+
+class _EsptoolOutput:
+    """Líneas de esptool de un hilo: van a log_func y se acumulan (tiempos por región)."""
+
+    def __init__(self, log_func):
+        self.log_func = log_func
+        self.pending = ''
+        self.lines = []
+        self.emitting = False
+
+    def write(self, s):
+        self.pending += s
+        *lines, self.pending = re.split(r'[\r\n]', self.pending)
+        self.emitting = True
+        try:
+            for line in lines:
+                if line.strip():
+                    self.lines.append(line.strip())
+                    self.log_func(f"esptool: {line.strip()}")
+        finally:
+            self.emitting = False
+        return len(s)
+
+
+class _EsptoolStdout:
+    """sys.stdout mientras corre esptool en proceso: reparte lo escrito según el hilo."""
+
+    def __init__(self, target):
+        self.target = target
+
+    def write(self, s):
+        sink = _esptool_stdout['sinks'].get(threading.get_ident())
+        if sink is None or sink.emitting:  # otro hilo, o log_func imprimiendo
+            return self.target.write(s)
+        return sink.write(s)
+
+    def flush(self):
+        self.target.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
+@contextmanager
+def _esptool_capture(log_func):
+    """Captura la salida de esptool de este hilo en un _EsptoolOutput."""
+    out = _EsptoolOutput(log_func)
+    ident = threading.get_ident()
+    with _esptool_stdout_lock:
+        if _esptool_stdout['router'] is None:
+            _esptool_stdout['previous'] = sys.stdout
+            _esptool_stdout['router'] = sys.stdout = _EsptoolStdout(sys.stdout)
+        _esptool_stdout['sinks'][ident] = out
+    try:
+        yield out
+    finally:
+        with _esptool_stdout_lock:
+            _esptool_stdout['sinks'].pop(ident, None)
+            if not _esptool_stdout['sinks']:
+                if sys.stdout is _esptool_stdout['router']:
+                    sys.stdout = _esptool_stdout['previous']
+                _esptool_stdout.update(router=None, previous=None)
+
+
+class _EsptoolSession:
+    """
+    Conexión de esptool (en proceso) de un upload. Se registra en job['proc'] mientras
+    trabaja: kill() cierra el puerto y la operación en curso termina con error.
+    """
+
+    pid = None
+
+    def __init__(self, api, port, profile, log_func):
+        self.api = api
+        self.port = port
+        self.profile = profile
+        self.log_func = log_func
+        self.esp = None
+        self.stale = False  # la última operación falló: resincronizar antes de reutilizar
+        self.running = False
+        self.connects = 0
+
+    def poll(self):
+        return None if self.running else 0
+
+    def kill(self):
+        self._close_port()
+
+    def _close_port(self):
+        port = getattr(self.esp, '_port', None)
+        if port is not None:
+            try:
+                port.close()
+            except Exception:
+                pass
 
-    for art in artifacts:
-        if not isinstance(art, dict):
-            continue
-        name = art.get('name', '')
-        if not name.endswith('.bin'):
-            continue
-        out_path = os.path.join(esp32_bin_dir, name)
-        if art.get('path') and os.path.isfile(art['path']):
-            shutil.copy2(art['path'], out_path)
-            if 'firmware' in name.lower():
-                has_firmware = True
-            log_func(f"Artifact {name} desde path")
-        elif art.get('content_base64'):
+    def _connect(self, before_mode):
+        mode = before_mode.replace('_', '-')
+        if self.esp is not None and self.stale:
             try:
-                with open(out_path, 'wb') as f:
-                    f.write(base64.b64decode(art['content_base64']))
-                if 'firmware' in name.lower():
-                    has_firmware = True
-                log_func(f"Artifact {name} desde base64")
+                self.esp.connect(mode)
+                self.stale = False
             except Exception as e:
-                log_func(f"Error artifact {name}: {e}")
-        elif art.get('url'):
+                self.log_func(f"esptool: no se pudo resincronizar ({e}); se reconecta")
+                self.close(reset=False)
+        if self.esp is not None:
+            return self.esp
+        esp = self.api.detect_chip(self.port, connect_mode=mode)
+        self.connects += 1
+        self.esp = esp
+        expected = str(self.profile['chip']).lower().replace('-', '')
+        detected = str(esp.CHIP_NAME).lower().replace('-', '')
+        if expected != detected:
+            self.close(reset=False)
+            raise RuntimeError(f"Chip detectado {esp.CHIP_NAME}, el perfil de la placa espera {self.profile['chip']}")
+        esp = self.esp = self.api.run_stub(esp)
+        baud = int(self.profile['baud'])
+        if baud > getattr(esp, 'ESP_ROM_BAUD', 115200):
             try:
-                resp = requests.get(art['url'], timeout=30, stream=True)
-                resp.raise_for_status()
-                with open(out_path, 'wb') as f:
-                    for chunk in resp.iter_content(8192):
-                        if chunk:
-                            f.write(chunk)
-                if os.path.getsize(out_path) > 0 and 'firmware' in name.lower():
-                    has_firmware = True
-                log_func(f"Artifact {name} desde URL")
+                esp.change_baud(baud)
             except Exception as e:
-                log_func(f"Error descargando {name}: {e}")
+                self.log_func(f"esptool: se mantiene el baud inicial ({e})")
+        self.api.attach_flash(esp)
+        self.stale = False
+        return esp
+
+    def _run(self, before_mode, operation):
+        """Ejecuta operation(esp) con la salida capturada. Returns: (exit, salida)."""
+        job = getattr(_cli_context, 'job', None)
+        if job is not None:
+            if job['cancel_requested']:
+                return -2, 'Cancelado'
+            job['proc'] = self
+        self.running = True
+        with _esptool_capture(self.log_func) as out:
+            try:
+                operation(self._connect(before_mode))
+                code, error = 0, ''
+            except Exception as e:
+                self.stale = True
+                code, error = 1, str(e)
+            finally:
+                self.running = False
+                if job is not None:
+                    job['proc'] = None
+        return code, '\n'.join(out.lines + ([error] if error else []))
+
+    def _addr_data(self, regions):
+        return [(_esptool_offset(offset), str(path)) for _name, offset, path in regions]
+
+    def _flash_params(self):
+        return {k: str(self.profile[k]) for k in ('flash_mode', 'flash_freq', 'flash_size')}
+
+    def verify(self, before_mode, regions):
+        """
+        Compara cada región por hash en la placa. Returns: {offset: 'OK'|'FAILED'};
+        vacío si no se pudo conectar o verificar.
+        """
+        results = {}
+
+        def operation(esp):
+            for addr, path in self._addr_data(regions):
+                try:
+                    self.api.verify_flash(esp, [(addr, path)], **self._flash_params())
+                    results[addr] = 'OK'
+                except Exception as e:
+                    if 'verification failed' not in str(e).lower():
+                        raise
+                    results[addr] = 'FAILED'
 
-    if has_firmware:
-        return esp32_bin_dir, None
+        code, _output = self._run(before_mode, operation)
+        return results if code == 0 else {}
 
-    # 3) code - compilar
-    code = data.get('code')
-    if code and code.strip():
-        fqbn = data.get('fqbn', 'esp32:esp32:esp32')
-        sketch_dir = os.path.join(temp_dir, 'sketch_esp32')
-        os.makedirs(sketch_dir)
-        with open(os.path.join(sketch_dir, 'sketch_esp32.ino'), 'w', encoding='utf-8') as f:
-            f.write(code)
-        build_dir = os.path.join(temp_dir, 'build_esp32')
-        os.makedirs(build_dir)
-        compile_args = [ARDUINO_CLI, 'compile', '--fqbn', fqbn, '--output-dir', build_dir]
-        lib_servo = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libraries', 'Servo')
-        if os.path.isdir(lib_servo):
-            compile_args.extend(['--library', lib_servo])
-        compile_args.append(sketch_dir)
-        try:
-            r = subprocess.run(compile_args, capture_output=True, text=True, timeout=120)
-            if r.returncode != 0:
-                return None, (r.stderr or r.stdout or 'Error de compilación')[:500]
-            if any(f.endswith('.bin') for f in os.listdir(build_dir)):
-                log_func("Compilación ESP32 exitosa")
-                return build_dir, None
-            return None, "No se generaron archivos .bin"
-        except subprocess.TimeoutExpired:
-            return None, "Timeout de compilación"
-        except Exception as e:
-            return None, str(e)
+    def write(self, before_mode, regions):
+        """write-flash de las regiones. Returns: (exit, salida) como el ejecutable."""
+        compress = bool(self.profile['compress'])
 
-    return None, "Se requiere build_dir, artifact(s) con firmware.bin, o code"
+        def operation(esp):
+            self.api.write_flash(esp, self._addr_data(regions), compress=compress,
+                                 no_compress=not compress, no_progress=True, **self._flash_params())
+
+        return self._run(before_mode, operation)
 
+    def close(self, reset=True):
+        """Reinicia la placa (hard reset, como el ejecutable al terminar) y cierra el puerto."""
+        if self.esp is None:
+            return
+        if reset and not self.stale:
+            try:
+                with _esptool_capture(self.log_func):
+                    self.api.reset_chip(self.esp, 'hard-reset')
+            except Exception as e:
+                self.log_func(f"esptool: hard reset falló ({e})")
+        self._close_port()
+        self.esp = None
 
-def _do_upload_esp32(port, fqbn, build_dir, log_func):
+
+@_with_upload_metrics('esp32')
+def _do_upload_esp32(port, fqbn, build_dir, log_func, skip_regions=None, report=None):
     """
-    Upload ESP32. Estrategia 1: arduino-cli. Estrategia 2: esptool.
+    Upload ESP32. Estrategia 1: arduino-cli. Estrategia 2: esptool con el perfil de la placa.
+    skip_regions: regiones ('bootloader', 'partitions') que ya están en la placa; esptool no las reescribe.
+    report: dict opcional donde se dejan perfil, estrategia y tiempos por región.
     Returns: (ok, strategy_used, error_code, hint, hints_list)
     """
+    profile = _esp32_flash_profile(fqbn)
+    report = {} if report is None else report
+    report.update(profile=profile, regions={}, verify_sec=None)
     hints = []
     hints.append("Drivers: CH340/CP2102 suelen necesitar instalación. Linux: udev rules o sudo usermod -a -G dialout $USER.")
     hints.append("CH340: Windows/Mac instalar desde wch.cn. Linux: a veces funciona con dialout.")
@@ -1641,7 +4823,9 @@ def _do_upload_esp32(port, fqbn, build_dir, log_func):
         '-v'
     ]
     err_out = ''
-    for attempt in range(2):
+    cli_attempts = 0 if profile['strategy'] == 'esptool' and _find_esptool() else 2
+    report['strategy'] = 'arduino-cli' if cli_attempts else 'esptool'
+    for attempt in range(cli_attempts):
         if attempt > 0:
             log_func("Reintento con reset a modo bootloader...")
             if _esp32_reset_for_bootloader(port, log_func):
@@ -1649,7 +4833,7 @@ def _do_upload_esp32(port, fqbn, build_dir, log_func):
         log_func(f"Estrategia 1: arduino-cli upload (intento {attempt + 1}/2)...")
         t1 = time.time()
         try:
-            r = subprocess.run(upload_cmd, capture_output=True, text=True, timeout=120)
+            r = _run_cli(upload_cmd, 120)
             elapsed = time.time() - t1
             log_func(f"arduino-cli upload: {elapsed:.1f}s, exit={r.returncode}")
             if r.returncode == 0:
@@ -1687,68 +4871,88 @@ def _do_upload_esp32(port, fqbn, build_dir, log_func):
     elif is_port_busy:
         hints.insert(0, "Puerto ocupado: cierra Serial Monitor, Arduino IDE y otras apps que usen COM3. Desconecta y reconecta el cable USB.")
 
-    # Estrategia 2: esptool (fallback cuando arduino-cli falla)
-    log_func("arduino-cli falló. Reintentando modo bootloader para esptool...")
-    if _esp32_reset_for_bootloader(port, log_func):
-        time.sleep(0.5)
+    # Estrategia 2: esptool (fallback cuando arduino-cli falla, o directa según el perfil)
+    if cli_attempts:
+        log_func("arduino-cli falló. Reintentando modo bootloader para esptool...")
+        if _esp32_reset_for_bootloader(port, log_func):
+            time.sleep(0.5)
 
     esptool_path = _find_esptool()
     if not esptool_path:
         return False, 'arduino-cli', 'UPLOAD_FAIL', 'arduino-cli falló y esptool no está instalado. pip install esptool', hints
 
-    build_path = Path(build_dir)
-    exclude = {'bootloader.bin', 'partitions.bin'}
-    firmware = None
-    for fp in build_path.rglob('*.bin'):
-        if fp.name.lower() not in exclude and fp.is_file():
-            firmware = fp
-            break
+    flash_files = _esp32_flash_files(build_dir)
+    firmware = flash_files.get('firmware')
     if not firmware:
-        firmware = build_path / 'firmware.bin'
-    if not firmware or not firmware.is_file():
         return False, 'arduino-cli', 'UPLOAD_FAIL', 'No se encontró firmware.bin', hints
 
-    bootloader = build_path / 'bootloader.bin'
-    partitions = build_path / 'partitions.bin'
-    flash_args = []
-    if bootloader.is_file():
-        flash_args.extend(['0x1000', str(bootloader)])
-    if partitions.is_file():
-        flash_args.extend(['0x8000', str(partitions)])
-    flash_args.extend(['0x10000', str(firmware)])
-
-    def _run_esptool(before_mode):
-        """Ejecuta esptool con el modo de reset indicado."""
-        if esptool_path.startswith(sys.executable) or ' -m ' in esptool_path:
-            base = esptool_path.split()
-        else:
-            base = [esptool_path]
-        cmd = base + ['--chip', 'esp32', '--port', port, '--before', before_mode, 'write-flash'] + flash_args
-        t = time.time()
-        try:
-            r = subprocess.run(cmd, capture_output=True, text=True, timeout=90)
-            elapsed = time.time() - t
-            log_func(f"esptool ({before_mode}): {elapsed:.1f}s, exit={r.returncode}")
-            return r.returncode, r.stderr + r.stdout
-        except subprocess.TimeoutExpired:
-            return -1, 'TIMEOUT'
-        except Exception as e:
-            return -2, str(e)
-
-    # Intento 2a: reset normal
-    log_func("Estrategia 2a: esptool write-flash (default_reset)...")
-    t2 = time.time()
-    code2a, err2a = _run_esptool('default_reset')
-    if code2a == 0:
-        log_func(f"✓ Upload exitoso (esptool default_reset) en {time.time()-t0:.1f}s")
-        return True, 'esptool', None, None, hints
-
-    # Intento 2b: sin reset (usuario pone bootloader manualmente)
-    log_func("Estrategia 2b: esptool write-flash (no_reset) — modo bootloader manual...")
-    code2b, err2b = _run_esptool('no_reset')
-    if code2b == 0:
-        log_func(f"✓ Upload exitoso (esptool no_reset) en {time.time()-t0:.1f}s")
-        return True, 'esptool', None, None, hints
+    report['strategy'] = 'esptool'
+    offsets = dict(ESP32_REGION_OFFSETS, bootloader=str(profile['bootloader_offset']))
+    regions = []
+    for name in ('bootloader', 'partitions', 'firmware'):
+        if name not in flash_files:
+            continue
+        if name in (skip_regions or ()):
+            report['regions'][name] = {'offset': offsets[name], 'skipped': 'ledger'}
+            log_func(f"{name} sin cambios: no se reescribe")
+            continue
+        regions.append((name, offsets[name], flash_files[name]))
+    api = _esptool_api()
+    session = _EsptoolSession(api, port, profile, log_func) if api else None
+    report['esptool'] = 'inprocess' if session else 'subprocess'
+    try:
+        if profile['diff_on_device'] and regions:
+            regions = _esp32_regions_differing(esptool_path, port, profile, regions, log_func, report, session)
+        if not regions:
+            log_func(f"✓ La placa ya tiene este firmware (comparado por hash) en {time.time()-t0:.1f}s")
+            return True, 'esptool', None, None, hints
+
+        write_args = ['write-flash', '-z' if profile['compress'] else '-u'] + _esptool_flash_params_args(profile)
+        for _name, offset, path in regions:
+            write_args.extend([offset, str(path)])
+        timeout = _esp32_flash_timeout(sum(os.path.getsize(path) for _n, _o, path in regions), profile['baud'])
+        log_func(f"esptool: {', '.join(n for n, _o, _p in regions)} a {profile['baud']} baud"
+                 f"{' comprimido' if profile['compress'] else ''}"
+                 f"{' (en proceso)' if session else f' (timeout {timeout}s)'}")
+
+        def _run_esptool(before_mode):
+            """Ejecuta esptool con el modo de reset indicado (en proceso si hay sesión)."""
+            t = time.time()
+            try:
+                if session is not None:
+                    code, output = session.write(before_mode, regions)
+                else:
+                    cmd = _esptool_base_cmd(esptool_path, port, profile) + ['--before', before_mode] + write_args
+                    r = _run_cli(cmd, timeout)
+                    code, output = r.returncode, r.stderr + r.stdout
+                elapsed = time.time() - t
+                log_func(f"esptool ({before_mode}): {elapsed:.1f}s, exit={code}")
+                _metric_observe('maxide_esptool_attempt_seconds', elapsed,
+                                {'mode': before_mode, 'result': 'ok' if code == 0 else 'error'})
+                if code == 0:
+                    _esptool_region_timings(output, regions, report)
+                return code, output
+            except subprocess.TimeoutExpired:
+                return -1, 'TIMEOUT'
+            except Exception as e:
+                return -2, str(e)
+
+        # Intento 2a: reset normal
+        log_func("Estrategia 2a: esptool write-flash (default_reset)...")
+        code2a, err2a = _run_esptool('default_reset')
+        if code2a == 0:
+            log_func(f"✓ Upload exitoso (esptool default_reset) en {time.time()-t0:.1f}s")
+            return True, 'esptool', None, None, hints
+
+        # Intento 2b: sin reset (usuario pone bootloader manualmente)
+        log_func("Estrategia 2b: esptool write-flash (no_reset) — modo bootloader manual...")
+        code2b, err2b = _run_esptool('no_reset')
+        if code2b == 0:
+            log_func(f"✓ Upload exitoso (esptool no_reset) en {time.time()-t0:.1f}s")
+            return True, 'esptool', None, None, hints
+    finally:
+        if session is not None:
+            session.close()
 
     err_out = err2b or err2a
     log_func(f"esptool falló: {err_out[:300]}")
@@ -1764,60 +4968,263 @@ def _do_upload_esp32(port, fqbn, build_dir, log_func):
     return False, 'esptool', 'UPLOAD_FAIL', (err_out[:500] if isinstance(err_out, str) else str(err_out)[:500]), hints
 
 
+# ============================================
+# REGISTRO DE FIRMWARE FLASHEADO (subir solo si cambió)
+# ============================================
+# Por placa (puerto + número de serie USB) se guarda el sha256 de lo último que se
+# flasheó con éxito. Si /upload trae los mismos hashes responde skipped=true sin tocar
+# la placa (salvo force). Las placas sin número de serie (muchos CH340) se identifican
+# solo por puerto: su entrada se olvida al desconectarlas y no se recupera al reiniciar.
+
+FLASH_LEDGER_ENABLED = True  # --no-skip-unchanged
+FLASH_LEDGER_MAX = 256
+
+_flash_ledger = OrderedDict()  # device_key -> {port, serial_number, fqbn, hashes, flashed_at}
+_flash_ledger_lock = threading.Lock()
+
+
+def _get_flash_ledger_path():
+    return os.path.join(_get_home_tmp(), 'flash_ledger.json')
+
+
+def _save_flash_ledger():
+    """Escribe flash_ledger.json (atómico). Llamar con el lock tomado."""
+    path = _get_flash_ledger_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(_flash_ledger, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"[LEDGER] No se pudo guardar {path}: {e}")
+
+
+def _load_flash_ledger():
+    """Recupera el registro al arrancar (solo placas con número de serie). Retorna cuántas."""
+    try:
+        with open(_get_flash_ledger_path(), 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    with _flash_ledger_lock:
+        for key, entry in saved.items():
+            if isinstance(entry, dict) and entry.get('serial_number') and isinstance(entry.get('hashes'), dict):
+                _flash_ledger[key] = entry
+        return len(_flash_ledger)
+
+
+def _flash_device_key(port):
+    """Clave de la placa: puerto + número de serie USB (de la tabla del watcher)."""
+    key = _port_key(port)
+    serial_num = None
+    with _ports_cond:
+        for info in _ports_state['ports']:
+            if _port_key(info.get('device') or '') == key:
+                serial_num = info.get('serial_number')
+                break
+    return f"{key}|{serial_num or ''}", serial_num
+
+
+def _upload_artifact_hashes(family, source):
+    """
+    sha256 por región de lo que se va a flashear: {'firmware': ...} en AVR (source = .hex),
+    {'firmware', 'bootloader'?, 'partitions'?} en ESP32 (source = build_dir).
+    Usa el manifest del job si existe (sin rehashear). Retorna None si algún hash falla.
+    """
+    if family == 'esp32':
+        files = _esp32_flash_files(source)
+    else:
+        files = {'firmware': Path(source)}
+    manifests = {}
+    hashes = {}
+    for region, path in files.items():
+        folder = str(path.parent)
+        if folder not in manifests:
+            manifests[folder] = (_load_job_manifest(folder) or {}).get('files') or {}
+        sha = (manifests[folder].get(path.name) or {}).get('sha256') or _compute_sha256(path)
+        if not sha:
+            return None
+        hashes[region] = sha
+    return hashes or None
+
+
+def _flash_ledger_lookup(port):
+    if not FLASH_LEDGER_ENABLED:
+        return None
+    key, _serial = _flash_device_key(port)
+    with _flash_ledger_lock:
+        entry = _flash_ledger.get(key)
+        return dict(entry) if entry else None
+
+
+def _flash_ledger_unchanged(entry, fqbn, hashes):
+    """True si la placa ya tiene exactamente estos artefactos para este fqbn."""
+    return bool(entry and hashes and entry.get('fqbn') == fqbn and entry.get('hashes') == hashes)
+
+
+def _flash_ledger_unchanged_regions(entry, fqbn, hashes):
+    """Regiones ESP32 (bootloader/particiones) idénticas a las ya flasheadas."""
+    if not entry or not hashes or entry.get('fqbn') != fqbn:
+        return set()
+    old = entry.get('hashes') or {}
+    return {r for r in ('bootloader', 'partitions') if hashes.get(r) and old.get(r) == hashes[r]}
+
+
+def _flash_ledger_record(port, fqbn, hashes, ok):
+    """Registra un upload exitoso; tras un fallo el contenido de la placa es incierto y se olvida."""
+    if not FLASH_LEDGER_ENABLED:
+        return
+    key, serial_num = _flash_device_key(port)
+    with _flash_ledger_lock:
+        changed = _flash_ledger.pop(key, None) is not None
+        if ok and hashes:
+            _flash_ledger[key] = {
+                'port': port, 'serial_number': serial_num, 'fqbn': fqbn,
+                'hashes': hashes, 'flashed_at': time.time(),
+            }
+            changed = True
+            while len(_flash_ledger) > FLASH_LEDGER_MAX:
+                _flash_ledger.popitem(last=False)
+        if changed:
+            _save_flash_ledger()
+
+
+def _flash_ledger_forget_ports(devices):
+    """Al desconectar un puerto se olvidan sus entradas sin número de serie (otra placa puede ocupar el puerto)."""
+    with _flash_ledger_lock:
+        stale = [k for k, e in _flash_ledger.items() if not e.get('serial_number') and e.get('port') in devices]
+        for key in stale:
+            del _flash_ledger[key]
+        if stale:
+            _save_flash_ledger()
+
+
 # ============================================
 # ENDPOINT: POST /upload
 # ============================================
 
-@app.route('/upload', methods=['POST', 'OPTIONS'])
-def upload():
+# Con `code`, compilar y preparar el puerto (esperar a que se libere tras cerrar el
+# monitor serie, reenumeración tras un reset) son independientes: se preparan en un hilo
+# mientras se compila. Si el puerto desaparece durante la compilación, se cancela.
+# El reset a bootloader del ESP32 sigue justo antes de flashear (deja la placa detenida).
+
+PORT_PREP_WATCH_SEC = 0.5
+
+
+def _resolve_with_port_prep(port, log_func, resolve):
     """
-    Sube firmware al Arduino. Endpoint único que rutea por family (avr/esp32).
-    
-    Request: { fqbn, port, artifacts? | job_id? }
-    - artifacts: [{ path?, content_base64?, url?, name? }] o artifact: {...}
-    - job_id: ID de compilación previa (compile con return_job_id=true)
-    - Deprecado pero soportado: hex_url, code (compilar y subir)
-    
-    Response unificada: { ok, port, fqbn, family, upload_log, logs?, ... }
+    Ejecuta resolve() (compila si hace falta) en este hilo mientras otro prepara el puerto.
+    Returns: (resultado de resolve, overlap) con overlap = {compile_sec, port_prep_sec, saved_sec}
+    o (None, overlap con port_lost=True) si el puerto desapareció.
+    """
+    parent = getattr(_cli_context, 'job', None)
+    job = _new_cli_job(sink=parent['sink'] if parent else None)
+    done = threading.Event()
+    state = {'prep_sec': 0.0, 'port_lost': False}
+
+    def cancel():
+        job['cancel_requested'] = True
+        if job['proc'] is not None:
+            _kill_process_tree(job['proc'])
+
+    def prepare():
+        t = time.time()
+        reset_serial_port(port, log_func)
+        state['prep_sec'] = time.time() - t
+        while not done.wait(PORT_PREP_WATCH_SEC):
+            if parent is not None and parent['cancel_requested']:
+                cancel()
+                return
+            if not _port_exists(port):
+                state['port_lost'] = True
+                log_func(f"Puerto {port} desconectado durante la compilación; cancelando")
+                cancel()
+                return
+
+    watcher = threading.Thread(target=prepare, daemon=True, name='port-prep')
+    t0 = time.time()
+    watcher.start()
+    _cli_context.job = job
+    try:
+        result = resolve()
+    except CompileCancelled:
+        if not state['port_lost']:
+            raise
+        result = None
+    finally:
+        _cli_context.job = parent
+        compile_sec = time.time() - t0
+        done.set()
+    watcher.join()
+    wall = time.time() - t0
+    overlap = {
+        'compile_sec': round(compile_sec, 3),
+        'port_prep_sec': round(state['prep_sec'], 3),
+        'saved_sec': round(max(0.0, compile_sec + state['prep_sec'] - wall), 3),
+    }
+    if state['port_lost']:
+        return None, dict(overlap, port_lost=True)
+    log_func(f"⏱ Compilación {overlap['compile_sec']:.2f}s en paralelo con preparar puerto "
+             f"{overlap['port_prep_sec']:.2f}s (ahorro {overlap['saved_sec']:.2f}s)")
+    return result, overlap
+
+
+@_with_request_metrics('upload')
+@_with_cli_priority(lambda data: 'upload')
+def _upload_request(data, logs):
+    """
+    Lógica de POST /upload (compartida con /upload/stream).
+    Returns: (payload dict, status HTTP)
     """
-    logs = []
     temp_dir = None
+    family = None
+    overlap = None
 
     def log(msg):
         ts = datetime.now().strftime('%H:%M:%S')
         logs.append(f"[{ts}] {msg}")
+        _stream_emit('log', {'line': f"[{ts}] {msg}"})
         print(f"[UPLOAD] {msg}")
 
     def err(code, msg, hint=None):
-        return jsonify({
+        return {
             'ok': False, 'port': data.get('port'), 'fqbn': data.get('fqbn'),
             'family': family, 'upload_log': '\n'.join(logs), 'logs': logs,
             'error': msg, 'error_code': code, 'hint': hint
-        }), 400 if code in ('PORT_NOT_FOUND', 'PERMISSION_DENIED', 'INVALID_FQBN') else 500
+        }, 400 if code in ('PORT_NOT_FOUND', 'PERMISSION_DENIED', 'INVALID_FQBN') else 500
+
+    def skipped(entry):
+        log("Firmware sin cambios: la placa ya lo tiene (force=true para volver a subir)")
+        return {
+            'ok': True, 'skipped': True, 'port': data.get('port'), 'fqbn': data.get('fqbn'),
+            'family': family, 'upload_log': '\n'.join(logs), 'logs': logs,
+            'flashed_at': entry.get('flashed_at'), 'hashes': entry.get('hashes'),
+            'message': 'Sin cambios: el firmware ya está en la placa'
+        }, 200
 
     try:
         if not ARDUINO_CLI:
-            return jsonify({
+            return {
                 'ok': False, 'error': 'arduino-cli no encontrado',
                 'logs': logs, 'hint': 'https://arduino.github.io/arduino-cli/'
-            }), 500
+            }, 500
 
-        data = request.get_json()
         if not data:
-            return jsonify({'ok': False, 'error': 'JSON body requerido', 'logs': logs}), 400
+            return {'ok': False, 'error': 'JSON body requerido', 'logs': logs}, 400
 
         port = data.get('port')
         fqbn = data.get('fqbn', 'arduino:avr:uno')
+        force = bool(data.get('force'))
 
         if not port:
-            return jsonify({'ok': False, 'error': 'Parámetro "port" requerido', 'logs': logs}), 400
+            return {'ok': False, 'error': 'Parámetro "port" requerido', 'logs': logs}, 400
 
         board = _get_board_by_fqbn(fqbn)
         if not board:
-            return jsonify({
+            return {
                 'ok': False, 'error': f'FQBN "{fqbn}" no está en el registry',
                 'logs': logs, 'error_code': 'INVALID_FQBN'
-            }), 400
+            }, 400
         family = board.get('family', 'avr')
 
         if not _port_exists(port):
@@ -1832,6 +5239,14 @@ def upload():
         if job_id:
             job = _get_upload_job(job_id)
             if job:
+                manifest, manifest_err = _verify_job_manifest(job['build_dir'])
+                if manifest_err:
+                    log(f"job_id {job_id} inválido: {manifest_err}")
+                    return {
+                        'ok': False, 'error': f'job_id "{job_id}" inválido: {manifest_err}',
+                        'logs': logs, 'port': port, 'fqbn': fqbn, 'family': family,
+                        'upload_log': '\n'.join(logs), 'error_code': 'JOB_INVALID'
+                    }, 400
                 data = dict(data)
                 data['build_dir'] = job.get('build_dir') or data.get('build_dir')
                 if job.get('fqbn'):
@@ -1842,83 +5257,131 @@ def upload():
                         family = board.get('family', 'avr')
                 log(f"Usando job_id {job_id} (build_dir, family={family})")
             else:
-                return jsonify({
+                with _compile_jobs_lock:
+                    pending_job = _compile_jobs.get(job_id)
+                    pending = pending_job is not None and pending_job['status'] in ('queued', 'running')
+                if pending:
+                    return {
+                        'ok': False, 'error': f'job_id "{job_id}" aún está compilando',
+                        'logs': logs, 'port': port, 'fqbn': fqbn, 'family': family,
+                        'upload_log': '\n'.join(logs), 'error_code': 'JOB_NOT_READY'
+                    }, 409
+                return {
                     'ok': False, 'error': f'job_id "{job_id}" no encontrado o expirado',
                     'logs': logs, 'port': port, 'fqbn': fqbn, 'family': family,
                     'upload_log': '\n'.join(logs), 'error_code': 'JOB_NOT_FOUND'
-                }), 400
+                }, 400
 
         # Asegurar que el core esté instalado (tras resolver job_id, tenemos fqbn final)
         core_ok, core_err = ensure_core_for_fqbn(fqbn, log)
         if not core_ok:
             hint = ' Para ESP32: arduino-cli core install esp32:esp32' if family == 'esp32' else ''
-            return jsonify({
+            return {
                 'ok': False, 'error': f'Core no disponible: {core_err}.{hint}',
                 'logs': logs, 'error_code': 'CORE_NOT_INSTALLED', 'family': family,
                 'upload_log': '\n'.join(logs)
-            }), 400
+            }, 400
 
-        home_tmp = os.path.join(os.path.expanduser('~'), 'snap', 'arduino-cli', 'common', 'maxide-tmp') if (ARDUINO_CLI and 'snap' in ARDUINO_CLI) else os.path.join(os.path.expanduser('~'), '.maxide-agent', 'tmp')
+        home_tmp = _get_home_tmp()
         os.makedirs(home_tmp, exist_ok=True)
         temp_dir = tempfile.mkdtemp(prefix='upload_', dir=home_tmp)
 
+        def resolve(resolver):
+            """(artefacto, error); con code, en paralelo con la preparación del puerto."""
+            nonlocal overlap
+            if not (data.get('code') or '').strip() or data.get('build_dir'):
+                return resolver(data, temp_dir, log)
+            result, overlap = _resolve_with_port_prep(port, log, lambda: resolver(data, temp_dir, log))
+            if result is None:
+                return None, None
+            return result
+
+        def port_lost():
+            return err('PORT_NOT_FOUND', f'Puerto "{port}" desconectado durante la compilación',
+                       'Reconecta la placa y vuelve a subir.')
+
         if family == 'avr':
-            hex_file, resolve_err = _resolve_hex_for_upload(data, temp_dir, log)
+            _set_phase('resolving')
+            hex_file, resolve_err = resolve(_resolve_hex_for_upload)
+            if overlap and overlap.get('port_lost'):
+                return port_lost()
             if resolve_err:
-                return jsonify({
+                return {
                     'ok': False, 'error': resolve_err, 'logs': logs,
                     'port': port, 'fqbn': fqbn, 'family': family, 'upload_log': '\n'.join(logs)
-                }), 400
-            ok, err_code, hint = _do_upload_avr(port, fqbn, hex_file, log)
+                }, 400
+            hashes = _upload_artifact_hashes('avr', hex_file)
+            _set_phase('uploading')
+            with _get_port_lock(port):
+                entry = _flash_ledger_lookup(port)
+                if not force and _flash_ledger_unchanged(entry, fqbn, hashes):
+                    return skipped(entry)
+                ok, err_code, hint = _do_upload_avr(port, fqbn, hex_file, log)
+                _flash_ledger_record(port, fqbn, hashes, ok)
             if ok:
                 log("✓ Upload exitoso")
-                return jsonify({
-                    'ok': True, 'port': port, 'fqbn': fqbn, 'family': family,
-                    'upload_log': '\n'.join(logs), 'logs': logs, 'message': 'Código subido exitosamente'
-                })
+                return {
+                    'ok': True, 'skipped': False, 'port': port, 'fqbn': fqbn, 'family': family,
+                    'upload_log': '\n'.join(logs), 'logs': logs, 'message': 'Código subido exitosamente',
+                    'overlap': overlap
+                }, 200
             return err(err_code, 'Upload fallido', hint)
 
         elif family == 'esp32':
-            build_dir, resolve_err = _resolve_bin_for_upload_esp32(data, temp_dir, log)
+            _set_phase('resolving')
+            build_dir, resolve_err = resolve(_resolve_bin_for_upload_esp32)
+            if overlap and overlap.get('port_lost'):
+                return port_lost()
             if resolve_err:
-                return jsonify({
+                return {
                     'ok': False, 'error': resolve_err, 'logs': logs,
                     'port': port, 'fqbn': fqbn, 'family': family, 'upload_log': '\n'.join(logs)
-                }), 400
-            ok, strategy_used, err_code, hint, hints = _do_upload_esp32(port, fqbn, build_dir, log)
+                }, 400
+            hashes = _upload_artifact_hashes('esp32', build_dir)
+            _set_phase('uploading')
+            with _get_port_lock(port):
+                entry = _flash_ledger_lookup(port)
+                if not force and _flash_ledger_unchanged(entry, fqbn, hashes):
+                    return skipped(entry)
+                unchanged = set() if force else _flash_ledger_unchanged_regions(entry, fqbn, hashes)
+                flash_report = {}
+                ok, strategy_used, err_code, hint, hints = _do_upload_esp32(port, fqbn, build_dir, log, unchanged,
+                                                                            flash_report)
+                _flash_ledger_record(port, fqbn, hashes, ok)
             if ok:
                 log("✓ Upload ESP32 exitoso")
-                return jsonify({
-                    'ok': True, 'port': port, 'fqbn': fqbn, 'family': 'esp32',
+                return {
+                    'ok': True, 'skipped': False, 'port': port, 'fqbn': fqbn, 'family': 'esp32',
                     'strategy_used': strategy_used, 'upload_log': '\n'.join(logs),
-                    'logs': logs, 'hints': hints, 'message': 'Código subido exitosamente'
-                })
-            return jsonify({
+                    'logs': logs, 'hints': hints, 'message': 'Código subido exitosamente',
+                    'overlap': overlap, 'flash': flash_report
+                }, 200
+            return {
                 'ok': False, 'port': port, 'fqbn': fqbn, 'family': 'esp32',
                 'strategy_used': strategy_used, 'upload_log': '\n'.join(logs),
                 'logs': logs, 'hints': hints, 'error': hint or 'Upload fallido',
-                'error_code': err_code or 'UPLOAD_FAIL', 'hint': hint
-            }), 500
+                'error_code': err_code or 'UPLOAD_FAIL', 'hint': hint, 'flash': flash_report
+            }, 500
 
         # Family no soportada
-        return jsonify({
+        return {
             'ok': False, 'error': f'Family "{family}" no soportada para upload',
             'port': port, 'fqbn': fqbn, 'family': family, 'upload_log': '\n'.join(logs), 'logs': logs
-        }), 501
+        }, 501
 
     except subprocess.TimeoutExpired:
         log("Timeout durante el upload")
-        return jsonify({
+        return {
             'ok': False, 'error': 'Timeout', 'error_code': 'TIMEOUT',
             'port': data.get('port'), 'fqbn': data.get('fqbn'), 'family': family,
             'upload_log': '\n'.join(logs), 'logs': logs
-        }), 408
+        }, 408
     except Exception as e:
         log(f"Error inesperado: {str(e)}")
-        return jsonify({
+        return {
             'ok': False, 'error': str(e), 'error_code': 'UNEXPECTED_ERROR',
             'upload_log': '\n'.join(logs), 'logs': logs
-        }), 500
+        }, 500
     finally:
         if temp_dir and os.path.exists(temp_dir):
             try:
@@ -1927,6 +5390,550 @@ def upload():
             except Exception as e:
                 print(f"[UPLOAD] Error limpiando temp: {e}")
 
+
+UPLOAD_BODY_MAX_BYTES = 64 * 1024 * 1024
+
+
+def _upload_request_data():
+    """
+    Body de /upload: JSON, binario crudo (application/octet-stream; parámetros en la
+    query: ?port=&fqbn=&name=&force=) o multipart/form-data (campos + uno o más archivos).
+    Los binarios se escriben a disco por streaming y llegan al resolver como build_dir,
+    sin pasar por base64. Returns: (data|None, incoming_dir|None, (msg, status, code)|None)
+    """
+    mimetype = request.mimetype or ''
+    if mimetype not in ('application/octet-stream', 'multipart/form-data'):
+        return request.get_json(silent=True), None, None
+    if request.content_length and request.content_length > UPLOAD_BODY_MAX_BYTES:
+        return None, None, (f'Body mayor a {UPLOAD_BODY_MAX_BYTES // (1024 * 1024)} MB', 413, 'PAYLOAD_TOO_LARGE')
+
+    fields = request.form if mimetype == 'multipart/form-data' else request.args
+    data = {k: fields.get(k) for k in ('port', 'fqbn', 'job_id', 'project_id') if fields.get(k)}
+    data['force'] = (fields.get('force') or '').lower() in ('1', 'true', 'yes', 'on')
+    board = _get_board_by_fqbn(data.get('fqbn', 'arduino:avr:uno')) or {}
+    default_name = 'firmware.bin' if board.get('family') == 'esp32' else 'firmware.hex'
+
+    home_tmp = _get_home_tmp()
+    os.makedirs(home_tmp, exist_ok=True)
+    incoming_dir = tempfile.mkdtemp(prefix='upload_in_', dir=home_tmp)
+    try:
+        if mimetype == 'multipart/form-data':
+            files = [f for _key, f in request.files.items(multi=True) if f.filename]
+            for storage in files:
+                storage.save(os.path.join(incoming_dir, secure_filename(storage.filename) or default_name))
+        else:
+            name = secure_filename(request.args.get('name') or '') or default_name
+            total = 0
+            with open(os.path.join(incoming_dir, name), 'wb') as f:
+                for chunk in iter(lambda: request.stream.read(65536), b''):
+                    total += len(chunk)
+                    if total > UPLOAD_BODY_MAX_BYTES:
+                        raise ValueError(f'Body mayor a {UPLOAD_BODY_MAX_BYTES // (1024 * 1024)} MB')
+                    f.write(chunk)
+            files = [name] if total else []
+    except Exception as e:
+        shutil.rmtree(incoming_dir, ignore_errors=True)
+        return None, None, (f'No se pudo leer el firmware: {e}', 400, 'INVALID_BODY')
+    if not files:
+        shutil.rmtree(incoming_dir, ignore_errors=True)
+        return None, None, ('El body no contiene firmware', 400, 'INVALID_BODY')
+    data['build_dir'] = incoming_dir
+    return data, incoming_dir, None
+
+
+@app.route('/upload', methods=['POST', 'OPTIONS'])
+def upload():
+    """
+    Sube firmware al Arduino. Endpoint único que rutea por family (avr/esp32).
+    
+    Request: { fqbn, port, artifacts? | job_id?, force? }
+    - artifacts: [{ path?, content_base64?, url?, sha256?, name? }] o artifact: {...}
+      (url + sha256 ya descargado antes: se sirve de la caché local sin red)
+    - También acepta el firmware como binario crudo (Content-Type: application/octet-stream,
+      ?port=&fqbn=&name=) o multipart/form-data (campos port, fqbn, force + archivos)
+    - job_id: ID de compilación previa (compile con return_job_id=true)
+    - force: flashear aunque la placa ya tenga exactamente ese firmware
+    - Deprecado pero soportado: hex_url (+ hex_sha256?), code (compilar y subir)
+    
+    Response unificada: { ok, skipped, port, fqbn, family, upload_log, logs?, ... }
+    skipped=true: los sha256 coinciden con lo último flasheado en esa placa; no se tocó.
+    """
+    data, incoming_dir, error = _upload_request_data()
+    if error:
+        return jsonify({'ok': False, 'error': error[0], 'error_code': error[2], 'logs': []}), error[1]
+    try:
+        payload, status = _upload_request(data, [])
+    finally:
+        if incoming_dir:
+            shutil.rmtree(incoming_dir, ignore_errors=True)
+    return jsonify(payload), status
+
+
+# ============================================
+# ENDPOINT: GET /artifacts/<job_id>/<name> (binario, sin base64)
+# ============================================
+# Los artefactos de un job (compile con return_job_id=true) se sirven desde disco con
+# Content-Length, ETag = sha256 del manifest y soporte de Range / If-None-Match, para
+# que el IDE los descargue sin inflarlos en JSON. Las respuestas de /compile incluyen
+# 'url' en cada artefacto del job.
+
+ARTIFACT_EXTENSIONS = ('.hex', '.bin', '.elf', '.eep')
+
+
+def _artifact_url(job_id, name):
+    return f'/artifacts/{job_id}/{name}'
+
+
+@app.route('/artifacts/<job_id>/<name>', methods=['GET'])
+def get_artifact(job_id, name):
+    """Descarga un artefacto de un job. Soporta Range (206) y If-None-Match (304)."""
+    job = _get_upload_job(job_id)
+    if not job:
+        return jsonify({'ok': False, 'error': f'job_id "{job_id}" no encontrado o expirado',
+                        'error_code': 'JOB_NOT_FOUND'}), 404
+    build_dir = job['build_dir']
+    manifest = _load_job_manifest(build_dir)
+    info = ((manifest or {}).get('files') or {}).get(name)
+    path = os.path.join(build_dir, name)
+    if manifest is not None and info is None:
+        path = None
+    elif name != os.path.basename(name) or not name.lower().endswith(ARTIFACT_EXTENSIONS):
+        path = None
+    if not path or not os.path.isfile(path):
+        return jsonify({'ok': False, 'error': f'Artefacto "{name}" no existe en el job',
+                        'error_code': 'ARTIFACT_NOT_FOUND'}), 404
+    sha = (info or {}).get('sha256') or _compute_sha256(path)
+    resp = send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=name, conditional=True, etag=sha, max_age=0)
+    resp.headers['X-Content-SHA256'] = sha
+    return resp
+
+
+# ============================================
+# ENDPOINT: POST /upload/batch (varias placas a la vez)
+# ============================================
+# Para preparar un kit de aula: un solo set de artefactos (job_id, artifacts o code,
+# resuelto una vez) se sube a N puertos en paralelo. Cada puerto tiene su lock, así
+# que un /upload simultáneo al mismo puerto espera en vez de chocar.
+
+UPLOAD_BATCH_CONCURRENCY = 8       # subidas simultáneas por defecto
+UPLOAD_BATCH_MAX_CONCURRENCY = 32
+UPLOAD_BATCH_MAX_PORTS = 64
+UPLOAD_BATCH_RETRIES = 1           # reintentos por puerto tras un fallo
+
+_port_locks = {}
+_port_locks_guard = threading.Lock()
+
+
+def _port_key(port):
+    """Nombre de puerto normalizado (COM3 y com3 son el mismo en Windows)."""
+    key = str(port).strip()
+    if platform.system() == 'Windows':
+        key = key.upper()
+    return key
+
+
+def _get_port_lock(port):
+    """Lock por puerto (ver _port_key)."""
+    key = _port_key(port)
+    with _port_locks_guard:
+        return _port_locks.setdefault(key, threading.Lock())
+
+
+def _batch_upload_port(port, fqbn, family, source, retries, hashes=None, force=False):
+    """Sube a un puerto con reintentos. Returns: fila de la tabla de resultados."""
+    lines = []
+
+    def log(msg):
+        ts = datetime.now().strftime('%H:%M:%S')
+        lines.append(f"[{ts}] {msg}")
+        _stream_emit('log', {'line': f"[{ts}] [{port}] {msg}"})
+        print(f"[BATCH] [{port}] {msg}")
+
+    row = {'port': port, 'ok': False, 'attempts': 0, 'error_code': None, 'hint': None}
+    t0 = time.time()
+    if not _port_exists(port):
+        row.update(error_code='PORT_NOT_FOUND', hint='Verifica que el dispositivo esté conectado.')
+    else:
+        with _get_port_lock(port):
+            row['lock_wait_sec'] = round(time.time() - t0, 2)
+            entry = _flash_ledger_lookup(port)
+            if not force and _flash_ledger_unchanged(entry, fqbn, hashes):
+                row.update(ok=True, skipped=True)
+                log("Firmware sin cambios: se omite")
+                retries = -1
+            unchanged = set() if force else _flash_ledger_unchanged_regions(entry, fqbn, hashes)
+            for attempt in range(retries + 1):
+                row['attempts'] = attempt + 1
+                if attempt > 0:
+                    log(f"Reintento {attempt}/{retries} tras {row['error_code']}")
+                    time.sleep(1.0)
+                try:
+                    if family == 'esp32':
+                        ok, strategy, err_code, hint, _hints = _do_upload_esp32(port, fqbn, source, log, unchanged)
+                        row['strategy_used'] = strategy
+                    else:
+                        ok, err_code, hint = _do_upload_avr(port, fqbn, source, log)
+                except subprocess.TimeoutExpired:
+                    ok, err_code, hint = False, 'TIMEOUT', 'Timeout durante el upload'
+                except Exception as e:
+                    ok, err_code, hint = False, 'UNEXPECTED_ERROR', str(e)
+                row.update(ok=ok, error_code=err_code, hint=hint)
+                # Puerto desaparecido o sin permisos: reintentar no ayuda
+                if ok or err_code in ('PORT_NOT_FOUND', 'PERMISSION_DENIED', 'ARDUINO_CLI_MISSING'):
+                    break
+            if not row.get('skipped'):
+                _flash_ledger_record(port, fqbn, hashes, row['ok'])
+    row['elapsed_sec'] = round(time.time() - t0, 2)
+    log("✓ Upload exitoso" if row['ok'] else f"✗ Upload fallido ({row['error_code']})")
+    row['upload_log'] = '\n'.join(lines)
+    return row
+
+
+@_with_cli_priority(lambda data: 'upload')
+def _upload_batch_request(data, logs):
+    """
+    Lógica de POST /upload/batch.
+    Returns: (payload dict, status HTTP)
+    """
+    temp_dir = None
+
+    def log(msg):
+        ts = datetime.now().strftime('%H:%M:%S')
+        logs.append(f"[{ts}] {msg}")
+        _stream_emit('log', {'line': f"[{ts}] {msg}"})
+        print(f"[BATCH] {msg}")
+
+    def bad_request(msg, code=None):
+        payload = {'ok': False, 'error': msg, 'logs': logs}
+        if code:
+            payload['error_code'] = code
+        return payload, 400
+
+    if not ARDUINO_CLI:
+        return {'ok': False, 'error': 'arduino-cli no encontrado', 'logs': logs}, 500
+    if not data:
+        return bad_request('JSON body requerido')
+
+    ports = data.get('ports')
+    if not isinstance(ports, list) or not ports or not all(isinstance(p, str) and p.strip() for p in ports):
+        return bad_request('Parámetro "ports" requerido (lista de puertos)')
+    ports = list(dict.fromkeys(p.strip() for p in ports))
+    if len(ports) > UPLOAD_BATCH_MAX_PORTS:
+        return bad_request(f'Máximo {UPLOAD_BATCH_MAX_PORTS} puertos por lote')
+    try:
+        concurrency = int(data.get('concurrency') or UPLOAD_BATCH_CONCURRENCY)
+        retries = int(data.get('retries') if data.get('retries') is not None else UPLOAD_BATCH_RETRIES)
+    except (TypeError, ValueError):
+        return bad_request('"concurrency" y "retries" deben ser enteros')
+    concurrency = max(1, min(concurrency, UPLOAD_BATCH_MAX_CONCURRENCY, len(ports)))
+    retries = max(0, min(retries, 5))
+
+    fqbn = data.get('fqbn', 'arduino:avr:uno')
+    job_id = data.get('job_id')
+    if job_id:
+        job = _get_upload_job(job_id)
+        if not job:
+            return bad_request(f'job_id "{job_id}" no encontrado o expirado', 'JOB_NOT_FOUND')
+        _manifest, manifest_err = _verify_job_manifest(job['build_dir'])
+        if manifest_err:
+            return bad_request(f'job_id "{job_id}" inválido: {manifest_err}', 'JOB_INVALID')
+        data = dict(data, build_dir=job['build_dir'])
+        fqbn = job.get('fqbn') or fqbn
+        data['fqbn'] = fqbn
+    board = _get_board_by_fqbn(fqbn)
+    if not board:
+        return bad_request(f'FQBN "{fqbn}" no está en el registry', 'INVALID_FQBN')
+    family = board.get('family', 'avr')
+
+    try:
+        core_ok, core_err = ensure_core_for_fqbn(fqbn, log)
+        if not core_ok:
+            return bad_request(f'Core no disponible: {core_err}', 'CORE_NOT_INSTALLED')
+
+        # Artefactos resueltos una sola vez para todos los puertos
+        home_tmp = _get_home_tmp()
+        os.makedirs(home_tmp, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix='batch_', dir=home_tmp)
+        _set_phase('resolving')
+        if family == 'esp32':
+            source, resolve_err = _resolve_bin_for_upload_esp32(data, temp_dir, log)
+        else:
+            source, resolve_err = _resolve_hex_for_upload(data, temp_dir, log)
+        if resolve_err:
+            return bad_request(resolve_err)
+        hashes = _upload_artifact_hashes(family, source)
+        force = bool(data.get('force'))
+
+        _set_phase('uploading')
+        log(f"Subiendo a {len(ports)} puerto(s), {concurrency} en paralelo, {retries} reintento(s)")
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch') as pool:
+            futures = [pool.submit(_batch_upload_port, p, fqbn, family, source, retries, hashes, force)
+                       for p in ports]
+            results = [f.result() for f in futures]
+        wall = time.time() - t0
+    except Exception as e:
+        log(f"Error inesperado: {e}")
+        return {'ok': False, 'error': str(e), 'error_code': 'UNEXPECTED_ERROR', 'logs': logs}, 500
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    ok_count = sum(1 for r in results if r['ok'])
+    log(f"Lote terminado: {ok_count}/{len(ports)} ok en {wall:.1f}s")
+    return {
+        'ok': ok_count == len(ports),
+        'fqbn': fqbn,
+        'family': family,
+        'results': results,
+        'ok_count': ok_count,
+        'failed_count': len(ports) - ok_count,
+        'concurrency': concurrency,
+        'wall_time_sec': round(wall, 2),
+        'sum_time_sec': round(sum(r['elapsed_sec'] for r in results), 2),
+        'logs': logs,
+    }, 200
+
+
+@app.route('/upload/batch', methods=['POST', 'OPTIONS'])
+def upload_batch():
+    """
+    Sube el mismo firmware a varias placas en paralelo.
+
+    Request: { ports: [...], fqbn?, job_id? | artifacts? | code?, concurrency?: 8, retries?: 1, force? }
+    Response: { ok, results: [{port, ok, skipped?, attempts, elapsed_sec, error_code, hint, upload_log}],
+                ok_count, failed_count, wall_time_sec, sum_time_sec }
+    """
+    payload, status = _upload_batch_request(request.get_json(silent=True), [])
+    return jsonify(payload), status
+
+
+# ============================================
+# ENDPOINT: POST /compile/stream, /upload/stream (SSE)
+# ============================================
+# Mismo body y resultado que /compile y /upload, pero la respuesta es
+# text/event-stream con eventos:
+#   event: log     data: {"line": "...", "stream"?: "stdout"|"stderr"}
+#   event: phase   data: {"phase": "compiling", "ts": ...}
+#   event: dropped data: {"count": N}   (líneas descartadas por cliente lento)
+#   event: result  data: {...respuesta de /compile o /upload..., "http_status": N}
+# La cola hacia el cliente es acotada: si el navegador no consume a tiempo se
+# descartan líneas de log (nunca el resultado).
+
+SSE_QUEUE_MAX = 500
+SSE_KEEPALIVE_SEC = 15
+
+
+def _sse_format(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _sse_stream(target, data, cancel_on_disconnect):
+    """
+    Ejecuta target(data, logs) -> (payload, status) en un hilo y devuelve una
+    Response SSE con sus líneas, fases y resultado final.
+    cancel_on_disconnect: si el cliente cierra la conexión, matar el proceso en curso.
+    """
+    events = queue.Queue(maxsize=SSE_QUEUE_MAX)
+    state = {'dropped': 0}
+
+    def sink(event, payload):
+        try:
+            events.put_nowait((event, payload))
+        except queue.Full:
+            state['dropped'] += 1
+
+    job = _new_cli_job(sink=sink)
+
+    def worker():
+        _cli_context.job = job
+        try:
+            payload, status = target(data, [])
+        except Exception as e:
+            payload, status = {'ok': False, 'error': str(e)}, 500
+        finally:
+            _cli_context.job = None
+        # logs ya se enviaron línea a línea
+        result = {k: v for k, v in payload.items() if k != 'logs'}
+        result['http_status'] = status
+        try:
+            events.put(('result', result), timeout=60)
+        except queue.Full:
+            print("[SSE] Cliente no consume eventos; resultado descartado")
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+
+    def generate():
+        reported = 0
+        finished = False
+        try:
+            yield ': stream abierto\n\n'
+            while True:
+                try:
+                    event, payload = events.get(timeout=SSE_KEEPALIVE_SEC)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if state['dropped'] > reported:
+                    yield _sse_format('dropped', {'count': state['dropped'] - reported})
+                    reported = state['dropped']
+                yield _sse_format(event, payload)
+                if event == 'result':
+                    finished = True
+                    return
+        finally:
+            if not finished and cancel_on_disconnect and thread.is_alive():
+                print("[SSE] Cliente desconectado, cancelando")
+                job['cancel_requested'] = True
+                if job['proc'] is not None:
+                    _kill_process_tree(job['proc'])
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@app.route('/compile/stream', methods=['POST', 'OPTIONS'])
+def compile_stream():
+    """POST /compile con salida en vivo (SSE). Si el cliente se desconecta, se cancela la compilación."""
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'ok': False, 'error': 'JSON body requerido'}), 400
+    return _sse_stream(_compile_request, data, cancel_on_disconnect=True)
+
+
+@app.route('/upload/stream', methods=['POST', 'OPTIONS'])
+def upload_stream():
+    """POST /upload con salida en vivo (SSE). El upload no se interrumpe si el cliente se desconecta."""
+    data, incoming_dir, error = _upload_request_data()
+    if error:
+        return jsonify({'ok': False, 'error': error[0], 'error_code': error[2]}), error[1]
+    if not data:
+        return jsonify({'ok': False, 'error': 'JSON body requerido'}), 400
+
+    def target(d, logs):
+        try:
+            return _upload_request(d, logs)
+        finally:
+            if incoming_dir:
+                shutil.rmtree(incoming_dir, ignore_errors=True)
+
+    return _sse_stream(target, data, cancel_on_disconnect=False)
+
+
+# ============================================
+# ENDPOINT: GET /metrics (Prometheus)
+# ============================================
+
+def _metrics_tmp_dir_bytes():
+    """Bytes por subdirectorio de home_tmp (jobs, compile_cache, warm_builds, ...), cacheado."""
+    now = time.time()
+    if now - _metrics_tmp_bytes['checked_at'] > METRICS_TMP_CHECK_SEC:
+        dirs = {}
+        home_tmp = _get_home_tmp()
+        try:
+            entries = [e for e in os.scandir(home_tmp) if e.is_dir()]
+        except OSError:
+            entries = []
+        for entry in entries:
+            name = 'upload' if entry.name.startswith(('upload_', 'batch_')) else entry.name
+            dirs[name] = dirs.get(name, 0) + _dir_size(entry.path)
+        _metrics_tmp_bytes.update(checked_at=now, dirs=dirs)
+    return _metrics_tmp_bytes['dirs']
+
+
+def _format_metric_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for k, v in labels:
+        value = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{k}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _render_metrics():
+    """Texto en formato de exposición de Prometheus (version 0.0.4)."""
+    with _metrics_lock:
+        counters = dict(_metrics_counters)
+        histograms = {k: list(v) for k, v in _metrics_histograms.items()}
+    lines = []
+
+    def header(name, kind, help_text=None):
+        lines.append(f'# HELP {name} {help_text or _METRICS_HELP.get(name, name)}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    for name in sorted({k[0] for k in counters}):
+        header(name, 'counter')
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f'{name}{_format_metric_labels(labels)} {value}')
+    for name in sorted({k[0] for k in histograms}):
+        header(name, 'histogram')
+        for (n, labels), hist in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(list(METRICS_BUCKETS) + ['+Inf'], hist[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_metric_labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_metric_labels(labels)} {hist[-1]:.6f}')
+            lines.append(f'{name}_count{_format_metric_labels(labels)} {cumulative}')
+
+    cache = get_compile_cache_status()
+    header('maxide_compile_cache_lookups_total', 'counter', 'Búsquedas en la caché de compilación')
+    lines.append(f'maxide_compile_cache_lookups_total{{result="hit"}} {cache["hits"]}')
+    lines.append(f'maxide_compile_cache_lookups_total{{result="miss"}} {cache["misses"]}')
+    header('maxide_compile_cache_hit_ratio', 'gauge', 'Fracción de aciertos de la caché de compilación')
+    lines.append(f'maxide_compile_cache_hit_ratio {cache["hit_rate"] or 0}')
+    header('maxide_compile_cache_bytes', 'gauge', 'Bytes en la caché de compilación')
+    lines.append(f'maxide_compile_cache_bytes {cache["bytes"]}')
+
+    sched = get_cli_scheduler_status()
+    header('maxide_cli_slots', 'gauge', 'Compilaciones simultáneas permitidas')
+    lines.append(f'maxide_cli_slots {sched["capacity"]}')
+    header('maxide_cli_running', 'gauge', 'Compilaciones en curso')
+    lines.append(f'maxide_cli_running {sched["running"]}')
+    header('maxide_cli_queue_depth', 'gauge', 'Compilaciones esperando turno')
+    lines.append(f'maxide_cli_queue_depth {sched["waiting"]}')
+
+    jobs = get_upload_jobs_status()
+    header('maxide_upload_jobs', 'gauge', 'Jobs de upload guardados')
+    lines.append(f'maxide_upload_jobs {jobs["count"]}')
+
+    header('maxide_tmp_bytes', 'gauge', 'Bytes en los directorios temporales del Agent')
+    for name, size in sorted(_metrics_tmp_dir_bytes().items()):
+        lines.append(f'maxide_tmp_bytes{_format_metric_labels((("dir", name),))} {size}')
+
+    header('maxide_agent_info', 'gauge', 'Versión del Agent')
+    lines.append(f'maxide_agent_info{_format_metric_labels((("version", VERSION),))} 1')
+    return '\n'.join(lines) + '\n'
+
+
+@app.route('/diagnostics/compile', methods=['GET'])
+def diagnostics_compile():
+    """
+    Resumen de tiempos por FQBN (últimas compilaciones reales, sin caché).
+    Query: ?fqbn=arduino:avr:uno (opcional)
+    Response: { ok, window, fqbns: { fqbn: { count, total_sec: {avg,p50,p90,max},
+                phases_avg_sec: {preprocess, sketch, libraries, core, linking, output}, reused_ratio } } }
+    """
+    return jsonify({
+        'ok': True,
+        'window': COMPILE_TIMINGS_WINDOW,
+        'fqbns': get_compile_timings_summary(request.args.get('fqbn')),
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Métricas en formato Prometheus (compile/upload, errores, caché, cola, tmp)."""
+    return Response(_render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 # ============================================
 # ENDPOINT: GET / (info)
 # ============================================
@@ -1941,8 +5948,19 @@ def index():
         'endpoints': {
             'GET /health': 'Estado del agent',
             'GET /ports': 'Lista de puertos seriales',
+            'GET /ports/changes': 'Long-poll de conexión/desconexión de placas',
             'POST /compile': 'Compilar código (sin subir)',
-            'POST /upload': 'Compilar y subir código al Arduino'
+            'POST /compile/jobs': 'Encolar compilación asíncrona',
+            'GET|DELETE /compile/jobs/<id>': 'Estado o cancelación de una compilación',
+            'POST /compile/stream': 'Compilar con log en vivo (SSE)',
+            'POST /upload/stream': 'Subir con log en vivo (SSE)',
+            'POST /upload': 'Compilar y subir código al Arduino',
+            'POST /upload/batch': 'Subir el mismo firmware a varias placas en paralelo',
+            'GET /artifacts/<job_id>/<name>': 'Descargar un artefacto compilado (binario, con Range)',
+            'GET /metrics': 'Métricas en formato Prometheus',
+            'GET /diagnostics/compile': 'Tiempos por fase de compilación (resumen por FQBN)',
+            'POST /cores/install': 'Instalar un core en segundo plano',
+            'GET /cores/install/<id>': 'Estado de una instalación de core'
         },
         'arduino_cli': ARDUINO_CLI,
         'status': 'running'
@@ -1953,6 +5971,8 @@ def index():
 # ============================================
 
 def main():
+    global ARDUINO_CLI, COMPILE_CACHE_MAX_BYTES, WARM_BUILDS_ENABLED, COMPILE_WORKERS, BOARDS_REGISTRY_EXTRA
+    global UPLOAD_JOBS_PERSIST, FLASH_LEDGER_ENABLED, CLI_SLOTS, PREWARM_ENABLED, CLI_BACKEND, ESPTOOL_INPROCESS
     parser = argparse.ArgumentParser(description='MAX-IDE Agent Local')
     parser.add_argument('--port', '-p', type=int, default=DEFAULT_PORT,
                         help=f'Puerto HTTP (default: {DEFAULT_PORT})')
@@ -1962,13 +5982,45 @@ def main():
                         help='Ruta a arduino-cli')
     parser.add_argument('--debug', action='store_true',
                         help='Modo debug')
+    parser.add_argument('--compile-workers', type=int, default=COMPILE_WORKERS,
+                        help=f'Compilaciones asíncronas simultáneas (default: {COMPILE_WORKERS})')
+    parser.add_argument('--cli-backend', choices=('subprocess', 'daemon'), default=CLI_BACKEND,
+                        help='Cómo invocar arduino-cli: un proceso por comando o un daemon gRPC persistente')
+    parser.add_argument('--benchmark-backends', type=int, default=0, metavar='N',
+                        help='Medir N veces version/core list/compile con ambos backends y salir')
+    parser.add_argument('--cli-slots', type=int, default=CLI_SLOTS,
+                        help='Compilaciones de arduino-cli simultáneas (default: 0 = según núcleos y RAM libre)')
+    parser.add_argument('--no-warm-builds', action='store_true',
+                        help='No reutilizar build dirs entre compilaciones (compilación completa siempre)')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='Al arrancar, precompilar en segundo plano cada placa del registry')
+    parser.add_argument('--compile-cache-mb', type=int, default=COMPILE_CACHE_MAX_BYTES // (1024 * 1024),
+                        help='Tamaño máximo de la caché de compilación en MB (0 = desactivada)')
+    parser.add_argument('--boards-registry', action='append', default=[], metavar='JSON',
+                        help='Registry de placas adicional (repetible; mismo formato que boards_registry.json)')
+    parser.add_argument('--no-persist-jobs', action='store_true',
+                        help='No guardar jobs/index.json (los job_id no sobreviven a un reinicio)')
+    parser.add_argument('--no-skip-unchanged', action='store_true',
+                        help='Flashear siempre, aunque la placa ya tenga el mismo firmware')
+    parser.add_argument('--esptool-subprocess', action='store_true',
+                        help='Ejecutar esptool como proceso aparte aunque su API de Python esté disponible')
     
     args = parser.parse_args()
     
     # Override arduino-cli path si se especifica
-    global ARDUINO_CLI
     if args.arduino_cli:
         ARDUINO_CLI = args.arduino_cli
+    COMPILE_CACHE_MAX_BYTES = args.compile_cache_mb * 1024 * 1024
+    WARM_BUILDS_ENABLED = not args.no_warm_builds
+    PREWARM_ENABLED = args.prewarm
+    COMPILE_WORKERS = max(1, args.compile_workers)
+    CLI_SLOTS = max(0, args.cli_slots)
+    CLI_BACKEND = args.cli_backend
+    if args.boards_registry:
+        BOARDS_REGISTRY_EXTRA = BOARDS_REGISTRY_EXTRA + [os.path.abspath(p) for p in args.boards_registry]
+    UPLOAD_JOBS_PERSIST = not args.no_persist_jobs
+    FLASH_LEDGER_ENABLED = not args.no_skip_unchanged
+    ESPTOOL_INPROCESS = not args.esptool_subprocess
     
     # Verificar arduino-cli
     print("=" * 50)
@@ -1977,11 +6029,39 @@ def main():
     
     if ARDUINO_CLI:
         print(f"✓ arduino-cli: {ARDUINO_CLI}")
+        cores = _refresh_cores_index()
+        if cores is not None:
+            print(f"✓ Cores instalados: {', '.join(sorted(cores)) or 'ninguno'}")
+        _get_library_index()
+        print(f"✓ Librerías indexadas: {_library_index['count']}")
+        if CLI_BACKEND == 'daemon':
+            ready = _cli_daemon_ensure() is not None
+            print(f"{'✓' if ready else '⚠'} Backend arduino-cli: daemon "
+                  + (f"({_cli_daemon['address']})" if ready else f"no disponible, usando subprocess ({_cli_daemon['error']})"))
+        if args.benchmark_backends > 0:
+            print(f"Benchmark de backends ({args.benchmark_backends} iteraciones)...")
+            for op, by_backend in _benchmark_cli_backends(args.benchmark_backends).items():
+                for backend, r in by_backend.items():
+                    line = 'no disponible' if r is None else \
+                        f"mediana {r['median_ms']:.0f} ms (min {r['min_ms']:.0f}, max {r['max_ms']:.0f})"
+                    print(f"  {op:<28} {backend:<10} {line}")
+            return
     else:
         print("⚠ arduino-cli NO encontrado")
         print("  Instala desde: https://arduino.github.io/arduino-cli/")
         print("  O especifica la ruta con --arduino-cli")
     
+    # Snapshot de /health (versión, cores, esptool) en segundo plano
+    _start_env_prober()
+    _start_ports_watcher()
+    restored = _load_upload_job_index()
+    if restored:
+        print(f"✓ Jobs recuperados: {restored}")
+    _start_job_sweeper()
+    _start_prewarm()
+    if FLASH_LEDGER_ENABLED and _load_flash_ledger():
+        print(f"✓ Placas con firmware registrado: {len(_flash_ledger)}")
+    print(f"✓ Placas en registry: {len(_load_boards_registry())}")
     print(f"✓ Python: {platform.python_version()}")
     print(f"✓ Platform: {platform.platform()}")
     print(f"✓ Listening on: http://{args.host}:{args.port}")
@@ -10,7 +10,11 @@ Verifica que:
 No depende de hardware real.
 """
 import json
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
 from pathlib import Path
 from unittest.mock import patch, MagicMock
@@ -25,14 +29,30 @@ if str(project_root) not in sys.path:
     sys.path.insert(0, str(project_root))
 
 
+def _isolate_home_tmp(test, agent):
+    """home_tmp temporal y caché/jobs en memoria vacíos: el test no toca ~/.maxide-agent."""
+    home_tmp = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, home_tmp, True)
+    for p in (patch.object(agent, '_get_home_tmp', return_value=home_tmp),
+              patch.object(agent, '_compile_cache_index', None),
+              patch.dict(agent._compile_cache_stats),
+              patch.dict(agent._upload_job_store, clear=True),
+              patch.dict(agent._compile_jobs, clear=True)):
+        p.start()
+        test.addCleanup(p.stop)
+    return home_tmp
+
+
 @unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
 class TestAgentHealthMock(unittest.TestCase):
     """Mocks para GET /health."""
 
     def setUp(self):
         with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
             from agent.agent import app
             self.client = app.test_client()
+        _isolate_home_tmp(self, agent_mod)
 
     @patch('agent.agent.get_cores_status')
     def test_health_ok(self, mock_cores):
@@ -46,14 +66,73 @@ class TestAgentHealthMock(unittest.TestCase):
         self.assertEqual(data.get('status'), 'running')
 
 
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestAgentHealthSnapshot(unittest.TestCase):
+    """/health responde desde el snapshot del prober; las instalaciones son jobs."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.client = self.agent.app.test_client()
+        _isolate_home_tmp(self, self.agent)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def test_health_does_not_wait_for_slow_probe(self):
+        """Con un sondeo bloqueado, /health responde al instante con stale_since."""
+        def slow_probe():
+            self.release.wait(10)
+            return {'arduino_cli_ok': True, 'cores': {}, 'errors': []}
+
+        with patch.object(self.agent, 'ensure_cores_installed', side_effect=slow_probe), \
+                patch.object(self.agent, '_env_snapshot', None), \
+                patch.object(self.agent, '_env_prober_thread', None):
+            t0 = time.time()
+            data = self.client.get('/health').get_json()
+            self.assertLess(time.time() - t0, 1.0)
+        self.assertTrue(data['ok'])
+        self.assertIsNone(data['probed_at'])
+        self.assertIsNotNone(data['stale_since'])
+
+    def test_core_install_runs_as_tracked_job(self):
+        """POST /cores/install devuelve 202 y el job se consulta hasta terminar."""
+        installed = []
+
+        def fake_run(cmd, *args, **kwargs):
+            if cmd[1:3] == ['core', 'install']:
+                installed.append(cmd[3])
+            if cmd[1:] == ['core', 'list']:
+                rows = ''.join(f'\n{c} 3.0.7 3.0.7 ESP32' for c in installed)
+                return MagicMock(returncode=0, stdout='ID Installed Latest Name' + rows, stderr='')
+            return MagicMock(returncode=0, stdout='', stderr='')
+
+        with patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'), \
+                patch.object(self.agent, '_installed_core_versions', None), \
+                patch.dict(self.agent._cores_index_state), \
+                patch.dict(self.agent._core_install_jobs, clear=True), \
+                patch('agent.agent.subprocess.run', side_effect=fake_run):
+            resp = self.client.post('/cores/install', json={'core': 'esp32:esp32'})
+            self.assertEqual(resp.status_code, 202)
+            job_id = resp.get_json()['job']['job_id']
+            self.agent._core_install_jobs[job_id]['finished'].wait(5)
+            job = self.client.get(f'/cores/install/{job_id}').get_json()['job']
+            self.assertTrue(self.agent._is_core_installed('esp32:esp32'))
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(installed, ['esp32:esp32'])
+        self.assertEqual(self.client.post('/cores/install', json={'core': 'nope'}).status_code, 400)
+
+
 @unittest.skipIf(flask is None, "Flask no instalado")
 class TestAgentCompileEmptyCode(unittest.TestCase):
     """Agent debe rechazar código vacío."""
 
     def setUp(self):
         with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
             from agent.agent import app
             self.client = app.test_client()
+        _isolate_home_tmp(self, agent_mod)
 
     @patch('agent.agent.ARDUINO_CLI', '/usr/bin/arduino-cli')
     def test_compile_empty_code_returns_error(self):
@@ -103,8 +182,10 @@ class TestAgentCompileMockOK(unittest.TestCase):
 
     def setUp(self):
         with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
             from agent.agent import app
             self.client = app.test_client()
+        _isolate_home_tmp(self, agent_mod)
 
     @patch('agent.agent.ARDUINO_CLI', '/usr/bin/arduino-cli')
     @patch('agent.agent.subprocess.run')
@@ -171,8 +252,10 @@ class TestAgentUploadMock(unittest.TestCase):
 
     def setUp(self):
         with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
             from agent.agent import app
             self.client = app.test_client()
+        _isolate_home_tmp(self, agent_mod)
 
     def test_upload_missing_port_returns_error(self):
         """Upload sin puerto debe devolver error."""
@@ -203,5 +286,50 @@ class TestAgentUploadMock(unittest.TestCase):
         self.assertIn(resp.status_code, [200, 400, 404, 500])
 
 
+
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestAgentMetrics(unittest.TestCase):
+    """GET /metrics en formato Prometheus."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.client = self.agent.app.test_client()
+        _isolate_home_tmp(self, self.agent)
+        for p in (patch.dict(self.agent._metrics_counters, clear=True),
+                  patch.dict(self.agent._metrics_histograms, clear=True)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_metrics_exposition(self):
+        ok_run = MagicMock(returncode=0, stdout='', stderr='')
+        busy = MagicMock(returncode=1, stdout='', stderr='avrdude: ser_open(): port busy')
+        with patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'), \
+                patch.object(self.agent, 'reset_serial_port', return_value=True), \
+                patch.object(self.agent, '_run_cli', side_effect=[busy, ok_run, busy, busy, busy]):
+            self.agent._do_upload_avr('COM3', 'arduino:avr:uno', '/tmp/x.hex', lambda m: None)
+            self.agent._do_upload_avr('COM3', 'arduino:avr:uno', '/tmp/x.hex', lambda m: None)
+        self.client.post('/compile', json={'code': 'void setup(){}', 'fqbn': 'x:y:z'})
+
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain; version=0.0.4'))
+        text = resp.get_data(as_text=True)
+        self.assertIn('maxide_upload_retries_total{family="avr"} 3', text)
+        self.assertIn('maxide_errors_total{code="PORT_BUSY",op="upload_avr"} 1', text)
+        self.assertIn('op="compile"} 1', text)
+        self.assertIn('maxide_upload_duration_seconds_count{family="avr",result="ok",strategy="arduino-cli"} 1', text)
+        self.assertIn('maxide_upload_duration_seconds_bucket{family="avr",result="error",strategy="arduino-cli",'
+                      'le="+Inf"} 1', text)
+        self.assertIn('maxide_compile_duration_seconds_count{cached="false",family="unknown",fqbn="other",'
+                      'result="error"} 1', text)
+        self.assertIn('maxide_compile_cache_hit_ratio', text)
+        self.assertIn('# TYPE maxide_upload_duration_seconds histogram', text)
+        for line in text.splitlines():
+            if line and not line.startswith('#'):
+                float(line.rsplit(' ', 1)[1])
+
+
 if __name__ == '__main__':
     unittest.main()
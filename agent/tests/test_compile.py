@@ -10,7 +10,13 @@ Ejecutar con dependencias del Agent instaladas:
   pytest agent/tests/test_compile.py -v
 """
 import json
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
 from pathlib import Path
 from unittest.mock import patch, MagicMock
@@ -27,6 +33,20 @@ if str(project_root) not in sys.path:
     sys.path.insert(0, str(project_root))
 
 
+def _isolate_home_tmp(test, agent):
+    """home_tmp temporal y caché/jobs en memoria vacíos: el test no toca ~/.maxide-agent."""
+    home_tmp = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, home_tmp, True)
+    for p in (patch.object(agent, '_get_home_tmp', return_value=home_tmp),
+              patch.object(agent, '_compile_cache_index', None),
+              patch.dict(agent._compile_cache_stats),
+              patch.dict(agent._upload_job_store, clear=True),
+              patch.dict(agent._compile_jobs, clear=True)):
+        p.start()
+        test.addCleanup(p.stop)
+    return home_tmp
+
+
 @unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
 class TestCompileEndpoint(unittest.TestCase):
     """Tests para el endpoint POST /compile"""
@@ -34,9 +54,11 @@ class TestCompileEndpoint(unittest.TestCase):
     def setUp(self):
         """Configura cliente de prueba."""
         with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
             from agent.agent import app
             self.app = app
         self.client = self.app.test_client()
+        _isolate_home_tmp(self, agent_mod)
 
     def _compile_post(self, data):
         """Helper: POST /compile con JSON."""
@@ -173,5 +195,773 @@ class TestCompileEndpoint(unittest.TestCase):
                 self.assertIn(resp.status_code, (200, 400))
 
 
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestCompileCache(unittest.TestCase):
+    """Caché content-addressed de /compile."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        _isolate_home_tmp(self, self.agent)
+        self.client = self.agent.app.test_client()
+        self.cache_dir = tempfile.mkdtemp()
+        patchers = [
+            patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'),
+            patch.object(self.agent, 'COMPILE_CACHE_DIR', self.cache_dir),
+            patch.object(self.agent, 'WARM_BUILD_DIR', tempfile.mkdtemp()),
+            patch.object(self.agent, '_compile_cache_index', None),
+            patch.dict(self.agent._compile_cache_stats, {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0,
+                                                       'deduplicated': 0}),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+        self.compile_calls = 0
+
+    def _fake_run(self, cmd, *args, **kwargs):
+        if 'compile' in cmd:
+            self.compile_calls += 1
+            build_dir = Path(cmd[cmd.index('--output-dir') + 1])
+            (build_dir / 'sketch_verify.ino.hex').write_bytes(b':020000020000FC\n:00000001FF\n')
+            (build_dir / 'sketch_verify.ino.elf').write_bytes(b'\x7fELF' + b'\0' * 64)
+            return MagicMock(returncode=0, stdout='Sketch uses 444 bytes', stderr='')
+        if 'version' in cmd:
+            return MagicMock(returncode=0, stdout='arduino-cli  Version: 1.1.1 Commit: x', stderr='')
+        return MagicMock(returncode=0, stdout='ID Installed Latest Name\narduino:avr 1.8.6 1.8.6 AVR', stderr='')
+
+    def _compile(self, code):
+        return self.client.post('/compile', data=json.dumps({'fqbn': 'arduino:avr:uno', 'code': code}),
+                                content_type='application/json')
+
+    def test_second_identical_compile_is_cache_hit(self):
+        """Mismo sketch (salvo CRLF/espacios finales) no vuelve a invocar arduino-cli compile."""
+        with patch('agent.agent.subprocess.run', side_effect=self._fake_run):
+            first = self._compile('void setup() {}\nvoid loop() {}\n').get_json()
+            second = self._compile('void setup() {}  \r\nvoid loop() {}').get_json()
+        self.assertTrue(first['ok'])
+        self.assertFalse(first['cached'])
+        self.assertTrue(second['ok'])
+        self.assertTrue(second['cached'])
+        self.assertEqual(self.compile_calls, 1)
+        self.assertEqual(first['artifacts'][0]['sha256'], second['artifacts'][0]['sha256'])
+        self.assertEqual(first['compile_log'], second['compile_log'])
+
+        health = self.client.get('/health').get_json()
+        self.assertEqual(health['compile_cache']['hits'], 1)
+        self.assertEqual(health['compile_cache']['misses'], 1)
+        self.assertEqual(health['compile_cache']['entries'], 1)
+
+    def test_return_job_id_hands_off_only_artifacts(self):
+        """El job recibe solo los artefactos (rename o hardlink desde caché) y un manifest."""
+        jobs_dir = tempfile.mkdtemp()
+        body = {'fqbn': 'arduino:avr:uno', 'code': 'void setup() {} void loop() {} // job', 'return_job_id': True}
+        with patch.object(self.agent, '_get_upload_jobs_dir', lambda: jobs_dir), \
+                patch.object(self.agent, '_job_sweeper_thread', MagicMock()), \
+                patch('agent.agent.subprocess.run', side_effect=self._fake_run):
+            first = self.client.post('/compile', json=body).get_json()
+            second = self.client.post('/compile', json=body).get_json()
+        self.assertTrue(second['cached'])
+        for data in (first, second):
+            job_dir = os.path.join(jobs_dir, data['job_id'])
+            self.assertEqual(sorted(os.listdir(job_dir)), ['manifest.json', 'sketch_verify.ino.hex'])
+            manifest, err = self.agent._verify_job_manifest(job_dir)
+            self.assertIsNone(err)
+            self.assertEqual(manifest['files']['sketch_verify.ino.hex']['sha256'], data['artifacts'][0]['sha256'])
+        cached_hex = os.path.join(self.cache_dir, second['cache_key'], 'sketch_verify.ino.hex')
+        self.assertTrue(os.path.samefile(cached_hex, second['artifacts'][0]['path']))
+
+    def test_lru_eviction_by_bytes(self):
+        """Con límite pequeño solo se conserva la entrada más reciente."""
+        with patch.object(self.agent, 'COMPILE_CACHE_MAX_BYTES', 1):
+            with patch('agent.agent.subprocess.run', side_effect=self._fake_run):
+                self._compile('void setup() {} void loop() {} // a')
+                self._compile('void setup() {} void loop() {} // b')
+                again = self._compile('void setup() {} void loop() {} // a').get_json()
+        self.assertFalse(again['cached'])
+        self.assertEqual(self.compile_calls, 3)
+        status = self.agent.get_compile_cache_status()
+        self.assertEqual(status['entries'], 1)
+        self.assertGreaterEqual(status['evictions'], 2)
+
+    def _wait_for_follower(self):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            if any(f['followers'] for f in list(self.agent._compile_flights.values())):
+                return
+            time.sleep(0.01)
+        self.fail('La segunda petición no se unió a la compilación en curso')
+
+    def _concurrent_compiles(self, code, fake_run):
+        body = {'fqbn': 'arduino:avr:uno', 'code': code}
+        results = [None, None]
+
+        def run(i):
+            results[i] = self.agent._compile_request(dict(body), [])
+
+        with patch('agent.agent.subprocess.run', side_effect=fake_run):
+            leader = threading.Thread(target=run, args=(0,))
+            leader.start()
+            deadline = time.time() + 5
+            while not self.agent._compile_flights and time.time() < deadline:
+                time.sleep(0.01)
+            follower = threading.Thread(target=run, args=(1,))
+            follower.start()
+            leader.join(10)
+            follower.join(10)
+        return results
+
+    def test_identical_concurrent_compiles_share_one_run(self):
+        def fake_run(cmd, *args, **kwargs):
+            if 'compile' in cmd:
+                self._wait_for_follower()
+            return self._fake_run(cmd, *args, **kwargs)
+
+        (first, _), (second, status) = self._concurrent_compiles('void setup() {} void loop() {} // dup', fake_run)
+        self.assertEqual(self.compile_calls, 1)
+        self.assertEqual(status, 200)
+        self.assertTrue(second['deduplicated'])
+        self.assertTrue(second['cached'])
+        self.assertFalse(first['deduplicated'])
+        self.assertEqual(first['artifacts'][0]['sha256'], second['artifacts'][0]['sha256'])
+        self.assertTrue(any('Compilando para arduino:avr:uno' in line for line in second['logs']))
+        self.assertEqual(self.agent._compile_flights, {})
+        self.assertEqual(self.agent.get_compile_cache_status()['deduplicated'], 1)
+
+    def test_concurrent_compiles_share_build_with_cache_disabled(self):
+        """Sin caché la petición en espera usa el build del líder en vez de compilar otra vez."""
+        def fake_run(cmd, *args, **kwargs):
+            if 'compile' in cmd:
+                self._wait_for_follower()
+            return self._fake_run(cmd, *args, **kwargs)
+
+        with patch.object(self.agent, 'COMPILE_CACHE_MAX_BYTES', 0):
+            (first, s1), (second, s2) = self._concurrent_compiles('void setup() {} void loop() {} // nocache',
+                                                                  fake_run)
+        self.assertEqual(self.compile_calls, 1)
+        self.assertEqual((s1, s2), (200, 200))
+        self.assertTrue(second['deduplicated'])
+        self.assertFalse(second['cached'])
+        self.assertEqual(first['artifacts'][0]['sha256'], second['artifacts'][0]['sha256'])
+        self.assertEqual(self.agent._compile_flights, {})
+        # El último en soltar el flight borra el build compartido
+        self.assertFalse(os.path.exists(second['artifacts'][0]['path']))
+        self.assertEqual(os.listdir(self.agent._get_home_tmp()), [])
+
+    def test_identical_concurrent_compiles_share_error(self):
+        calls = []
+
+        def fake_run(cmd, *args, **kwargs):
+            if 'compile' in cmd:
+                calls.append(cmd)
+                self._wait_for_follower()
+                return MagicMock(returncode=1, stdout='', stderr="sketch.ino:1: error: 'x' was not declared")
+            return self._fake_run(cmd, *args, **kwargs)
+
+        (first, s1), (second, s2) = self._concurrent_compiles('void setup() { x; } void loop() {}', fake_run)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((s1, s2), (400, 400))
+        self.assertEqual(second['error'], first['error'])
+        self.assertTrue(second['deduplicated'])
+        self.assertIn("[stderr] sketch.ino:1: error: 'x' was not declared", second['logs'])
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestWarmBuildDirs(unittest.TestCase):
+    """Build dirs persistentes por FQBN para compilación incremental."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        _isolate_home_tmp(self, self.agent)
+        self.warm_dir = tempfile.mkdtemp()
+        for p in (patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'),
+                  patch.object(self.agent, 'WARM_BUILD_DIR', self.warm_dir)):
+            p.start()
+            self.addCleanup(p.stop)
+        self.commands = []
+
+    def _fake_run(self, cmd, *args, **kwargs):
+        self.commands.append(cmd)
+        out = Path(cmd[cmd.index('--output-dir') + 1])
+        (out / 'sketch_verify.ino.hex').write_bytes(b':00000001FF\n')
+        return MagicMock(returncode=0, stdout='', stderr='')
+
+    def _compile(self, files, out_dir):
+        with patch('agent.agent.subprocess.run', side_effect=self._fake_run):
+            return self.agent._compile_sketch('arduino:avr:uno', files, out_dir, [], lambda m: None)
+
+    def test_same_build_path_and_unchanged_files_keep_mtime(self):
+        """Dos compilaciones del mismo FQBN reutilizan --build-path y no reescriben archivos idénticos."""
+        with tempfile.TemporaryDirectory() as out1, tempfile.TemporaryDirectory() as out2:
+            self._compile({'sketch_verify.ino': 'void setup() {} void loop() {}', 'util.h': '#define X 1'}, out1)
+            sketch_dir = Path(self.commands[0][-1])
+            ino = sketch_dir / 'sketch_verify.ino'
+            old_mtime = ino.stat().st_mtime_ns - 10_000_000
+            os.utime(ino, ns=(old_mtime, old_mtime))
+            self._compile({'sketch_verify.ino': 'void setup() {} void loop() {}'}, out2)
+
+        first, second = self.commands
+        self.assertEqual(first[first.index('--build-path') + 1], second[second.index('--build-path') + 1])
+        self.assertIn('--build-cache-path', second)
+        self.assertEqual(ino.stat().st_mtime_ns, old_mtime)
+        self.assertFalse((sketch_dir / 'util.h').exists())
+
+    def test_upload_with_code_uses_same_project_slot_as_compile(self):
+        """/upload con code elige el slot con la misma regla que /compile (options.project o project_id)."""
+        self.assertEqual(self.agent._warm_slot_project({'options': {'project': 'p1'}, 'project_id': 'p2'}), 'p1')
+        self.assertEqual(self.agent._warm_slot_project({'project_id': 'p2', 'options': None}), 'p2')
+        data = {'code': 'void setup() {} void loop() {}', 'options': {'project': 'p1'}}
+        failed = MagicMock(returncode=1, stdout='', stderr='error')
+        with patch.object(self.agent, '_compile_sketch', return_value=failed) as compile_sketch, \
+                patch.object(self.agent, '_library_args_for_sketch', return_value=[]):
+            self.agent._resolve_hex_for_upload(data, tempfile.mkdtemp(), lambda m: None)
+            self.agent._resolve_bin_for_upload_esp32(data, tempfile.mkdtemp(), lambda m: None)
+        self.assertEqual([c.kwargs['project'] for c in compile_sketch.call_args_list], ['p1', 'p1'])
+
+    def test_prune_stale_sketch_objects(self):
+        """Solo se eliminan objetos del sketch cuyo fuente ya no existe."""
+        with tempfile.TemporaryDirectory() as build:
+            obj = Path(build) / 'sketch'
+            obj.mkdir()
+            for name in ('sketch_verify.ino.cpp', 'sketch_verify.ino.cpp.o', 'helper.cpp.o', 'helper.cpp.d'):
+                (obj / name).write_text('x')
+            (Path(build) / 'core').mkdir()
+            (Path(build) / 'core' / 'core.a').write_text('x')
+            removed = self.agent._prune_stale_sketch_objects(build, {'sketch_verify.ino': ''})
+            self.assertEqual(removed, 2)
+            self.assertTrue((obj / 'sketch_verify.ino.cpp.o').exists())
+            self.assertTrue((Path(build) / 'core' / 'core.a').exists())
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestCoresIndex(unittest.TestCase):
+    """Índice en memoria de cores instalados (sin `core list` por request)."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.data_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.data_dir, 'packages', 'arduino', 'hardware', 'avr'))
+        patchers = [
+            patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'),
+            patch.object(self.agent, '_installed_core_versions', None),
+            patch.object(self.agent, 'CORES_INDEX_CHECK_SEC', 0),
+            patch.dict(self.agent._cores_index_state),
+            patch.dict(self.agent._arduino_data_dir_cache, {'/usr/bin/arduino-cli': self.data_dir}),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+        self.core_list_calls = 0
+
+    def _fake_run(self, cmd, *args, **kwargs):
+        if cmd[1:] == ['core', 'list']:
+            self.core_list_calls += 1
+        return MagicMock(returncode=0, stdout='ID Installed Latest Name\narduino:avr 1.8.6 1.8.6 AVR', stderr='')
+
+    def test_core_list_only_once_until_data_dir_changes(self):
+        """Consultas repetidas no lanzan el CLI; un cambio en packages/ recarga el índice."""
+        with patch('agent.agent.subprocess.run', side_effect=self._fake_run):
+            for _ in range(3):
+                self.assertEqual(self.agent.ensure_core_for_fqbn('arduino:avr:uno', lambda m: None), (True, None))
+            self.assertEqual(self.agent._get_core_version('arduino:avr'), '1.8.6')
+            self.assertEqual(self.core_list_calls, 1)
+
+            os.makedirs(os.path.join(self.data_dir, 'packages', 'esp32', 'hardware', 'esp32'))
+            self.assertTrue(self.agent._is_core_installed('arduino:avr'))
+        self.assertEqual(self.core_list_calls, 2)
+
+    def test_miss_confirms_with_cli_before_installing(self):
+        """Un core ausente del índice se confirma con `core list` antes de instalar."""
+        with patch('agent.agent.subprocess.run', side_effect=self._fake_run) as mock_run:
+            self.agent._refresh_cores_index()
+            ok, _ = self.agent.ensure_core_for_fqbn('esp32:esp32:esp32', lambda m: None)
+        self.assertTrue(ok)
+        self.assertIn(['/usr/bin/arduino-cli', 'core', 'install', 'esp32:esp32'],
+                      [c.args[0] for c in mock_run.call_args_list])
+        # refresh inicial + confirmación del fallo + recarga tras instalar
+        self.assertEqual(self.core_list_calls, 3)
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestBoardsRegistry(unittest.TestCase):
+    """Registry de placas indexado, con registries extra y recarga por mtime."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.extra = os.path.join(tempfile.mkdtemp(), 'extra.json')
+        self._write_extra([{'label': 'Pro Mini', 'fqbn': 'arduino:avr:pro', 'family': 'avr', 'notes': '',
+                            'usb': [{'vid': '0x1A86', 'pid': '0x7523'}]}])
+        for p in (patch.object(self.agent, 'BOARDS_REGISTRY_EXTRA', [self.extra]),
+                  patch.object(self.agent, 'BOARDS_REGISTRY_CHECK_SEC', 0)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _write_extra(self, boards):
+        with open(self.extra, 'w', encoding='utf-8') as f:
+            json.dump(boards, f)
+
+    def test_lookups_and_extra_registry(self):
+        """Búsqueda por FQBN, familia y VID/PID, incluyendo placas de un registry extra."""
+        self.assertEqual(self.agent._get_board_by_fqbn('esp32:esp32:esp32')['family'], 'esp32')
+        self.assertEqual(self.agent._get_board_by_fqbn('arduino:avr:pro')['label'], 'Pro Mini')
+        self.assertIn('arduino:avr:pro', [b['fqbn'] for b in self.agent._get_boards_by_family('avr')])
+        self.assertEqual([b['fqbn'] for b in self.agent._get_boards_by_usb(0x2341, 0x0043)], ['arduino:avr:uno'])
+        self.assertEqual([b['fqbn'] for b in self.agent._get_boards_by_usb(0x1A86, 0x7523)], ['arduino:avr:pro'])
+
+    def test_reload_when_file_changes(self):
+        """Sin cambios se reutiliza el índice; al modificar el archivo se recarga."""
+        first = self.agent._get_boards_index()
+        self.assertIs(self.agent._get_boards_index(), first)
+        self._write_extra([{'label': 'UNO clon', 'fqbn': 'arduino:avr:uno', 'family': 'avr', 'notes': 'x'}])
+        st = os.stat(self.extra)
+        os.utime(self.extra, ns=(st.st_atime_ns, st.st_mtime_ns + 10_000_000))
+        self.assertIsNone(self.agent._get_board_by_fqbn('arduino:avr:pro'))
+        self.assertEqual(self.agent._get_board_by_fqbn('arduino:avr:uno')['label'], 'UNO clon')
+        self.assertEqual(len(self.agent._load_boards_registry()), len(first['boards']) - 1)
+
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestCliScheduler(unittest.TestCase):
+    """Scheduler de arduino-cli: compilaciones acotadas y las de upload primero."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        p = patch.object(self.agent, 'CLI_SLOTS', 1)
+        p.start()
+        self.addCleanup(p.stop)
+        self.compile_cmd = ['/usr/bin/arduino-cli', 'compile', '--fqbn', 'arduino:avr:uno', '/tmp/s']
+
+    def _queued(self, name, priority, order, stats):
+        def run():
+            with self.agent._cli_priority(priority) as st:
+                with self.agent._cli_slot(self.compile_cmd):
+                    order.append(name)
+            stats[name] = st
+        t = threading.Thread(target=run)
+        t.start()
+        return t
+
+    def test_upload_compiles_jump_ahead_of_verify(self):
+        order, stats = [], {}
+        release = threading.Event()
+
+        def holder():
+            with self.agent._cli_slot(self.compile_cmd):
+                release.wait(5)
+        h = threading.Thread(target=holder)
+        h.start()
+        time.sleep(0.05)
+        threads = [self._queued('verify1', 'verify', order, stats)]
+        time.sleep(0.05)
+        threads.append(self._queued('verify2', 'verify', order, stats))
+        time.sleep(0.05)
+        threads.append(self._queued('upload', 'upload', order, stats))
+        time.sleep(0.05)
+        self.assertEqual(self.agent.get_cli_scheduler_status()['waiting'], 3)
+        release.set()
+        for t in [h] + threads:
+            t.join(5)
+        self.assertEqual(order, ['upload', 'verify1', 'verify2'])
+        self.assertGreater(stats['verify2']['wait_sec'], 0.1)
+        self.assertEqual(stats['verify2']['queue_depth'], 1)
+        self.assertEqual(self.agent.get_cli_scheduler_status()['running'], 0)
+
+    def test_light_commands_do_not_wait(self):
+        release = threading.Event()
+
+        def holder():
+            with self.agent._cli_slot(self.compile_cmd):
+                release.wait(5)
+        h = threading.Thread(target=holder)
+        h.start()
+        time.sleep(0.05)
+        t0 = time.time()
+        with self.agent._cli_slot(['/usr/bin/arduino-cli', 'upload', '-p', 'COM3']):
+            pass
+        self.assertLess(time.time() - t0, 0.05)
+        release.set()
+        h.join(5)
+
+    def test_cancelled_job_leaves_queue(self):
+        release = threading.Event()
+
+        def holder():
+            with self.agent._cli_slot(self.compile_cmd):
+                release.wait(5)
+        h = threading.Thread(target=holder)
+        h.start()
+        time.sleep(0.05)
+        job = self.agent._new_cli_job()
+        job['cancel_requested'] = True
+        self.agent._cli_context.job = job
+        try:
+            with self.assertRaises(self.agent.CompileCancelled):
+                with self.agent._cli_slot(self.compile_cmd):
+                    pass
+        finally:
+            self.agent._cli_context.job = None
+        self.assertEqual(self.agent.get_cli_scheduler_status()['waiting'], 0)
+        release.set()
+        h.join(5)
+
+    def test_compile_priority_from_request(self):
+        self.assertEqual(self.agent._compile_priority({'code': 'x'}), 'verify')
+        self.assertEqual(self.agent._compile_priority({'return_job_id': True}), 'upload')
+        self.assertEqual(self.agent._compile_priority({'options': {'return_job_id': True}}), 'upload')
+        resp = self.agent.app.test_client().post('/compile', json={'code': 'void setup(){}', 'fqbn': 'x:y:z'})
+        self.assertEqual(resp.get_json()['queue'], {'priority': 'verify', 'wait_sec': 0.0, 'queue_depth': 0})
+
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestCompileTimings(unittest.TestCase):
+    """Tiempos por fase a partir de lo que arduino-cli escribe en el build dir persistente."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        _isolate_home_tmp(self, self.agent)
+        self.warm_dir = tempfile.mkdtemp()
+        for p in (patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'),
+                  patch.object(self.agent, 'WARM_BUILD_DIR', self.warm_dir),
+                  patch.object(self.agent, 'COMPILE_CACHE_MAX_BYTES', 0),
+                  patch.object(self.agent, 'ensure_core_for_fqbn', return_value=(True, None)),
+                  patch.dict(self.agent._compile_timings, clear=True)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _fake_run(self, cmd, *args, **kwargs):
+        if len(cmd) < 2 or cmd[1] != 'compile':
+            return MagicMock(returncode=0, stdout='', stderr='')
+        build = Path(cmd[cmd.index('--build-path') + 1])
+        steps = [('includes.cache', 0.05), ('sketch/sketch_verify.ino.cpp.o', 0.1),
+                 ('core/core.a', 0.05), ('sketch_verify.ino.elf', 0.05), ('sketch_verify.ino.hex', 0.0)]
+        for rel, pause in steps:
+            (build / rel).parent.mkdir(parents=True, exist_ok=True)
+            (build / rel).write_bytes(b'x')
+            time.sleep(pause)
+        out = Path(cmd[cmd.index('--output-dir') + 1])
+        (out / 'sketch_verify.ino.hex').write_bytes(b':00000001FF\n')
+        return MagicMock(returncode=0, stdout='', stderr='')
+
+    def test_compile_response_has_phase_timings_and_summary(self):
+        client = self.agent.app.test_client()
+        with patch('agent.agent.subprocess.run', side_effect=self._fake_run):
+            data = client.post('/compile', json={'code': 'void setup(){} void loop(){}',
+                                                 'fqbn': 'arduino:avr:uno'}).get_json()
+        self.assertTrue(data['ok'], data)
+        timings = data['timings']
+        phases = timings['phases']
+        self.assertEqual(set(phases), set(self.agent.COMPILE_PHASES))
+        self.assertEqual(timings['reused'], ['libraries'])
+        self.assertGreaterEqual(phases['sketch'], 0.04)
+        self.assertGreaterEqual(phases['core'], 0.08)
+        self.assertEqual(timings['compiled_files']['sketch'], 1)
+        self.assertGreaterEqual(timings['total_sec'], sum(phases.values()))
+
+        summary = client.get('/diagnostics/compile?fqbn=arduino:avr:uno').get_json()['fqbns']
+        self.assertEqual(summary['arduino:avr:uno']['count'], 1)
+        self.assertEqual(summary['arduino:avr:uno']['reused_ratio']['libraries'], 1.0)
+
+    def test_queue_wait_is_not_charged_to_preprocess(self):
+        real_slot = self.agent._cli_slot
+
+        @self.agent.contextmanager
+        def slow_slot(cmd):
+            time.sleep(0.3)  # turno ocupado por otra compilación
+            with real_slot(cmd):
+                yield
+
+        with patch.object(self.agent, '_cli_slot', slow_slot), \
+                patch('agent.agent.subprocess.run', side_effect=self._fake_run):
+            data = self.agent.app.test_client().post('/compile', json={'code': 'void setup(){} void loop(){}',
+                                                                       'fqbn': 'arduino:avr:uno'}).get_json()
+        self.assertTrue(data['ok'], data)
+        timings = data['timings']
+        self.assertGreaterEqual(timings['queue_wait_sec'], 0.3)
+        self.assertLess(timings['phases']['preprocess'], 0.2)
+        self.assertGreaterEqual(timings['total_sec'], timings['queue_wait_sec'] + sum(timings['phases'].values()))
+
+    def test_old_files_count_as_reused(self):
+        with tempfile.TemporaryDirectory() as build:
+            (Path(build) / 'core').mkdir()
+            (Path(build) / 'core' / 'core.a').write_bytes(b'x')
+            t0 = time.time() + 1
+            (Path(build) / 'sketch.ino.hex').write_bytes(b'x')
+            os.utime(Path(build) / 'sketch.ino.hex', (t0 + 0.5, t0 + 0.5))
+            result = self.agent._compile_phase_timings(build, t0, t0 + 1)
+        self.assertIn('core', result['reused'])
+        self.assertEqual(result['phases']['output'], 0.5)
+        self.assertEqual(result['other_sec'], 0.5)
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestLibraryIndex(unittest.TestCase):
+    """Índice header -> librería y --library solo para lo que el sketch incluye."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.root = tempfile.mkdtemp()
+        self.bundled = os.path.join(self.root, 'bundled')
+        self.user = os.path.join(self.root, 'user')
+        self.data = os.path.join(self.root, 'data')
+        self._make_lib(self.bundled, 'Servo', ['Servo.h'], archs=['esp32'])
+        self._make_lib(os.path.join(self.user, 'libraries'), 'Servo', ['Servo.h'], props_archs='avr,megaavr')
+        os.makedirs(os.path.join(self.data, 'libraries'))
+        for p in (patch.object(self.agent, 'BUNDLED_LIBRARIES_DIR', self.bundled),
+                  patch.object(self.agent, '_get_arduino_user_dir', return_value=self.user),
+                  patch.object(self.agent, '_get_arduino_data_dir', return_value=self.data),
+                  patch.object(self.agent, 'LIBRARY_INDEX_CHECK_SEC', 0),
+                  patch.dict(self.agent._library_index, {'signature': None, 'checked_at': 0.0,
+                                                         'headers': {}, 'count': 0})):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _make_lib(self, root, name, headers, archs=None, props_archs='*'):
+        lib = os.path.join(root, name)
+        src = os.path.join(lib, 'src')
+        os.makedirs(src)
+        with open(os.path.join(lib, 'library.properties'), 'w') as f:
+            f.write(f'name={name}\narchitectures={props_archs}\n')
+        for header in headers:
+            Path(src, header).write_text('#pragma once\n')
+        for arch in archs or []:
+            os.makedirs(os.path.join(src, arch))
+        return lib
+
+    def test_esp32_uses_bundled_servo(self):
+        args = self.agent._library_args_for_sketch(
+            'esp32:esp32:esp32', {'s.ino': '#include <Servo.h>\nvoid setup(){} void loop(){}'})
+        self.assertEqual(args, ['--library', os.path.join(self.bundled, 'Servo')])
+
+    def test_no_include_no_library_args(self):
+        self.assertEqual(self.agent._library_args_for_sketch('esp32:esp32:esp32', {'s.ino': 'void setup(){}'}), [])
+
+    def test_incompatible_bundled_leaves_discovery_to_cli(self):
+        args = self.agent._library_args_for_sketch('arduino:avr:uno', {'s.ino': '#include <Servo.h>'})
+        self.assertEqual(args, [])
+
+    def test_sketch_local_headers_ignored(self):
+        self._make_lib(self.bundled, 'Config', ['config.h'])
+        args = self.agent._library_args_for_sketch(
+            'esp32:esp32:esp32', {'s.ino': '#include "config.h"', 'config.h': '#define X 1'})
+        self.assertEqual(args, [])
+
+    def test_cache_key_changes_with_library_version(self):
+        sketch = {'s.ino': '#include <Servo.h>\nvoid setup(){} void loop(){}'}
+        props = os.path.join(self.user, 'libraries', 'Servo', 'library.properties')
+        with patch.object(self.agent, '_get_arduino_cli_version', return_value='1.1.1'), \
+                patch.object(self.agent, '_get_core_version', return_value='1.8.6'):
+            Path(props).write_text('name=Servo\nversion=1.2.1\narchitectures=avr\n')
+            before = self.agent._compile_cache_key(sketch, 'arduino:avr:uno', [])
+            self.assertEqual(before, self.agent._compile_cache_key(sketch, 'arduino:avr:uno', []))
+            Path(props).write_text('name=Servo\nversion=1.2.2\narchitectures=avr\n')
+            after = self.agent._compile_cache_key(sketch, 'arduino:avr:uno', [])
+        self.assertNotEqual(before, after)
+        self.assertEqual(self.agent._sketch_library_versions('arduino:avr:uno', {'s.ino': 'void setup(){}'}), {})
+
+    def test_duplicate_header_is_pinned_and_index_refreshes(self):
+        sketch = {'s.ino': '#include <Adafruit_Sensor.h>'}
+        self.assertEqual(self.agent._library_args_for_sketch('arduino:avr:uno', sketch), [])
+        libs = os.path.join(self.user, 'libraries')
+        self._make_lib(libs, 'Zeta_Sensor', ['Adafruit_Sensor.h'])
+        self._make_lib(libs, 'Adafruit_Unified_Sensor', ['Adafruit_Sensor.h'])
+        os.utime(libs, ns=(time.time_ns() + 10**9,) * 2)
+        args = self.agent._library_args_for_sketch('arduino:avr:uno', sketch)
+        self.assertEqual(args, ['--library', os.path.join(libs, 'Adafruit_Unified_Sensor')])
+        self.assertEqual(self.agent.get_library_index_status()['libraries'], 4)
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestPrewarm(unittest.TestCase):
+    """Pre-calentamiento de los slots persistentes por FQBN del registry."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.home_tmp = tempfile.mkdtemp()
+        installed = {'arduino:avr': '1.8.6'}
+        for p in (patch.object(self.agent, '_get_home_tmp', return_value=self.home_tmp),
+                  patch.object(self.agent, 'PREWARM_IDLE_SEC', 0),
+                  patch.object(self.agent, '_get_core_version', side_effect=installed.get),
+                  patch.object(self.agent, '_load_boards_registry', return_value=[
+                      {'fqbn': 'arduino:avr:uno'}, {'fqbn': 'arduino:avr:nano'},
+                      {'fqbn': 'arduino:avr:uno'}, {'fqbn': 'esp32:esp32:esp32'}]),
+                  patch.dict(self.agent._prewarm_state, {'state': 'disabled', 'total': 0, 'current': None,
+                                                         'job': None, 'results': {}, 'last_request_at': 0.0})):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_prewarm_compiles_each_installed_fqbn_once(self):
+        calls = []
+
+        def fake_compile(fqbn, sketch_files, output_dir, extra_args, log_func, **kwargs):
+            calls.append((fqbn, list(sketch_files), self.agent._cli_context.priority,
+                          self.agent._cli_context.job['low_priority']))
+            return MagicMock(returncode=0, stdout='', stderr='')
+
+        with patch.object(self.agent, '_compile_sketch', side_effect=fake_compile):
+            self.agent._prewarm_run(self.agent._prewarm_fqbns())
+        self.assertEqual(calls, [('arduino:avr:uno', ['sketch_verify.ino'], 'prewarm', True),
+                                 ('arduino:avr:nano', ['sketch_verify.ino'], 'prewarm', True)])
+        status = self.agent.get_prewarm_status()
+        self.assertEqual(status['state'], 'done')
+        self.assertEqual((status['total'], status['done']), (3, 3))
+        self.assertEqual(status['results']['esp32:esp32:esp32']['state'], 'skipped')
+        self.assertEqual(status['results']['arduino:avr:uno']['state'], 'ok')
+        self.assertEqual(os.listdir(self.home_tmp), [])
+
+    def test_real_compile_preempts_prewarm_which_retries_later(self):
+        attempts = []
+
+        def fake_compile(fqbn, *args, **kwargs):
+            attempts.append(fqbn)
+            if len(attempts) == 1:
+                # Llega una compilación real mientras se pre-calienta
+                with self.agent._cli_priority('verify'):
+                    with self.agent._cli_slot([self.agent.ARDUINO_CLI, 'compile']):
+                        pass
+                self.assertTrue(self.agent._cli_context.job['cancel_requested'])
+                raise self.agent.CompileCancelled()
+            return MagicMock(returncode=0, stdout='', stderr='')
+
+        with patch.object(self.agent, '_compile_sketch', side_effect=fake_compile):
+            self.agent._prewarm_run(['arduino:avr:uno'])
+        self.assertEqual(attempts, ['arduino:avr:uno', 'arduino:avr:uno'])
+        self.assertEqual(self.agent.get_prewarm_status()['results']['arduino:avr:uno']['state'], 'ok')
+
+
+class _FakeRpcError(Exception):
+    def __init__(self, code, details=''):
+        super().__init__(details)
+        self._code, self._details = code, details
+
+    def code(self):
+        return self._code
+
+    def details(self):
+        return self._details
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestCliDaemonBackend(unittest.TestCase):
+    """Backend gRPC (arduino-cli daemon) con subprocess como respaldo; stubs falsos."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        request = lambda **kw: kw  # noqa: E731
+        status = types.SimpleNamespace(DEADLINE_EXCEEDED='deadline', CANCELLED='cancelled', UNAVAILABLE='unavailable')
+        self.api = {
+            'grpc': types.SimpleNamespace(RpcError=_FakeRpcError, StatusCode=status),
+            'commands': types.SimpleNamespace(VersionRequest=request),
+            'core': types.SimpleNamespace(PlatformSearchRequest=request),
+            'compile': types.SimpleNamespace(CompileRequest=request),
+            'upload': types.SimpleNamespace(UploadRequest=request),
+            'port': types.SimpleNamespace(Port=request),
+        }
+        self.stub = MagicMock()
+        self.real_ensure = self.agent._cli_daemon_ensure
+        for p in (patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'),
+                  patch.object(self.agent, 'CLI_BACKEND', 'daemon'),
+                  patch.object(self.agent, '_cli_daemon_ensure', return_value=(self.api, self.stub, 'inst')),
+                  patch.dict(self.agent._cli_daemon, {'calls': 0, 'fallbacks': 0, 'stub': self.stub})):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_failed_start_kills_daemon_outside_lock(self):
+        """Si el canal gRPC no queda listo, el daemon lanzado se mata y el lock no se retiene al esperar."""
+        proc = MagicMock(pid=4321, stdout=iter(['{"Port": "50051"}\n']))
+        proc.poll.return_value = None
+        channel = MagicMock()
+        lock_held = []
+
+        def not_ready(timeout):
+            lock_held.append(self.agent._cli_daemon_lock.locked())
+            raise TimeoutError('canal no listo')
+
+        self.api['grpc'].insecure_channel = MagicMock(return_value=channel)
+        self.api['grpc'].channel_ready_future = lambda ch: MagicMock(result=not_ready)
+        with patch.dict(self.agent._cli_daemon, {'api': self.api, 'proc': None, 'stub': None,
+                                                 'failed_at': 0.0, 'starting': False}), \
+                patch.object(self.agent.subprocess, 'Popen', return_value=proc), \
+                patch.object(self.agent, '_kill_process_tree') as kill:
+            self.assertIsNone(self.real_ensure())
+            self.assertFalse(self.agent._cli_daemon['starting'])
+            self.assertIn('canal no listo', self.agent._cli_daemon['error'])
+        kill.assert_called_once_with(proc)
+        channel.close.assert_called_once()
+        self.assertEqual(lock_held, [False])
+
+    def test_compile_argv_maps_to_rpc(self):
+        self.stub.Compile.return_value = iter([MagicMock(out_stream=b'Sketch uses 444 bytes\n', err_stream=b''),
+                                               MagicMock(out_stream=b'', err_stream=b'warning: x\n')])
+        cmd = ['/usr/bin/arduino-cli', 'compile', '--fqbn', 'esp32:esp32:esp32', '--build-path', '/b',
+               '--build-cache-path', '/c', '--output-dir', '/o', '--library', '/libs/Servo', '/s/sketch_verify']
+        with patch('agent.agent.subprocess.run') as run:
+            r = self.agent._run_cli(cmd, 60)
+        run.assert_not_called()
+        self.assertEqual((r.returncode, r.stdout, r.stderr), (0, 'Sketch uses 444 bytes\n', 'warning: x\n'))
+        req = self.stub.Compile.call_args[0][0]
+        self.assertEqual((req['fqbn'], req['sketch_path'], req['build_path'], req['export_dir'], req['library']),
+                         ('esp32:esp32:esp32', '/s/sketch_verify', '/b', '/o', ['/libs/Servo']))
+        self.assertEqual(self.stub.Compile.call_args[1]['timeout'], 60)
+
+    def test_version_and_core_list_keep_cli_output_format(self):
+        self.stub.Version.return_value = MagicMock(version='1.1.1')
+        self.stub.PlatformSearch.return_value = MagicMock(search_output=[
+            MagicMock(metadata=MagicMock(id='arduino:avr'), installed_version='1.8.6', latest_version='1.8.6'),
+            MagicMock(metadata=MagicMock(id='esp32:esp32'), installed_version='', latest_version='3.0.7')])
+        with patch.dict(self.agent._cli_version_cache, clear=True), \
+                patch.object(self.agent, '_get_arduino_data_dir', return_value=None), \
+                patch.object(self.agent, '_installed_core_versions', None):
+            self.assertEqual(self.agent._get_arduino_cli_version(), '1.1.1')
+            self.assertEqual(self.agent._refresh_cores_index(), {'arduino:avr': '1.8.6'})
+
+    def test_compile_error_and_unavailable_daemon(self):
+        self.stub.Compile.side_effect = _FakeRpcError('unknown', 'platform not installed')
+        cmd = ['/usr/bin/arduino-cli', 'compile', '--fqbn', 'arduino:avr:uno', '/s/sketch']
+        r = self.agent._exec_cli(cmd, 60)
+        self.assertEqual(r.returncode, 1)
+        self.assertIn('platform not installed', r.stderr)
+
+        self.stub.Compile.side_effect = _FakeRpcError('unavailable')
+        with patch('agent.agent.subprocess.run', return_value=MagicMock(returncode=0, stdout='ok', stderr='')) as run:
+            r = self.agent._exec_cli(cmd, 60)
+        run.assert_called_once()
+        self.assertEqual(r.stdout, 'ok')
+        self.assertIsNone(self.agent._cli_daemon['stub'])
+        self.assertEqual(self.agent._cli_daemon['fallbacks'], 1)
+
+    def test_deadline_raises_timeout(self):
+        self.stub.Upload.side_effect = _FakeRpcError('deadline')
+        cmd = ['/usr/bin/arduino-cli', 'upload', '-p', '/dev/ttyUSB0', '--fqbn', 'arduino:avr:uno',
+               '--input-file', '/t/fw.hex', '-v']
+        with self.assertRaises(self.agent.subprocess.TimeoutExpired):
+            self.agent._exec_cli(cmd, 5)
+        req = self.stub.Upload.call_args[0][0]
+        self.assertEqual((req['port']['address'], req['import_file'], req['verbose']), ('/dev/ttyUSB0', '/t/fw.hex', True))
+
+    def test_unsupported_commands_use_subprocess(self):
+        for cmd in (['/usr/bin/arduino-cli', 'core', 'install', 'esp32:esp32'],
+                    ['/usr/bin/arduino-cli', 'compile', '--export-binaries', '/s'],
+                    [sys.executable, '-m', 'esptool', 'version']):
+            self.assertIsNone(self.agent._cli_daemon_exec(cmd, 10))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,138 @@
+"""
+Tests para la cola asíncrona de compilación (/compile/jobs).
+- job terminado queda disponible para /upload por job_id
+- DELETE mata arduino-cli (proceso real: script falso de arduino-cli)
+
+Ejecutar: pip install -r agent/requirements.txt && pytest agent/tests/test_compile_jobs.py -v
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+try:
+    import flask
+except ImportError:
+    flask = None
+
+project_root = Path(__file__).resolve().parent.parent.parent
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+
+def _isolate_home_tmp(test, agent):
+    """home_tmp temporal y caché/jobs en memoria vacíos: el test no toca ~/.maxide-agent."""
+    home_tmp = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, home_tmp, True)
+    for p in (patch.object(agent, '_get_home_tmp', return_value=home_tmp),
+              patch.object(agent, '_compile_cache_index', None),
+              patch.dict(agent._compile_cache_stats),
+              patch.dict(agent._upload_job_store, clear=True),
+              patch.dict(agent._compile_jobs, clear=True)):
+        p.start()
+        test.addCleanup(p.stop)
+    return home_tmp
+
+# arduino-cli falso: version / core list / compile (SLEEP en el código → tarda)
+FAKE_CLI = '''#!{python}
+import os, sys, time
+args = sys.argv[1:]
+if args[:1] == ['version']:
+    print('arduino-cli  Version: 1.1.1')
+elif args[:2] == ['core', 'list']:
+    print('ID Installed Latest Name')
+    print('arduino:avr 1.8.6 1.8.6 Arduino AVR Boards')
+elif args[:1] == ['compile']:
+    sketch_dir = args[-1]
+    code = open(os.path.join(sketch_dir, os.path.basename(sketch_dir) + '.ino')).read()
+    if 'SLEEP' in code:
+        time.sleep(30)
+    out = args[args.index('--output-dir') + 1]
+    with open(os.path.join(out, 'sketch_verify.ino.hex'), 'w') as f:
+        f.write(':00000001FF\\n')
+    print('Sketch uses 444 bytes')
+'''
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. pip install -r agent/requirements.txt")
+@unittest.skipIf(sys.platform.startswith('win'), "Script falso de arduino-cli solo en POSIX")
+class TestCompileJobs(unittest.TestCase):
+    """POST/GET/DELETE /compile/jobs"""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.client = self.agent.app.test_client()
+        _isolate_home_tmp(self, self.agent)
+        tmp = tempfile.mkdtemp()
+        cli = Path(tmp) / 'arduino-cli'
+        cli.write_text(FAKE_CLI.format(python=sys.executable))
+        cli.chmod(0o755)
+        for p in (patch.object(self.agent, 'ARDUINO_CLI', str(cli)),
+                  patch.object(self.agent, 'COMPILE_CACHE_DIR', os.path.join(tmp, 'cache')),
+                  patch.object(self.agent, '_compile_cache_index', None),
+                  patch.object(self.agent, 'WARM_BUILD_DIR', os.path.join(tmp, 'warm'))):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _submit(self, code):
+        resp = self.client.post('/compile/jobs', data=json.dumps({'fqbn': 'arduino:avr:uno', 'code': code}),
+                                content_type='application/json')
+        self.assertEqual(resp.status_code, 202)
+        return resp.get_json()['job_id']
+
+    def _wait(self, job_id, statuses, timeout=20):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            data = self.client.get(f'/compile/jobs/{job_id}').get_json()
+            if data['status'] in statuses:
+                return data
+            time.sleep(0.05)
+        self.fail(f'job {job_id} no llegó a {statuses}: {data}')
+
+    def test_job_completes_and_is_reusable_for_upload(self):
+        """Un job terminado devuelve el resultado y queda registrado para upload."""
+        job_id = self._submit('void setup() {} void loop() {} // job ok')
+        data = self._wait(job_id, ('done', 'failed'))
+        self.assertEqual(data['status'], 'done', data)
+        self.assertTrue(data['result']['ok'])
+        self.assertEqual(data['result']['job_id'], job_id)
+        self.assertEqual(data['progress'], 1.0)
+        upload_job = self.agent._get_upload_job(job_id)
+        self.assertIsNotNone(upload_job)
+        self.assertTrue(any(f.endswith('.hex') for f in os.listdir(upload_job['build_dir'])))
+
+    def test_delete_kills_running_compile(self):
+        """DELETE durante la compilación mata arduino-cli y marca el job como cancelado."""
+        job_id = self._submit('void setup() {} void loop() {} // SLEEP')
+        running = self._wait(job_id, ('running',))
+        self.assertEqual(running['status'], 'running')
+        self._wait_for_process(job_id)
+        t0 = time.time()
+        self.client.delete(f'/compile/jobs/{job_id}')
+        data = self._wait(job_id, ('cancelled', 'done', 'failed'), timeout=10)
+        self.assertEqual(data['status'], 'cancelled')
+        self.assertLess(time.time() - t0, 10)
+
+    def _wait_for_process(self, job_id, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.agent._compile_jobs_lock:
+                if self.agent._compile_jobs[job_id]['proc'] is not None:
+                    return
+            time.sleep(0.05)
+
+    def test_unknown_job_returns_404(self):
+        resp = self.client.get('/compile/jobs/nonexistent')
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.get_json()['error_code'], 'JOB_NOT_FOUND')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Tests unitarios para GET /ports y GET /ports/changes del Agent.
+- tabla en memoria con ETag / 304
+- long-poll que responde al conectar una placa
+
+Ejecutar con dependencias del Agent instaladas:
+  pip install -r agent/requirements.txt
+  pytest agent/tests/test_ports.py -v
+"""
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+try:
+    import flask
+except ImportError:
+    flask = None
+
+project_root = Path(__file__).resolve().parent.parent.parent
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+
+def _fake_port(device, vid=0x2341, pid=0x0043):
+    port = MagicMock(device=device, description='Arduino Uno', vid=vid, pid=pid,
+                     serial_number='123', manufacturer='Arduino', product='Uno', hwid='USB VID:PID')
+    port.name = device.split('/')[-1]
+    return port
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. Ejecuta: pip install -r agent/requirements.txt")
+class TestPortsWatcher(unittest.TestCase):
+    """Watcher de puertos: /ports desde memoria y long-poll de cambios."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.client = self.agent.app.test_client()
+        self.ports = [_fake_port('/dev/ttyACM0')]
+        patchers = [
+            # Sin hilo real: los tests llaman a _refresh_ports()
+            patch.object(self.agent, '_ports_watcher_thread', MagicMock()),
+            patch.object(self.agent.serial.tools.list_ports, 'comports', side_effect=lambda: list(self.ports)),
+            patch.dict(self.agent._ports_state, {'ports': [], 'total_scanned': 0, 'all_devices': [], 'version': 0,
+                                                 'etag': None, 'scanned_at': None, 'error': None}),
+            patch.object(self.agent, '_ports_info_cache', {}),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_ports_etag_and_304(self):
+        """Sin cambios, /ports responde 304 al If-None-Match y no reconstruye port_info."""
+        with patch.object(self.agent, '_build_port_info', wraps=self.agent._build_port_info) as build:
+            resp = self.client.get('/ports')
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.get_json()['ports'][0]['device'], '/dev/ttyACM0')
+            self.agent._refresh_ports()
+            again = self.client.get('/ports', headers={'If-None-Match': etag})
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(build.call_count, 1)
+        self.assertTrue(self.agent._port_exists('/dev/ttyACM0'))
+        self.assertFalse(self.agent._port_exists('/dev/ttyUSB9'))
+
+    def test_longpoll_returns_when_board_plugged(self):
+        """/ports/changes espera hasta que aparece un puerto nuevo."""
+        version = self.client.get('/ports').get_json()['version']
+        result = {}
+
+        def poll():
+            result['resp'] = self.client.get(f'/ports/changes?since={version}&timeout=5')
+
+        t = threading.Thread(target=poll)
+        t0 = time.time()
+        t.start()
+        time.sleep(0.2)
+        self.ports.append(_fake_port('/dev/ttyUSB0', vid=0x10C4, pid=0xEA60))
+        self.agent._refresh_ports()
+        t.join(5)
+        data = result['resp'].get_json()
+        self.assertLess(time.time() - t0, 4)
+        self.assertTrue(data['changed'])
+        self.assertEqual(data['added'], ['/dev/ttyUSB0'])
+        self.assertEqual(data['count'], 2)
+
+        timeout = self.client.get(f"/ports/changes?since={data['version']}&timeout=0.1").get_json()
+        self.assertFalse(timeout['changed'])
+
+    def test_scan_from_old_registry_does_not_overwrite_cache(self):
+        """Dos escaneos a la vez (watcher y /ports): el que empezó con el registry viejo no publica su caché."""
+        registries = ['old']
+        comports = self.agent.serial.tools.list_ports.comports
+
+        def scan_during_comports():
+            if registries == ['old']:
+                registries[0] = 'new'
+                self.agent._scan_ports()  # otro hilo escanea mientras comports() de este sigue
+            return list(self.ports)
+
+        built = []
+
+        def build(port, log):
+            built.append({'device': port.device})
+            return built[-1]
+
+        with patch.object(self.agent, '_get_boards_index', side_effect=lambda: registries[0]), \
+                patch.object(self.agent, '_ports_info_registry', None), \
+                patch.object(self.agent, '_build_port_info', side_effect=build), \
+                patch.object(comports, 'side_effect', scan_during_comports):
+            self.agent._scan_ports()
+            self.assertEqual(self.agent._ports_info_registry, 'new')
+            self.assertEqual(len(built), 2)
+            # queda la caché del escaneo con el registry nuevo, no la del viejo
+            self.assertIs(list(self.agent._ports_info_cache.values())[0], built[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Tests para /compile/stream y /upload/stream (Server-Sent Events).
+- eventos phase / log / result en orden
+- salida muy verbosa: memoria acotada (CLI_OUTPUT_MAX_LINES)
+
+Ejecutar: pip install -r agent/requirements.txt && pytest agent/tests/test_stream.py -v
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+try:
+    import flask
+except ImportError:
+    flask = None
+
+project_root = Path(__file__).resolve().parent.parent.parent
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+from agent.tests.test_compile_jobs import FAKE_CLI
+
+
+def _parse_sse(body):
+    """Convierte el cuerpo text/event-stream en [(event, data), ...]."""
+    events = []
+    for block in body.split('\n\n'):
+        lines = [l for l in block.split('\n') if l and not l.startswith(':')]
+        if not lines:
+            continue
+        event = next(l[len('event: '):] for l in lines if l.startswith('event: '))
+        data = json.loads(next(l[len('data: '):] for l in lines if l.startswith('data: ')))
+        events.append((event, data))
+    return events
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. pip install -r agent/requirements.txt")
+@unittest.skipIf(sys.platform.startswith('win'), "Script falso de arduino-cli solo en POSIX")
+class TestCompileStream(unittest.TestCase):
+    """POST /compile/stream"""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.client = self.agent.app.test_client()
+        tmp = tempfile.mkdtemp()
+        cli = Path(tmp) / 'arduino-cli'
+        cli.write_text(FAKE_CLI.format(python=sys.executable))
+        cli.chmod(0o755)
+        home_tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home_tmp, True)
+        for p in (patch.object(self.agent, '_get_home_tmp', return_value=home_tmp),
+                  patch.object(self.agent, 'ARDUINO_CLI', str(cli)),
+                  patch.object(self.agent, 'COMPILE_CACHE_DIR', os.path.join(tmp, 'cache')),
+                  patch.object(self.agent, '_compile_cache_index', None),
+                  patch.object(self.agent, 'WARM_BUILD_DIR', os.path.join(tmp, 'warm'))):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_stream_emits_phases_lines_and_result(self):
+        resp = self.client.post('/compile/stream', data=json.dumps({
+            'fqbn': 'arduino:avr:uno', 'code': 'void setup() {} void loop() {} // stream'
+        }), content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.mimetype.startswith('text/event-stream'))
+        events = _parse_sse(resp.get_data(as_text=True))
+
+        phases = [d['phase'] for e, d in events if e == 'phase']
+        self.assertEqual(phases[:3], ['preparing', 'compiling', 'collecting'])
+        lines = [d['line'] for e, d in events if e == 'log']
+        self.assertTrue(any('Sketch uses' in l for l in lines), lines)
+        self.assertEqual(events[-1][0], 'result')
+        result = events[-1][1]
+        self.assertTrue(result['ok'], result)
+        self.assertEqual(result['http_status'], 200)
+        self.assertNotIn('logs', result)
+
+    def test_verbose_output_is_bounded(self):
+        """Con salida enorme solo se retienen CLI_OUTPUT_MAX_LINES líneas."""
+        emitted = []
+        job = self.agent._new_cli_job(sink=lambda event, data: emitted.append(data))
+        cmd = [sys.executable, '-c', 'for i in range(3000): print("linea", i)']
+        self.agent._cli_context.job = job
+        try:
+            with patch.object(self.agent, 'CLI_OUTPUT_MAX_LINES', 100):
+                r = self.agent._run_cli(cmd, 30)
+        finally:
+            self.agent._cli_context.job = None
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(len(emitted), 3000)
+        out_lines = r.stdout.splitlines()
+        self.assertEqual(len(out_lines), 101)
+        self.assertIn('2900 líneas omitidas', out_lines[0])
+        self.assertEqual(out_lines[-1], 'linea 2999')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,15 +4,24 @@ Tests unitarios para POST /upload del Agent.
 - FQBN inválido
 - job_id no encontrado
 - Retrocompat: code, hex_url
+- Artefactos por URL: sesión HTTP compartida y caché por sha256
 
 Ejecutar: pip install -r agent/requirements.txt && pytest agent/tests/test_upload.py -v
 """
+import hashlib
+import io
 import json
+import os
+import shutil
 import sys
 import tempfile
+import threading
+import time
+import types
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, create_autospec
 
 try:
     import flask
@@ -35,6 +44,12 @@ class TestUploadEndpoint(unittest.TestCase):
             self._port_exists = _port_exists
             self._upload_job_store = _upload_job_store
             self._store_upload_job = _store_upload_job
+            import agent.agent as agent_mod
+        ledger_dir = tempfile.mkdtemp()
+        for p in (patch.object(agent_mod, '_get_flash_ledger_path', lambda: os.path.join(ledger_dir, 'ledger.json')),
+                  patch.dict(agent_mod._flash_ledger, clear=True)):
+            p.start()
+            self.addCleanup(p.stop)
         self.client = self.app.test_client()
 
     def _upload_post(self, data):
@@ -136,5 +151,734 @@ class TestUploadEndpoint(unittest.TestCase):
                 self.assertEqual(resp.get_json().get('family'), 'avr')
 
 
+@unittest.skipIf(flask is None, "Flask no instalado. pip install -r agent/requirements.txt")
+class TestUploadJobStore(unittest.TestCase):
+    """Job store acotado, con barrido de directorios e índice persistente."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.jobs_dir = tempfile.mkdtemp()
+        for p in (patch.object(self.agent, '_get_upload_jobs_dir', lambda: self.jobs_dir),
+                  patch.object(self.agent, '_job_sweeper_thread', MagicMock()),
+                  patch.dict(self.agent._upload_job_store, clear=True)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _make_job(self, job_id, size=10):
+        job_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(job_dir)
+        with open(os.path.join(job_dir, 'sketch.ino.hex'), 'wb') as f:
+            f.write(b'x' * size)
+        return self.agent._store_upload_job(job_dir, 'avr', 'arduino:avr:uno', job_id)
+
+    def test_limits_drop_oldest_and_delete_dirs(self):
+        """Al superar el límite de jobs o bytes se descarta el más antiguo y su directorio."""
+        with patch.object(self.agent, 'UPLOAD_JOBS_MAX', 2):
+            for jid in ('a', 'b', 'c'):
+                self._make_job(jid)
+        self.assertEqual(list(self.agent._upload_job_store), ['b', 'c'])
+        self.assertFalse(os.path.exists(os.path.join(self.jobs_dir, 'a')))
+        with patch.object(self.agent, 'UPLOAD_JOBS_MAX_BYTES', 25):
+            self._make_job('d')
+        self.assertEqual(list(self.agent._upload_job_store), ['c', 'd'])
+        status = self.agent.get_upload_jobs_status()
+        self.assertEqual((status['count'], status['bytes']), (2, 20))
+
+    def test_sweep_removes_expired_and_orphan_dirs(self):
+        """El barrido borra jobs expirados y directorios huérfanos viejos."""
+        self._make_job('old')
+        self._make_job('new')
+        self.agent._upload_job_store['old']['created_at'] -= self.agent.JOB_TTL_SEC + 1
+        orphan = os.path.join(self.jobs_dir, 'orphan')
+        os.makedirs(orphan)
+        past = time.time() - self.agent.JOB_TTL_SEC - 1
+        os.utime(orphan, (past, past))
+        self.assertEqual(self.agent._sweep_upload_jobs(), 1)
+        self.assertEqual(sorted(os.listdir(self.jobs_dir)), ['index.json', 'new'])
+
+    @patch('agent.agent.ARDUINO_CLI', '/usr/bin/arduino-cli')
+    def test_upload_rejects_job_with_modified_artifact(self):
+        """Si un artefacto del job no coincide con el manifest, /upload responde JOB_INVALID."""
+        job_dir = os.path.join(self.jobs_dir, 'man')
+        src = os.path.join(tempfile.mkdtemp(), 'sketch.ino.hex')
+        with open(src, 'wb') as f:
+            f.write(b':00000001FF\n')
+        art = {'name': 'sketch.ino.hex', 'type': 'firmware', 'path': src, 'sha256': 'x', 'size': 12}
+        self.agent._handoff_job_artifacts([art], job_dir, move=True)
+        self.agent._store_upload_job(job_dir, 'avr', 'arduino:avr:uno', 'man')
+        with open(os.path.join(job_dir, 'sketch.ino.hex'), 'ab') as f:
+            f.write(b'garbage')
+        with patch.object(self.agent, '_port_exists', return_value=True):
+            resp = self.agent.app.test_client().post('/upload', json={'job_id': 'man', 'port': '/dev/ttyUSB0'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json()['error_code'], 'JOB_INVALID')
+
+    def test_index_survives_restart(self):
+        """jobs/index.json permite recuperar los job_id vigentes."""
+        self._make_job('persist')
+        self.agent._upload_job_store.clear()
+        self.assertEqual(self.agent._load_upload_job_index(), 1)
+        self.assertEqual(self.agent._get_upload_job('persist')['fqbn'], 'arduino:avr:uno')
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. pip install -r agent/requirements.txt")
+class TestUploadBatch(unittest.TestCase):
+    """POST /upload/batch: varias placas en paralelo con reintento por puerto."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.client = self.agent.app.test_client()
+        self.hex_path = os.path.join(tempfile.mkdtemp(), 'sketch.ino.hex')
+        with open(self.hex_path, 'wb') as f:
+            f.write(b':00000001FF\n')
+        self.calls = []
+        home_tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home_tmp, True)
+        for p in (patch.object(self.agent, '_get_home_tmp', return_value=home_tmp),
+                  patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'),
+                  patch.object(self.agent, 'ensure_core_for_fqbn', return_value=(True, None)),
+                  patch.object(self.agent, '_port_exists', side_effect=lambda port: port != 'COM9'),
+                  patch.object(self.agent, '_do_upload_avr', side_effect=self._fake_upload),
+                  patch.object(self.agent, '_get_flash_ledger_path', lambda: self.hex_path + '.ledger'),
+                  patch.dict(self.agent._flash_ledger, clear=True)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _fake_upload(self, port, fqbn, hex_file, log_func):
+        self.calls.append(port)
+        time.sleep(0.3)
+        if port == 'COM2' and self.calls.count('COM2') == 1:
+            return False, 'SYNC_FAIL', 'sync'
+        return True, None, None
+
+    def test_batch_runs_ports_concurrently_with_retry(self):
+        """4 placas tardan como una; un fallo transitorio se reintenta; un puerto ausente se reporta."""
+        resp = self.client.post('/upload/batch', json={
+            'fqbn': 'arduino:avr:uno', 'artifacts': [{'path': self.hex_path}],
+            'ports': ['COM1', 'COM2', 'COM3', 'COM4', 'COM9', 'COM1'], 'concurrency': 8,
+        })
+        self.assertEqual(resp.status_code, 200)
+        data = resp.get_json()
+        rows = {r['port']: r for r in data['results']}
+        self.assertEqual(list(rows), ['COM1', 'COM2', 'COM3', 'COM4', 'COM9'])
+        self.assertTrue(rows['COM1']['ok'])
+        self.assertEqual(rows['COM2']['attempts'], 2)
+        self.assertTrue(rows['COM2']['ok'])
+        self.assertEqual(rows['COM9']['error_code'], 'PORT_NOT_FOUND')
+        self.assertEqual((data['ok_count'], data['failed_count']), (4, 1))
+        self.assertFalse(data['ok'])
+        self.assertLess(data['wall_time_sec'], 2.5)
+        self.assertGreater(data['sum_time_sec'], data['wall_time_sec'])
+
+    def test_batch_requires_ports(self):
+        resp = self.client.post('/upload/batch', json={'fqbn': 'arduino:avr:uno', 'ports': []})
+        self.assertEqual(resp.status_code, 400)
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. pip install -r agent/requirements.txt")
+class TestFlashLedger(unittest.TestCase):
+    """Registro de firmware flasheado: /upload omite la placa si los sha256 no cambiaron."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.client = self.agent.app.test_client()
+        self.tmp = tempfile.mkdtemp()
+        self.ledger_path = os.path.join(self.tmp, 'flash_ledger.json')
+        home_tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home_tmp, True)
+        for p in (patch.object(self.agent, '_get_home_tmp', return_value=home_tmp),
+                  patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'),
+                  patch.object(self.agent, 'ensure_core_for_fqbn', return_value=(True, None)),
+                  patch.object(self.agent, '_port_exists', return_value=True),
+                  patch.object(self.agent, '_get_flash_ledger_path', lambda: self.ledger_path),
+                  patch.dict(self.agent._flash_ledger, clear=True)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_avr_same_hex_is_skipped_unless_forced(self):
+        hex_path = self._write('sketch.ino.hex', b':00000001FF\n')
+        body = {'fqbn': 'arduino:avr:uno', 'port': '/dev/ttyUSB0', 'artifacts': [{'path': hex_path}]}
+        with patch.object(self.agent, '_do_upload_avr', return_value=(True, None, None)) as up:
+            first = self.client.post('/upload', json=body).get_json()
+            second = self.client.post('/upload', json=body).get_json()
+            self.assertEqual(up.call_count, 1)
+            self.assertFalse(first['skipped'])
+            self.assertTrue(second['ok'] and second['skipped'])
+            self.client.post('/upload', json=dict(body, force=True))
+            self.assertEqual(up.call_count, 2)
+            self._write('sketch.ino.hex', b':00000001FF\n:00\n')
+            self.assertFalse(self.client.post('/upload', json=body).get_json()['skipped'])
+            self.assertEqual(up.call_count, 3)
+        with open(self.ledger_path, 'r', encoding='utf-8') as f:
+            self.assertIn('/dev/ttyUSB0|', json.load(f))
+
+    def test_failed_upload_forgets_device(self):
+        hex_path = self._write('sketch.ino.hex', b':00000001FF\n')
+        body = {'fqbn': 'arduino:avr:uno', 'port': '/dev/ttyUSB0', 'artifacts': [{'path': hex_path}]}
+        with patch.object(self.agent, '_do_upload_avr', return_value=(True, None, None)):
+            self.client.post('/upload', json=body)
+        with patch.object(self.agent, '_do_upload_avr', return_value=(False, 'SYNC_FAIL', 'sync')):
+            self.client.post('/upload', json=dict(body, force=True))
+        self.assertEqual(len(self.agent._flash_ledger), 0)
+
+    def test_esp32_unchanged_regions_left_out_of_esptool(self):
+        """Solo cambió el firmware: esptool no reescribe bootloader ni particiones."""
+        build = os.path.join(self.tmp, 'build')
+        self._write('build/sketch.ino.bootloader.bin', b'B' * 16)
+        self._write('build/sketch.ino.partitions.bin', b'P' * 16)
+        self._write('build/sketch.ino.bin', b'F' * 64)
+        self._write('build/sketch.ino.merged.bin', b'M' * 96)
+        body = {'fqbn': 'esp32:esp32:esp32', 'port': '/dev/ttyUSB0', 'build_dir': build}
+        with patch.object(self.agent, '_do_upload_esp32', return_value=(True, 'esptool', None, None, [])) as up:
+            self.client.post('/upload', json=body)
+            self.assertEqual(up.call_args[0][4], set())
+            self._write('build/sketch.ino.bin', b'G' * 64)
+            self.assertFalse(self.client.post('/upload', json=body).get_json()['skipped'])
+            self.assertEqual(up.call_args[0][4], {'bootloader', 'partitions'})
+
+        cli_fail = MagicMock(returncode=1, stdout='', stderr='upload error')
+        verify_fail = MagicMock(returncode=2, stdout='', stderr='Failed to connect')
+        esptool_ok = MagicMock(returncode=0, stdout='', stderr='')
+        with patch.object(self.agent, '_esp32_reset_for_bootloader', return_value=True), \
+                patch.object(self.agent, '_find_esptool', return_value='/usr/bin/esptool'), \
+                patch.object(self.agent, '_esptool_api', return_value=None), \
+                patch.object(self.agent.time, 'sleep'), \
+                patch.object(self.agent, '_run_cli', side_effect=[cli_fail, verify_fail, esptool_ok]) as run:
+            ok = self.agent._do_upload_esp32('/dev/ttyUSB0', 'esp32:esp32:esp32', build, lambda m: None,
+                                             {'bootloader'})[0]
+        self.assertTrue(ok)
+        self.assertIn('verify-flash', run.call_args_list[1][0][0])
+        self.assertNotIn('0x1000', run.call_args_list[1][0][0])
+        cmd = run.call_args_list[2][0][0]
+        self.assertNotIn('0x1000', cmd)
+        self.assertEqual(cmd[-4:], ['0x8000', os.path.join(build, 'sketch.ino.partitions.bin'),
+                                    '0x10000', os.path.join(build, 'sketch.ino.bin')])
+
+    def test_windows_port_case_still_finds_serial_number(self):
+        """com3 y COM3 son la misma placa: la clave lleva el número de serie del watcher."""
+        with patch.object(self.agent.platform, 'system', return_value='Windows'), \
+                patch.dict(self.agent._ports_state, {'ports': [{'device': 'COM3', 'serial_number': 'A1B2'}]}):
+            self.assertEqual(self.agent._flash_device_key('com3'), ('COM3|A1B2', 'A1B2'))
+            self.assertEqual(self.agent._flash_device_key(' COM3 '), ('COM3|A1B2', 'A1B2'))
+
+    def test_unplugged_port_without_serial_is_forgotten(self):
+        hashes = {'firmware': 'abc'}
+        self.agent._flash_ledger_record('/dev/ttyUSB0', 'arduino:avr:uno', hashes, True)
+        self.agent._flash_ledger['/dev/ttyUSB1|A1B2'] = {
+            'port': '/dev/ttyUSB1', 'serial_number': 'A1B2', 'fqbn': 'arduino:avr:uno', 'hashes': hashes}
+        self.agent._flash_ledger_forget_ports(['/dev/ttyUSB0', '/dev/ttyUSB1'])
+        self.assertEqual(list(self.agent._flash_ledger), ['/dev/ttyUSB1|A1B2'])
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. pip install -r agent/requirements.txt")
+class TestBinaryArtifacts(unittest.TestCase):
+    """GET /artifacts/<job_id>/<name> y /upload con body binario o multipart."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.client = self.agent.app.test_client()
+        self.tmp = tempfile.mkdtemp()
+        self.received = {}
+        for p in (patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'),
+                  patch.object(self.agent, 'ensure_core_for_fqbn', return_value=(True, None)),
+                  patch.object(self.agent, '_port_exists', return_value=True),
+                  patch.object(self.agent, '_get_home_tmp', lambda: self.tmp),
+                  patch.object(self.agent, '_job_sweeper_thread', MagicMock()),
+                  patch.object(self.agent, 'FLASH_LEDGER_ENABLED', False),
+                  patch.dict(self.agent._upload_job_store, clear=True)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _make_job(self, content):
+        src = os.path.join(self.tmp, 'sketch.ino.bin')
+        with open(src, 'wb') as f:
+            f.write(content)
+        sha = hashlib.sha256(content).hexdigest()
+        art = {'name': 'sketch.ino.bin', 'type': 'binary', 'path': src, 'sha256': sha, 'size': len(content)}
+        job_dir = os.path.join(self.agent._get_upload_jobs_dir(), 'j1')
+        self.agent._handoff_job_artifacts([art], job_dir, move=True)
+        self.agent._store_upload_job(job_dir, 'esp32', 'esp32:esp32:esp32', 'j1')
+        return sha
+
+    def test_artifact_download_with_etag_and_range(self):
+        content = bytes(range(256)) * 4
+        sha = self._make_job(content)
+        resp = self.client.get('/artifacts/j1/sketch.ino.bin')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, content)
+        self.assertEqual(resp.headers['Content-Length'], str(len(content)))
+        self.assertEqual(resp.headers['ETag'], f'"{sha}"')
+        resp = self.client.get('/artifacts/j1/sketch.ino.bin', headers={'Range': 'bytes=100-199'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, content[100:200])
+        resp = self.client.get('/artifacts/j1/sketch.ino.bin', headers={'If-None-Match': f'"{sha}"'})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(self.client.get('/artifacts/j1/manifest.json').status_code, 404)
+        self.assertEqual(self.client.get('/artifacts/nope/sketch.ino.bin').status_code, 404)
+
+    def _capture_avr(self, port, fqbn, hex_file, log_func):
+        with open(hex_file, 'rb') as f:
+            self.received[os.path.basename(hex_file)] = f.read()
+        return True, None, None
+
+    def _capture_esp32(self, port, fqbn, build_dir, log_func, skip_regions=None, report=None):
+        for name in os.listdir(build_dir):
+            with open(os.path.join(build_dir, name), 'rb') as f:
+                self.received[name] = f.read()
+        return True, 'arduino-cli', None, None, []
+
+    def test_upload_raw_octet_stream(self):
+        with patch.object(self.agent, '_do_upload_avr', side_effect=self._capture_avr):
+            resp = self.client.post('/upload?port=/dev/ttyUSB0&fqbn=arduino:avr:uno',
+                                    data=b':00000001FF\n', content_type='application/octet-stream')
+        self.assertEqual(resp.status_code, 200, resp.get_json())
+        self.assertEqual(self.received, {'firmware.hex': b':00000001FF\n'})
+        self.assertEqual([n for n in os.listdir(self.tmp) if n.startswith('upload_in_')], [])
+
+    def test_upload_multipart_esp32_files(self):
+        form = {
+            'port': '/dev/ttyUSB0', 'fqbn': 'esp32:esp32:esp32',
+            'firmware': (io.BytesIO(b'F' * 32), 'sketch.ino.bin'),
+            'bootloader': (io.BytesIO(b'B' * 8), 'sketch.ino.bootloader.bin'),
+        }
+        with patch.object(self.agent, '_do_upload_esp32', side_effect=self._capture_esp32):
+            resp = self.client.post('/upload', data=form, content_type='multipart/form-data')
+        self.assertEqual(resp.status_code, 200, resp.get_json())
+        self.assertEqual(self.received, {'sketch.ino.bin': b'F' * 32, 'sketch.ino.bootloader.bin': b'B' * 8})
+
+    def test_upload_empty_raw_body_rejected(self):
+        resp = self.client.post('/upload?port=/dev/ttyUSB0', data=b'', content_type='application/octet-stream')
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json()['error_code'], 'INVALID_BODY')
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. pip install -r agent/requirements.txt")
+class TestAdaptivePortReset(unittest.TestCase):
+    """reset_serial_port: sin esperas si el puerto está libre; sondeo si está ocupado."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.busy_opens = 0
+        self.opens = 0
+        test = self
+
+        class FakeSerial:
+            def __init__(self):
+                self.port = None
+
+            def open(self):
+                test.opens += 1
+                if test.busy_opens > 0:
+                    test.busy_opens -= 1
+                    raise OSError(16, 'Device or resource busy')
+
+            def reset_input_buffer(self):
+                pass
+
+            def close(self):
+                pass
+
+        p = patch.object(self.agent.serial, 'Serial', FakeSerial)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_clean_port_skips_reset(self):
+        """Puerto libre: una sola apertura y sin sleeps."""
+        t0 = time.time()
+        self.assertTrue(self.agent.reset_serial_port('/dev/ttyUSB0', lambda m: None))
+        self.assertLess(time.time() - t0, 0.05)
+        self.assertEqual(self.opens, 1)
+
+    def test_busy_port_polls_until_free(self):
+        """Puerto ocupado: reintenta hasta que se libera."""
+        self.busy_opens = 3
+        with patch.object(self.agent, 'PORT_READY_POLL_SEC', 0.01):
+            self.assertTrue(self.agent.reset_serial_port('/dev/ttyUSB0', lambda m: None))
+        self.assertEqual(self.opens, 4)
+        self.busy_opens = 1000
+        with patch.object(self.agent, 'PORT_READY_POLL_SEC', 0.01):
+            self.assertFalse(self.agent.reset_serial_port('/dev/ttyUSB0', lambda m: None, timeout=0.05))
+
+    def test_unknown_open_error_fails_fast(self):
+        """Un error no reconocido no se confunde con 'ocupado': sin sondeos."""
+        def broken_open(_self):
+            self.opens += 1
+            raise OSError(22, 'Invalid argument')
+
+        with patch.object(self.agent.serial.Serial, 'open', broken_open):
+            self.assertEqual(self.agent._probe_port('/dev/ttyUSB0'), ('error', '[Errno 22] Invalid argument'))
+            t0 = time.time()
+            self.assertFalse(self.agent.reset_serial_port('/dev/ttyUSB0', lambda m: None, timeout=1.0))
+        self.assertLess(time.time() - t0, 0.5)
+        self.assertEqual(self.opens, 2)
+
+    def test_upload_logs_stage_timings(self):
+        """El log del upload AVR incluye el tiempo de cada etapa."""
+        lines = []
+        ok_run = MagicMock(returncode=0, stdout='', stderr='')
+        with patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'), \
+                patch.object(self.agent, '_run_cli', return_value=ok_run):
+            t0 = time.time()
+            result = self.agent._do_upload_avr('/dev/ttyUSB0', 'arduino:avr:uno', '/tmp/x.hex', lines.append)
+        self.assertEqual(result, (True, None, None))
+        self.assertLess(time.time() - t0, 0.1)
+        self.assertTrue(any('preparar puerto' in l and 'upload #1' in l for l in lines), lines)
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. pip install -r agent/requirements.txt")
+class TestUploadOverlap(unittest.TestCase):
+    """Con code: compilar y preparar el puerto en paralelo."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        ledger_dir = tempfile.mkdtemp()
+        self.port_present = True
+        home_tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home_tmp, True)
+        for p in (patch.object(self.agent, '_get_home_tmp', return_value=home_tmp),
+                  patch.object(self.agent, 'ARDUINO_CLI', '/usr/bin/arduino-cli'),
+                  patch.object(self.agent, 'ensure_core_for_fqbn', return_value=(True, None)),
+                  patch.object(self.agent, '_port_exists', side_effect=lambda port: self.port_present),
+                  patch.object(self.agent, 'PORT_PREP_WATCH_SEC', 0.02),
+                  patch.object(self.agent, '_get_flash_ledger_path', lambda: os.path.join(ledger_dir, 'ledger.json')),
+                  patch.dict(self.agent._flash_ledger, clear=True)):
+            p.start()
+            self.addCleanup(p.stop)
+        self.body = {'fqbn': 'arduino:avr:uno', 'port': '/dev/ttyUSB0', 'code': 'void setup() {} void loop() {}'}
+
+    def test_compile_and_port_prep_overlap(self):
+        def slow_resolve(data, temp_dir, log):
+            time.sleep(0.3)
+            return '/tmp/fake.hex', None
+
+        def slow_reset(port, log_func=None, timeout=None):
+            time.sleep(0.3)
+            return True
+
+        with patch.object(self.agent, '_resolve_hex_for_upload', side_effect=slow_resolve), \
+                patch.object(self.agent, 'reset_serial_port', side_effect=slow_reset), \
+                patch.object(self.agent, '_do_upload_avr', return_value=(True, None, None)) as upload:
+            t0 = time.time()
+            payload, status = self.agent._upload_request(dict(self.body), [])
+            elapsed = time.time() - t0
+        self.assertEqual(status, 200, payload)
+        upload.assert_called_once()
+        self.assertLess(elapsed, 0.55)
+        self.assertGreaterEqual(payload['overlap']['saved_sec'], 0.2)
+        self.assertTrue(any('en paralelo con preparar puerto' in line for line in payload['logs']))
+
+    def test_port_unplugged_cancels_compile(self):
+        def compile_until_cancelled(data, temp_dir, log):
+            job = self.agent._cli_context.job
+            self.port_present = False
+            deadline = time.time() + 5
+            while not job['cancel_requested'] and time.time() < deadline:
+                time.sleep(0.01)
+            raise self.agent.CompileCancelled()
+
+        with patch.object(self.agent, '_resolve_hex_for_upload', side_effect=compile_until_cancelled), \
+                patch.object(self.agent, 'reset_serial_port', return_value=True), \
+                patch.object(self.agent, '_do_upload_avr') as upload:
+            payload, status = self.agent._upload_request(dict(self.body), [])
+        self.assertEqual((status, payload['error_code']), (400, 'PORT_NOT_FOUND'))
+        upload.assert_not_called()
+
+    def test_prebuilt_artifacts_skip_overlap(self):
+        with tempfile.TemporaryDirectory() as build_dir:
+            with patch.object(self.agent, '_resolve_hex_for_upload', return_value=('/tmp/fake.hex', None)), \
+                    patch.object(self.agent, '_do_upload_avr', return_value=(True, None, None)):
+                payload, status = self.agent._upload_request(dict(self.body, build_dir=build_dir), [])
+        self.assertEqual(status, 200)
+        self.assertIsNone(payload['overlap'])
+
+
+@unittest.skipIf(flask is None, "Flask no instalado. pip install -r agent/requirements.txt")
+class TestEsp32FlashProfile(unittest.TestCase):
+    """Perfil de flasheo por placa, regiones comparadas en la placa y tiempos por región."""
+
+    # Salida real de esptool 5.0 (verify-flash / write-flash)
+    VERIFY_OUT = (
+        "Verifying 0x10 (16) bytes at 0x00001000 in flash against '{b}'...\n"
+        "Verification successful (digest matched).\n"
+        "Verifying 0x10 (16) bytes at 0x00008000 in flash against '{p}'...\n"
+        "Verification successful (digest matched).\n"
+        "Verifying 0x40 (64) bytes at 0x00010000 in flash against '{f}'...\n"
+        "Verification failed (digest mismatch).\n"
+    )
+    VERIFY_ERR = '\nA fatal error occurred: Verification failed.\n'
+    WRITE_OUT = 'Wrote 65536 bytes (40000 compressed) at 0x00010000 in 0.7 seconds (749.0 kbit/s).\n'
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.build = tempfile.mkdtemp()
+        self.files = {}
+        for name, content in (('bootloader', b'B' * 16), ('partitions', b'P' * 16), ('firmware', b'F' * 64)):
+            path = os.path.join(self.build, 'firmware.bin' if name == 'firmware' else f'{name}.bin')
+            Path(path).write_bytes(content)
+            self.files[name] = path
+        board = {'fqbn': 'esp32:esp32:esp32', 'family': 'esp32',
+                 'flash': {'baud': 921600, 'flash_mode': 'dio', 'strategy': 'esptool', 'bogus': 1}}
+        for p in (patch.object(self.agent, '_get_board_by_fqbn', return_value=board),
+                  patch.object(self.agent, '_esp32_reset_for_bootloader', return_value=True),
+                  patch.object(self.agent, '_find_esptool', return_value='/usr/bin/esptool'),
+                  patch.object(self.agent, '_esptool_api', return_value=None),
+                  patch.object(self.agent.time, 'sleep')):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_profile_merges_registry_over_defaults(self):
+        profile = self.agent._esp32_flash_profile('esp32:esp32:esp32')
+        self.assertEqual((profile['baud'], profile['flash_mode'], profile['compress']), (921600, 'dio', True))
+        self.assertNotIn('bogus', profile)
+
+    def test_only_differing_regions_are_written_with_profile(self):
+        verify = MagicMock(returncode=2, stdout=self.VERIFY_OUT.format(b=self.files['bootloader'],
+                           p=self.files['partitions'], f=self.files['firmware']), stderr=self.VERIFY_ERR)
+        write = MagicMock(returncode=0, stdout=self.WRITE_OUT, stderr='')
+        report = {}
+        with patch.object(self.agent, '_run_cli', side_effect=[verify, write]) as run:
+            result = self.agent._do_upload_esp32('/dev/ttyUSB0', 'esp32:esp32:esp32', self.build,
+                                                 lambda m: None, None, report)
+        self.assertEqual(result[:2], (True, 'esptool'))
+        self.assertEqual(run.call_count, 2)  # estrategia esptool: sin arduino-cli
+        verify_cmd = run.call_args_list[0][0][0]
+        self.assertEqual(verify_cmd[verify_cmd.index('--flash-mode') + 1], 'dio')
+        cmd = run.call_args_list[1][0][0]
+        self.assertEqual(cmd[cmd.index('--baud') + 1], '921600')
+        self.assertEqual(cmd[cmd.index('--flash-mode') + 1], 'dio')
+        self.assertIn('-z', cmd)
+        self.assertEqual(cmd[-2:], ['0x10000', self.files['firmware']])
+        self.assertNotIn('0x1000', cmd)
+        self.assertEqual(report['regions']['bootloader'], {'offset': '0x1000', 'skipped': 'device'})
+        self.assertEqual(report['regions']['firmware']['sec'], 0.7)
+        self.assertEqual(report['regions']['firmware']['compressed'], 40000)
+        self.assertEqual(report['strategy'], 'esptool')
+
+    def test_identical_board_is_not_written(self):
+        out = self.VERIFY_OUT.replace('failed (digest mismatch)', 'successful (digest matched)')
+        verify = MagicMock(returncode=0, stdout=out.format(b=self.files['bootloader'], p=self.files['partitions'],
+                                                           f=self.files['firmware']), stderr='')
+        with patch.object(self.agent, '_run_cli', side_effect=[verify]) as run:
+            result = self.agent._do_upload_esp32('/dev/ttyUSB0', 'esp32:esp32:esp32', self.build, lambda m: None)
+        self.assertTrue(result[0])
+        self.assertEqual(run.call_count, 1)
+
+    def test_timeout_scales_with_size_and_baud(self):
+        self.assertEqual(self.agent._esp32_flash_timeout(0, 921600), 15)
+        self.assertLess(self.agent._esp32_flash_timeout(1024 * 1024, 921600), 60)
+        self.assertEqual(self.agent._esp32_flash_timeout(4 * 1024 * 1024, 115200), 120)
+
+
+class TestEsptoolInProcess(unittest.TestCase):
+    """esptool por su API de Python: una conexión para verify y write, salida al log."""
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.build = tempfile.mkdtemp()
+        self.paths = {}
+        for name, content in (('bootloader', b'B' * 16), ('partitions', b'P' * 16), ('firmware', b'F' * 64)):
+            path = os.path.join(self.build, 'firmware.bin' if name == 'firmware' else f'{name}.bin')
+            Path(path).write_bytes(content)
+            self.paths[name] = path
+        self.esp = MagicMock(CHIP_NAME='ESP32', ESP_ROM_BAUD=115200)
+        self.write_errors = []
+        self.fake = self._fake_esptool()
+        board = {'fqbn': 'esp32:esp32:esp32', 'family': 'esp32', 'flash': {'strategy': 'esptool'}}
+        for p in (patch.object(self.agent, '_get_board_by_fqbn', return_value=board),
+                  patch.object(self.agent, '_esp32_reset_for_bootloader', return_value=True),
+                  patch.object(self.agent, '_find_esptool', return_value='/usr/bin/esptool'),
+                  patch.object(self.agent.time, 'sleep'),
+                  patch.dict('sys.modules', {'esptool': self.fake})):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _fake_esptool(self):
+        fake = types.ModuleType('esptool')
+        fake.detect_chip = MagicMock(return_value=self.esp)
+        fake.run_stub = MagicMock(side_effect=lambda esp: esp)
+        fake.attach_flash = MagicMock()
+        fake.reset_chip = MagicMock()
+        firmware_addr = 0x10000
+
+        def verify_flash(esp, addr_data, flash_freq='keep', flash_mode='keep', flash_size='keep', diff=False):
+            if addr_data[0][0] == firmware_addr:
+                raise RuntimeError('Verification failed.')
+
+        def write_flash(esp, addr_data, flash_freq='keep', flash_mode='keep', flash_size='keep', **kwargs):
+            if self.write_errors:
+                raise self.write_errors.pop(0)
+            for addr, _path in addr_data:
+                print(f"Wrote 64 bytes (20 compressed) at {addr:#010x} in 0.1 seconds (5.1 kbit/s).")
+
+        fake.verify_flash = MagicMock(side_effect=verify_flash)
+        fake.write_flash = create_autospec(write_flash, side_effect=write_flash)
+        return fake
+
+    def _upload(self, logs, report):
+        with patch.object(self.agent, '_run_cli') as run:
+            result = self.agent._do_upload_esp32('/dev/ttyUSB0', 'esp32:esp32:esp32', self.build,
+                                                 logs.append, None, report)
+        run.assert_not_called()
+        return result
+
+    def test_single_connection_for_verify_and_write(self):
+        logs, report = [], {}
+        result = self._upload(logs, report)
+        self.assertEqual(result[:2], (True, 'esptool'))
+        self.fake.detect_chip.assert_called_once_with('/dev/ttyUSB0', connect_mode='default-reset')
+        self.assertEqual(self.fake.verify_flash.call_count, 3)
+        self.assertEqual(self.fake.write_flash.call_args[0][1], [(0x10000, self.paths['firmware'])])
+        self.esp.change_baud.assert_called_once_with(460800)
+        self.fake.reset_chip.assert_called_once_with(self.esp, 'hard-reset')
+        self.esp._port.close.assert_called_once()
+        self.assertEqual(report['esptool'], 'inprocess')
+        self.assertEqual(report['regions']['partitions'], {'offset': '0x8000', 'skipped': 'device'})
+        self.assertEqual(report['regions']['firmware']['sec'], 0.1)
+        self.assertTrue(any(m.startswith('esptool: Wrote 64 bytes') for m in logs))
+
+    def test_no_reset_retry_reuses_connection(self):
+        self.write_errors.append(RuntimeError('Failed to write to target RAM'))
+        logs, report = [], {}
+        result = self._upload(logs, report)
+        self.assertTrue(result[0])
+        self.fake.detect_chip.assert_called_once()
+        self.esp.connect.assert_called_once_with('no-reset')
+        self.assertEqual(self.fake.write_flash.call_count, 2)
+
+    def test_chip_mismatch_fails_without_writing(self):
+        self.esp.CHIP_NAME = 'ESP32-S3'
+        result = self._upload([], {})
+        self.assertFalse(result[0])
+        self.fake.write_flash.assert_not_called()
+        self.fake.reset_chip.assert_not_called()
+
+    def test_batch_sessions_flash_concurrently(self):
+        """Dos ESP32 en paralelo (como /upload/batch): sin lock global, cada log con sus líneas."""
+        esps = {port: MagicMock(CHIP_NAME='ESP32', ESP_ROM_BAUD=115200, port=port) for port in ('COM1', 'COM2')}
+        self.fake.detect_chip.side_effect = lambda port, connect_mode: esps[port]
+        barrier = threading.Barrier(2, timeout=5)
+
+        def write_flash(esp, addr_data, flash_freq='keep', flash_mode='keep', flash_size='keep', **kwargs):
+            barrier.wait()  # solo pasa si las dos escrituras están en curso a la vez
+            print(f"Wrote 64 bytes (20 compressed) at 0x00010000 in 0.1 seconds ({esp.port}).")
+
+        self.fake.write_flash = create_autospec(write_flash, side_effect=write_flash)
+        stdout = sys.stdout
+        logs = {'COM1': [], 'COM2': []}
+
+        def upload(port):
+            return self.agent._do_upload_esp32(port, 'esp32:esp32:esp32', self.build, logs[port].append, None, {})
+
+        with patch.object(self.agent, '_run_cli') as run, ThreadPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(upload, ['COM1', 'COM2']))
+        run.assert_not_called()
+        self.assertEqual([r[:2] for r in results], [(True, 'esptool')] * 2)
+        for port, other in (('COM1', 'COM2'), ('COM2', 'COM1')):
+            wrote = [m for m in logs[port] if m.startswith('esptool: Wrote')]
+            self.assertEqual(len(wrote), 1)
+            self.assertIn(port, wrote[0])
+            self.assertFalse(any(other in m for m in logs[port]))
+        self.assertIs(sys.stdout, stdout)
+
+    def test_old_api_or_flag_uses_executable(self):
+        self.assertIs(self.agent._esptool_api(), self.fake)
+        with patch.object(self.agent, 'ESPTOOL_INPROCESS', False):
+            self.assertIsNone(self.agent._esptool_api())
+        self.fake.write_flash = lambda esp, args: None  # esptool 4.x: write_flash(esp, args)
+        self.assertIsNone(self.agent._esptool_api())
+
+
+class TestArtifactDownloads(unittest.TestCase):
+    """Artefactos por URL: sesión HTTP compartida y caché por sha256."""
+
+    HEX = b':00000001FF\n'
+
+    def setUp(self):
+        with patch.dict('sys.modules', {'serial': MagicMock(), 'serial.tools.list_ports': MagicMock()}):
+            import agent.agent as agent_mod
+            self.agent = agent_mod
+        self.cache_dir = tempfile.mkdtemp()
+        self.tmp = tempfile.mkdtemp()
+        self.sha = hashlib.sha256(self.HEX).hexdigest()
+        self.get_session = self.agent._get_http_session
+        self.session = MagicMock()
+        self.session.get.return_value = MagicMock(iter_content=lambda n: [self.HEX])
+        for p in (patch.object(self.agent, '_get_download_cache_dir', return_value=self.cache_dir),
+                  patch.object(self.agent, '_get_http_session', return_value=self.session),
+                  patch.dict(self.agent._download_cache_stats, {'hits': 0, 'misses': 0, 'evictions': 0})):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _resolve(self, data):
+        logs = []
+        path, err = self.agent._resolve_hex_for_upload(data, self.tmp, logs.append)
+        return path, err, logs
+
+    def test_download_is_cached_and_reused_by_hash(self):
+        art = {'url': 'http://srv/firmware.hex', 'sha256': self.sha.upper()}
+        path, err, _logs = self._resolve({'artifacts': [art]})
+        self.assertIsNone(err)
+        self.assertEqual(Path(path).read_bytes(), self.HEX)
+        self.assertTrue(os.path.isfile(os.path.join(self.cache_dir, self.sha)))
+        self.assertEqual(self.session.get.call_count, 1)
+        path, err, logs = self._resolve({'artifacts': [art]})
+        self.assertEqual(Path(path).read_bytes(), self.HEX)
+        self.assertEqual(self.session.get.call_count, 1)  # segunda vez sin red
+        self.assertTrue(any('caché' in m for m in logs))
+        self.assertEqual(self.agent.get_download_cache_status()['hits'], 1)
+
+    def test_without_hash_always_downloads(self):
+        self._resolve({'hex_url': 'http://srv/a.hex'})
+        self._resolve({'hex_url': 'http://srv/a.hex'})
+        self.assertEqual(self.session.get.call_count, 2)
+        path, _err, _logs = self._resolve({'hex_url': 'http://srv/a.hex', 'hex_sha256': self.sha})
+        self.assertEqual(self.session.get.call_count, 2)  # el contenido ya estaba en caché
+        self.assertEqual(Path(path).read_bytes(), self.HEX)
+
+    def test_hash_mismatch_is_rejected_and_not_cached(self):
+        path, err, _logs = self._resolve({'artifacts': [{'url': 'http://srv/x.hex', 'sha256': 'a' * 64}]})
+        self.assertIsNone(path)
+        self.assertIn('sha256', err)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'a' * 64)))
+
+    def test_cache_is_bounded(self):
+        with patch.object(self.agent, 'DOWNLOAD_CACHE_MAX_BYTES', len(self.HEX)):
+            old = os.path.join(self.cache_dir, 'b' * 64)
+            Path(old).write_bytes(b'x' * 4)
+            os.utime(old, (0, 0))
+            self._resolve({'hex_url': 'http://srv/a.hex'})
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(self.agent.get_download_cache_status()['entries'], 1)
+
+    def test_shared_session_retries(self):
+        with patch.object(self.agent, '_http_session', None):
+            first, second = self.get_session(), self.get_session()
+        self.assertIs(first, second)
+        self.assertEqual(first.get_adapter('https://srv/x.hex').max_retries.total, self.agent.DOWNLOAD_RETRIES)
+
+
 if __name__ == '__main__':
     unittest.main()